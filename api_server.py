@@ -0,0 +1,262 @@
+import os
+import json
+import time
+import asyncio
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import uvicorn
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+import tracing
+
+# HTTP API for the question pipeline, for front-ends other than Streamlit
+# (Teams, the intranet):
+#   POST /v1/ask          {"question": ...} -> {"answer": markdown, "blocks": [...]}
+#   POST /v1/ask/stream   same body, answer events as server-sent events
+#   GET  /v1/ask/stream?question=...  (for browser EventSource)
+#   GET  /healthz
+# The server is asyncio (Starlette on uvicorn), so waiting clients and open
+# streams cost no thread. Each answer runs ask_question_stream on a bounded
+# worker pool: the pipeline keeps its shared request schedulers, caches and
+# question coalescing (see chat_with_index.py), and the event loop awaits its
+# events. At most API_MAX_IN_FLIGHT questions run at once per worker process;
+# up to API_MAX_QUEUED more wait for a slot, and anything beyond that (or
+# waiting longer than API_QUEUE_TIMEOUT_SECONDS) gets 503 with Retry-After.
+#
+# Run with `python api_server.py` (API_WORKERS processes) or
+# `uvicorn api_server:app --workers N`. Every worker has its own caches and
+# schedulers, so set OPENAI_*_TPM / OPENAI_*_RPM to the quota divided by the
+# number of workers.
+
+load_dotenv(override=True)
+
+# API config
+API_HOST = os.getenv("API_HOST", "0.0.0.0")
+API_PORT = int(os.getenv("API_PORT", "8000"))
+API_WORKERS = int(os.getenv("API_WORKERS", "1"))  # processes
+API_MAX_IN_FLIGHT = int(os.getenv("API_MAX_IN_FLIGHT", "16"))  # questions answered at once; sizes the pipeline's thread pools
+API_MAX_QUEUED = int(os.getenv("API_MAX_QUEUED", "256"))  # questions waiting for a slot before new ones are rejected
+API_QUEUE_TIMEOUT_SECONDS = float(os.getenv("API_QUEUE_TIMEOUT_SECONDS", "10"))  # max wait for a slot
+API_REQUEST_TIMEOUT_SECONDS = float(os.getenv("API_REQUEST_TIMEOUT_SECONDS", "60"))  # whole answer, once it has a slot
+API_MAX_QUESTION_CHARS = int(os.getenv("API_MAX_QUESTION_CHARS", "2000"))
+API_SSE_PING_SECONDS = float(os.getenv("API_SSE_PING_SECONDS", "15"))  # keeps idle streams open through proxies
+
+# Every admitted question may run two answer blocks on the chat pool, and its
+# producer on the coalescing pool; smaller pools would queue admitted
+# questions there until their blocks time out
+os.environ.setdefault("CHAT_MAX_WORKERS", str(2 * API_MAX_IN_FLIGHT))
+os.environ.setdefault("QUESTION_FLIGHT_MAX_WORKERS", str(API_MAX_IN_FLIGHT))
+
+# Imported after the config so the pipeline's clients are built once per worker process
+from chat_with_index import (  # noqa: E402
+    ask_question_stream, format_block, question_flights, CHAT_MAX_WORKERS, QUESTION_FLIGHT_MAX_WORKERS,
+)
+
+if CHAT_MAX_WORKERS < 2 * API_MAX_IN_FLIGHT or QUESTION_FLIGHT_MAX_WORKERS < API_MAX_IN_FLIGHT:
+    raise ValueError(f"API_MAX_IN_FLIGHT={API_MAX_IN_FLIGHT} needs CHAT_MAX_WORKERS >= {2 * API_MAX_IN_FLIGHT} "
+                     f"and QUESTION_FLIGHT_MAX_WORKERS >= {API_MAX_IN_FLIGHT} (got {CHAT_MAX_WORKERS} and "
+                     f"{QUESTION_FLIGHT_MAX_WORKERS}); unset them to size the pools automatically")
+
+pipeline_executor = ThreadPoolExecutor(max_workers=API_MAX_IN_FLIGHT, thread_name_prefix="api")
+
+class Overloaded(Exception):
+    pass
+
+class InFlightLimiter:
+    # Bounded concurrency with a bounded wait queue (backpressure)
+    def __init__(self, max_in_flight=API_MAX_IN_FLIGHT, max_queued=API_MAX_QUEUED, timeout=API_QUEUE_TIMEOUT_SECONDS):
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.max_queued = max_queued
+        self.timeout = timeout
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+
+    async def acquire(self):
+        if self.slots.locked() and self.queued >= self.max_queued:
+            self.rejected += 1
+            raise Overloaded("too many questions waiting")
+        self.queued += 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Overloaded("timed out waiting for a free slot")
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.slots.release()
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "queued": self.queued, "rejected": self.rejected}
+
+limiter = None  # created on startup, inside the worker's event loop
+
+class PipelineRun:
+    # One ask_question_stream run on pipeline_executor, started right away.
+    # It holds its limiter slot until the pipeline thread is done, so a
+    # timed-out or abandoned answer still counts until it has stopped; cancel()
+    # stops it at its next event.
+    def __init__(self, question, endpoint):
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.cancelled = threading.Event()
+        self.loop.run_in_executor(pipeline_executor, self._produce, question, endpoint)
+
+    def _put(self, kind, value):
+        try:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, (kind, value))
+        except RuntimeError:
+            pass  # event loop closed (shutdown)
+
+    def _produce(self, question, endpoint):
+        try:
+            with tracing.span("api_request", endpoint=endpoint):
+                generator = ask_question_stream(question)
+                try:
+                    for event in generator:
+                        if self.cancelled.is_set():
+                            break
+                        self._put("event", event)
+                finally:
+                    generator.close()
+            self._put("end", None)
+        except Exception as e:
+            self._put("error", e)
+        finally:
+            try:
+                self.loop.call_soon_threadsafe(limiter.release)
+            except RuntimeError:
+                pass
+
+    async def events(self, deadline, ping_seconds=None):
+        # Yields the pipeline events, and None after ping_seconds without one.
+        # Raises TimeoutError at the deadline and re-raises pipeline errors.
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            try:
+                kind, value = await asyncio.wait_for(self.queue.get(), min(remaining, ping_seconds or remaining))
+            except asyncio.TimeoutError:
+                if time.monotonic() >= deadline:
+                    raise
+                yield None
+                continue
+            if kind == "error":
+                raise value
+            if kind == "end":
+                return
+            yield value
+
+    def cancel(self):
+        self.cancelled.set()
+
+def error_response(status, message, retry_after=None):
+    headers = {"Retry-After": str(retry_after)} if retry_after else None
+    return JSONResponse({"error": message}, status_code=status, headers=headers)
+
+async def read_question(request):
+    # Returns (question, None) or (None, error response)
+    if request.method == "GET":
+        question = request.query_params.get("question")
+    else:
+        try:
+            body = await request.json()
+        except ValueError:
+            return None, error_response(400, "body must be JSON")
+        question = body.get("question") if isinstance(body, dict) else None
+    if not isinstance(question, str) or not question.strip():
+        return None, error_response(400, "'question' is required")
+    if len(question) > API_MAX_QUESTION_CHARS:
+        return None, error_response(400, f"'question' is longer than {API_MAX_QUESTION_CHARS} characters")
+    return question.strip(), None
+
+async def acquire_slot():
+    # None, or a 503 response when the worker is overloaded
+    try:
+        await limiter.acquire()
+    except Overloaded as e:
+        return error_response(503, f"server busy: {e}", retry_after=max(int(API_QUEUE_TIMEOUT_SECONDS), 1))
+    return None
+
+async def ask(request):
+    question, error = await read_question(request)
+    if error is None:
+        error = await acquire_slot()
+    if error is not None:
+        return error
+    run = PipelineRun(question, "ask")
+    blocks = []
+    try:
+        async for event in run.events(time.monotonic() + API_REQUEST_TIMEOUT_SECONDS):
+            if event["type"] == "done":
+                blocks = event["blocks"]
+    except asyncio.TimeoutError:
+        return error_response(504, "the answer took too long")
+    except Exception as e:
+        print("WARNING - question failed:", e)
+        return error_response(500, "the question could not be answered")
+    finally:
+        run.cancel()
+    return JSONResponse({
+        "answer": "\n\n".join(format_block(block) for block in blocks),
+        "blocks": blocks,
+    })
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+async def ask_stream(request):
+    question, error = await read_question(request)
+    if error is None:
+        error = await acquire_slot()
+    if error is not None:
+        return error
+
+    run = PipelineRun(question, "ask_stream")
+
+    async def body():
+        # Events as produced by ask_question_stream (heading, delta, sources,
+        # done), then "error" if the answer failed or timed out
+        try:
+            async for event in run.events(time.monotonic() + API_REQUEST_TIMEOUT_SECONDS, API_SSE_PING_SECONDS):
+                yield sse(event["type"], event) if event is not None else ": ping\n\n"
+        except asyncio.TimeoutError:
+            yield sse("error", {"type": "error", "message": "the answer took too long"})
+        except Exception as e:
+            print("WARNING - question failed:", e)
+            yield sse("error", {"type": "error", "message": "the question could not be answered"})
+        finally:
+            # Also reached when the client disconnects mid-stream
+            run.cancel()
+
+    return StreamingResponse(body(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def healthz(request):
+    return JSONResponse({"status": "ok", **limiter.stats(), "coalescing": question_flights.stats()})
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global limiter
+    limiter = InFlightLimiter()
+    yield
+
+app = Starlette(
+    routes=[
+        Route("/v1/ask", ask, methods=["POST"]),
+        Route("/v1/ask/stream", ask_stream, methods=["GET", "POST"]),
+        Route("/healthz", healthz, methods=["GET"]),
+    ],
+    lifespan=lifespan,
+)
+
+if __name__ == "__main__":
+    uvicorn.run("api_server:app", host=API_HOST, port=API_PORT, workers=API_WORKERS)
@@ -0,0 +1,711 @@
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import hashlib
+import argparse
+import threading
+import tempfile
+import subprocess
+from io import BytesIO
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+import numpy as np
+
+# Offline benchmark for the question path and the ingestion pipeline. A local
+# stub server stands in for the Azure OpenAI embeddings/chat endpoints and the
+# Azure AI Search REST API (with injected latency and error rates), and the real
+# chat_with_index / embed_to_ai_search code is pointed at it. Results are saved
+# as JSON tagged with the git commit so runs can be compared:
+#   python benchmark.py --concurrency 8 --output bench_new.json --compare bench_old.json
+# --vector-index adds an offline recall/latency comparison of embedding sizes
+# and vector compressions over a local index of the real corpus:
+#   python benchmark.py --skip-query --skip-ingestion --vector-index local_index
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+SAMPLE_PDF_PATH = os.path.join(BENCHMARK_DIR, "sample.pdf")
+CONTRACT_DOC = "Nurses Bargaining Association 2022-2025 Collective Agreement"
+NON_CONTRACT_DOC = "Terms and Conditions of Employment for Non-Contract Employees"
+FAQ_DOC = "PHC New Employee Onboarding FAQ 2025"
+EMPLOYEE_GROUPS = {CONTRACT_DOC: "contract", NON_CONTRACT_DOC: "non_contract"}
+FILTER_CLAUSE = re.compile(r"search\.in\((\w+), '([^']*)', '\|'\)")  # as written by retrievers.odata_filter
+
+# Fixed question set (replayed in order, `--iterations` times)
+QUESTIONS = [
+    "How do I call in sick?",
+    "What happens if I am late for my shift?",
+    "How much vacation do I get in my first year?",
+    "When is payday?",
+    "How do I request a leave of absence?",
+    "What is the overtime rate for nurses?",
+    "Am I paid for statutory holidays?",
+    "How do I enrol in extended health benefits?",
+    "What does Article 14.02 say about WCB top-up?",
+    "How many sick days do non-contract employees get?",
+    "Can I carry over unused vacation?",
+    "What is the probationary period?",
+    "How do I report a workplace injury?",
+    "Who do I contact about my pension?",
+    "How does shift premium work on weekends?",
+    "What is the bereavement leave policy?",
+    "How do I change my direct deposit information?",
+    "What training do new employees have to complete?",
+    "How do I miss a shift without penalty?",
+    "What is the dress code?",
+]
+
+WORDS = (
+    "employee employer shift schedule vacation leave sick illness absence benefit pension overtime "
+    "premium holiday statutory notice manager payroll deposit probation seniority grievance article "
+    "nurse hours week month year entitlement accrual request approval policy health dental training"
+).split()
+
+# --- Stub Azure services ---
+def stub_embedding(text, dims):
+    # Deterministic unit vector per text, so the same chunk always embeds the same way
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dims).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+def random_text(rng, words):
+    return " ".join(rng.choice(WORDS) for _ in range(words)) + "."
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping pooled keep-alive connections is expected
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class StubAzure:
+    # Serves /openai/deployments/*/embeddings, /openai/deployments/*/chat/completions,
+    # the Search docs search/index endpoints, index stats, and /files/<name> PDFs
+    def __init__(self, embed_latency_ms=40, search_latency_ms=30, chat_first_token_ms=300,
+                 chat_token_ms=10, chat_tokens=60, jitter=0.2, error_rate=0.0, dims=1536, seed=0):
+        self.embed_latency_ms = embed_latency_ms
+        self.search_latency_ms = search_latency_ms
+        self.chat_first_token_ms = chat_first_token_ms
+        self.chat_token_ms = chat_token_ms
+        self.chat_tokens = chat_tokens
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.dims = dims
+        self.random = random.Random(seed)
+        self.documents = {}  # search index: id -> document
+        self.matrix = None  # unit vectors of self.documents, rebuilt after writes
+        self.matrix_ids = []
+        self.files = {}  # name -> bytes served under /files/
+        self.lock = threading.Lock()
+        self.requests = defaultdict(int)
+        self.injected_errors = defaultdict(int)
+        self.server = None
+
+    def seed_index(self, documents_per_name=500, seed=0):
+        rng = random.Random(seed)
+        with self.lock:
+            for name in (CONTRACT_DOC, NON_CONTRACT_DOC, FAQ_DOC):
+                for i in range(documents_per_name):
+                    content = " ".join(random_text(rng, 12) for _ in range(20))
+                    doc_id = f"{hashlib.sha1(name.encode()).hexdigest()[:8]}_section_{i}"
+                    self.documents[doc_id] = {
+                        "id": doc_id,
+                        "content": content,
+                        "document_name": name,
+                        "document_url": f"https://example.invalid/{i}.pdf",
+                        "section_number": str(i),
+                        "section_title": random_text(rng, 4),
+                        "employee_group": EMPLOYEE_GROUPS.get(name, "all"),
+                        "embedding": stub_embedding(content, self.dims).tolist(),
+                    }
+            self.matrix = None
+
+    def start(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.handle(self, "GET")
+
+            def do_POST(self):
+                stub.handle(self, "POST")
+
+        self.server = _StubServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, name="stub-azure", daemon=True).start()
+        return f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _sleep(self, ms):
+        if ms > 0:
+            time.sleep(max(0.0, self.random.gauss(ms, ms * self.jitter)) / 1000)
+
+    def handle(self, handler, method):
+        path = urlparse(handler.path).path
+        body = {}
+        length = int(handler.headers.get("Content-Length") or 0)
+        if length:
+            body = json.loads(handler.rfile.read(length) or b"{}")
+        routes = [
+            ("POST", r"/openai/deployments/[^/]+/embeddings$", "embeddings", self.embeddings),
+            ("POST", r"/openai/deployments/[^/]+/chat/completions$", "chat", self.chat),
+            ("POST", r"/indexes(\('[^']+'\)|/[^/]+)/docs/search\.post\.search$", "search", self.search),
+            ("POST", r"/indexes(\('[^']+'\)|/[^/]+)/docs/search\.index$", "index", self.index),
+            ("GET", r"/indexes(\('[^']+'\)|/[^/]+)/(search\.)?stats$", "stats", self.stats),
+            ("GET", r"/files/(?P<name>[^/]+)$", "files", self.file),
+        ]
+        for route_method, pattern, name, func in routes:
+            match = re.search(pattern, path)
+            if route_method == method and match:
+                with self.lock:
+                    self.requests[name] += 1
+                if name != "files" and self.random.random() < self.error_rate:
+                    with self.lock:
+                        self.injected_errors[name] += 1
+                    status = self.random.choice([429, 500, 503])
+                    return self._send_json(handler, status, {"error": {"code": str(status), "message": "injected"}},
+                                           {"Retry-After": "0"} if status == 429 else None)
+                return func(handler, body, match)
+        self._send_json(handler, 404, {"error": {"message": f"no stub for {method} {path}"}})
+
+    def _send_json(self, handler, status, payload, headers=None):
+        data = json.dumps(payload).encode("utf-8")
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            handler.send_header(key, value)
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def embeddings(self, handler, body, match):
+        inputs = body.get("input")
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        self._sleep(self.embed_latency_ms)
+        dims = body.get("dimensions") or self.dims
+        data = []
+        for i, text in enumerate(inputs):
+            vector = stub_embedding(text if isinstance(text, str) else json.dumps(text), dims)
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        tokens = sum(len(str(text).split()) for text in inputs)
+        self._send_json(handler, 200, {"object": "list", "data": data, "model": "stub-embedding",
+                                       "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+    def chat(self, handler, body, match):
+        words = [self.random.choice(WORDS) for _ in range(self.chat_tokens)]
+        prompt_tokens = sum(len(message.get("content", "").split()) for message in body.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words),
+                 "total_tokens": prompt_tokens + len(words)}
+        self._sleep(self.chat_first_token_ms)
+        if not body.get("stream"):
+            self._sleep(self.chat_token_ms * len(words))
+            return self._send_json(handler, 200, {
+                "id": "stub", "object": "chat.completion", "created": int(time.time()), "model": "stub-chat",
+                "choices": [{"index": 0, "finish_reason": "stop",
+                             "message": {"role": "assistant", "content": " ".join(words)}}],
+                "usage": usage,
+            })
+        # Server-sent events over chunked transfer encoding, one chunk per token
+        handler.send_response(200)
+        handler.send_header("Content-Type", "text/event-stream")
+        handler.send_header("Transfer-Encoding", "chunked")
+        handler.end_headers()
+
+        def send(payload):
+            data = f"data: {payload}\n\n".encode("utf-8")
+            handler.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            handler.wfile.flush()
+
+        for i, word in enumerate(words):
+            if i:
+                self._sleep(self.chat_token_ms)
+            send(json.dumps({
+                "id": "stub", "object": "chat.completion.chunk", "created": int(time.time()), "model": "stub-chat",
+                "choices": [{"index": 0, "delta": {"content": ("" if i == 0 else " ") + word},
+                             "finish_reason": None}],
+            }))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            send(json.dumps({"id": "stub", "object": "chat.completion.chunk", "created": int(time.time()),
+                             "model": "stub-chat", "choices": [], "usage": usage}))
+        send("[DONE]")
+        handler.wfile.write(b"0\r\n\r\n")
+        handler.wfile.flush()
+
+    def _index_matrix(self):
+        with self.lock:
+            if self.matrix is None:
+                self.matrix_ids = list(self.documents)
+                vectors = [self.documents[doc_id]["embedding"] for doc_id in self.matrix_ids]
+                matrix = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+                norms = np.linalg.norm(matrix, axis=1, keepdims=True) if len(vectors) else 1
+                self.matrix = matrix / np.where(norms == 0, 1, norms)
+            return self.matrix, self.matrix_ids
+
+    def search(self, handler, body, match):
+        self._sleep(self.search_latency_ms)
+        top = body.get("top") or 50
+        select = body.get("select")
+        fields = select.split(",") if select else None
+        clauses = [(field, set(values.split("|"))) for field, values in FILTER_CLAUSE.findall(body.get("filter") or "")]
+
+        def allowed(doc):
+            return all(doc.get(field) in values for field, values in clauses)
+        vector_queries = body.get("vectorQueries") or []
+        if vector_queries:
+            matrix, ids = self._index_matrix()
+            query = np.asarray(vector_queries[0]["vector"], dtype=np.float32)
+            scores = matrix @ (query / (np.linalg.norm(query) or 1)) if len(ids) else np.zeros(0)
+            ranked = np.argsort(-scores)
+            with self.lock:
+                hits = [(ids[row], float(scores[row])) for row in ranked
+                        if not clauses or allowed(self.documents.get(ids[row], {}))][:top]
+        elif body.get("search"):
+            terms = set(body["search"].lower().split())
+            with self.lock:
+                scored = [(doc_id, len(terms & set(doc["content"].lower().split())))
+                          for doc_id, doc in self.documents.items() if allowed(doc)]
+            hits = sorted((hit for hit in scored if hit[1]), key=lambda hit: -hit[1])[:top]
+        else:
+            with self.lock:
+                hits = [(doc_id, 1.0) for doc_id in list(self.documents)[:top]]
+        with self.lock:
+            value = []
+            for doc_id, score in hits:
+                doc = self.documents.get(doc_id)
+                if doc is None:
+                    continue
+                result = {key: doc.get(key) for key in fields} if fields else dict(doc)
+                result["@search.score"] = score
+                value.append(result)
+        self._send_json(handler, 200, {"value": value})
+
+    def index(self, handler, body, match):
+        self._sleep(self.search_latency_ms)
+        results = []
+        with self.lock:
+            for action in body.get("value", []):
+                doc = {key: value for key, value in action.items() if key != "@search.action"}
+                if action.get("@search.action") == "delete":
+                    self.documents.pop(doc["id"], None)
+                else:
+                    self.documents[doc["id"]] = dict(self.documents.get(doc["id"], {}), **doc)
+                results.append({"key": doc["id"], "status": True, "errorMessage": None, "statusCode": 200})
+            self.matrix = None
+        self._send_json(handler, 200, {"value": results})
+
+    def stats(self, handler, body, match):
+        with self.lock:
+            count = len(self.documents)
+        self._send_json(handler, 200, {"documentCount": count, "storageSize": count * 1024})
+
+    def file(self, handler, body, match):
+        data = self.files.get(match.group("name"))
+        if data is None:
+            return self._send_json(handler, 404, {"error": {"message": "not found"}})
+        handler.send_response(200)
+        handler.send_header("Content-Type", "application/pdf")
+        handler.send_header("Content-Length", str(len(data)))
+        handler.send_header("ETag", f'"{hashlib.sha256(data).hexdigest()[:16]}"')
+        handler.end_headers()
+        handler.wfile.write(data)
+
+# --- Synthetic PDFs ---
+def synthetic_pdf(pages, lines_per_page=45, seed=0):
+    # Minimal PDF with Helvetica text pages laid out like the HR documents
+    # ("Article N - Title" headings followed by paragraphs)
+    rng = random.Random(seed)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in once page object numbers are known
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    page_numbers = []
+    article = 0
+    for _ in range(pages):
+        lines = []
+        for line in range(lines_per_page):
+            if line % 15 == 0:
+                article += 1
+                lines.append(f"Article {article} - {random_text(rng, 3).rstrip('.').title()}")
+            else:
+                lines.append(random_text(rng, 12))
+        text = "".join(f"({line}) Tj T* " for line in lines)
+        stream = f"BT /F1 10 Tf 12 TL 50 760 Td {text}ET".encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream))
+        content_number = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_number
+        )
+        page_numbers.append(len(objects))
+    kids = " ".join(f"{number} 0 R" for number in page_numbers)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_numbers)} >>".encode("ascii")
+
+    out = BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n%s\nendobj\n" % (number, obj))
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+# --- Measurement helpers ---
+def summarize(seconds):
+    if not seconds:
+        return {"count": 0}
+    values = np.asarray(seconds) * 1000
+    return {
+        "count": len(values),
+        "mean_ms": round(float(values.mean()), 2),
+        "p50_ms": round(float(np.percentile(values, 50)), 2),
+        "p95_ms": round(float(np.percentile(values, 95)), 2),
+        "p99_ms": round(float(np.percentile(values, 99)), 2),
+        "max_ms": round(float(values.max()), 2),
+    }
+
+class StageTimer:
+    # Wraps module functions to collect per-stage durations (thread-safe)
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.lock = threading.Lock()
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.samples[name].append(time.perf_counter() - start)
+        return timed
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+
+    def summary(self):
+        with self.lock:
+            return {name: summarize(values) for name, values in self.samples.items()}
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BENCHMARK_DIR,
+                               capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def configure_environment(stub_url, warm_caches):
+    # Must run before chat_with_index / embed_to_ai_search are imported: they
+    # read their configuration and build clients at import time
+    os.environ.update({
+        "AZURE_SEARCH_ENDPOINT": stub_url,
+        "AZURE_SEARCH_API_KEY": "benchmark",
+        "AZURE_OPENAI_EMBEDDING_ENDPOINT": stub_url,
+        "AZURE_OPENAI_EMBEDDING_API_KEY": "benchmark",
+        "AZURE_OPENAI_EMBEDDING_DEPLOYMENT": "benchmark-embedding",
+        "AZURE_OPENAI_CHAT_ENDPOINT": stub_url,
+        "AZURE_OPENAI_CHAT_API_KEY": "benchmark",
+        "AZURE_OPENAI_CHAT_DEPLOYMENT": "benchmark-chat",
+        "OPENAI_API_VERSION": "2024-02-15-preview",
+        "RETRIEVER_BACKEND": "azure",
+        "PDF_TEXT_CACHE_DIR": tempfile.mkdtemp(prefix="benchmark_pdf_text_"),
+        "FAQ_ANSWERS_PATH": os.path.join(tempfile.mkdtemp(prefix="benchmark_faq_"), "faq_answers.json"),
+    })
+    if not warm_caches:
+        # Measure the uncached path: every question embeds, searches and generates
+        os.environ.update({
+            "EMBEDDING_CACHE_ENABLED": "false",
+            "SEMANTIC_CACHE_ENABLED": "false",
+            "QUERY_CACHE_MAX_ENTRIES": "0",
+            "QUESTION_COALESCING_ENABLED": "false",
+        })
+    # The modules call load_dotenv(override=True); a developer .env must not
+    # point the benchmark at the real services
+    import dotenv
+    dotenv.load_dotenv = lambda *args, **kwargs: False
+
+# --- Benchmarks ---
+def run_query_benchmark(questions, concurrency, iterations, warmup):
+    import chat_with_index
+
+    timer = StageTimer()
+    chat_with_index.expand_query = timer.wrap("expand_query", chat_with_index.expand_query)
+    chat_with_index.retrieve = timer.wrap("retrieve", chat_with_index.retrieve)
+    chat_with_index.embed_texts = timer.wrap("embed", chat_with_index.embed_texts)
+    chat_with_index.stream_answer = timer.wrap("chat_block", chat_with_index.stream_answer)
+    retriever = chat_with_index.retriever
+    retriever.search = timer.wrap("vector_search", retriever.search)
+    retriever.keyword_search = timer.wrap("keyword_search", retriever.keyword_search)
+
+    def ask(question):
+        # ask_question() is a thin join over these events; streaming them also
+        # gives the time to the first answer token
+        start = time.perf_counter()
+        first_token = None
+        try:
+            for event in chat_with_index.ask_question_stream(question):
+                if first_token is None and event["type"] == "delta":
+                    first_token = time.perf_counter()
+        except Exception as e:
+            return time.perf_counter() - start, None, f"{type(e).__name__}: {e}"
+        return time.perf_counter() - start, (first_token or time.perf_counter()) - start, None
+
+    for question in questions[:warmup]:
+        ask(question)
+    timer.reset()
+
+    jobs = [question for _ in range(iterations) for question in questions]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(ask, jobs))
+    elapsed = time.perf_counter() - start
+
+    errors = [error for _, _, error in outcomes if error]
+    succeeded = [(total, first) for total, first, error in outcomes if not error]
+    return {
+        "questions": len(jobs),
+        "concurrency": concurrency,
+        "errors": len(errors),
+        "error_samples": sorted(set(errors))[:5],
+        "elapsed_s": round(elapsed, 3),
+        "throughput_qps": round(len(succeeded) / elapsed, 3) if elapsed else None,
+        "latency": summarize([total for total, _ in succeeded]),
+        "time_to_first_token": summarize([first for _, first in succeeded]),
+        "stages": timer.summary(),
+    }
+
+def run_ingestion_benchmark(stub, stub_url, synthetic_pages):
+    import embed_to_ai_search
+    from PyPDF2 import PdfReader
+
+    files = {}
+    if os.path.exists(SAMPLE_PDF_PATH):
+        with open(SAMPLE_PDF_PATH, "rb") as f:
+            files["sample.pdf"] = f.read()
+    for pages in synthetic_pages:
+        files[f"synthetic_{pages}_pages.pdf"] = synthetic_pdf(pages, seed=pages)
+    stub.files.update(files)
+
+    results = {}
+    for name, data in files.items():
+        doc = {"url": f"{stub_url}/files/{name}", "name": f"Benchmark {name}"}
+        page_count = len(PdfReader(BytesIO(data)).pages)
+
+        fd, pdf_path = tempfile.mkstemp(suffix=".pdf")
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        try:
+            # Extraction + chunking + token counting alone, in this process, uncached
+            embed_to_ai_search.PDF_TEXT_CACHE_ENABLED = False
+            start = time.perf_counter()
+            chunk_ids, _ = embed_to_ai_search.parse_document(doc, pdf_path)
+            parse_elapsed = time.perf_counter() - start
+            embed_to_ai_search.PDF_TEXT_CACHE_ENABLED = True
+
+            # Full pipeline: fetch -> parse -> embed -> upload against the stubs
+            # (page-parallel extraction; fills the text cache)
+            start = time.perf_counter()
+            stats, failures, _ = embed_to_ai_search.run_pipeline([doc], None, incremental=False)
+            pipeline_elapsed = time.perf_counter() - start
+
+            # Re-parsing the unchanged PDF: extraction comes from the text cache
+            start = time.perf_counter()
+            embed_to_ai_search.extract_pdf_text(pdf_path)
+            cached_elapsed = time.perf_counter() - start
+        finally:
+            os.remove(pdf_path)
+
+        results[name] = {
+            "bytes": len(data),
+            "pages": page_count,
+            "chunks": stats["chunks_total"],
+            "failures": len(failures),
+            "parse_s": round(parse_elapsed, 3),
+            "parse_chunks_per_s": round(len(chunk_ids) / parse_elapsed, 2) if parse_elapsed else None,
+            "cached_extract_ms": round(cached_elapsed * 1000, 2),
+            "pipeline_s": round(pipeline_elapsed, 3),
+            "pipeline_chunks_per_s": round(stats["chunks_total"] / pipeline_elapsed, 2) if pipeline_elapsed else None,
+            "pipeline_pages_per_s": round(page_count / pipeline_elapsed, 2) if pipeline_elapsed else None,
+        }
+    return results
+
+def run_vector_benchmark(index_path, dimensions, k=6, query_count=200, oversampling=4.0, seed=0):
+    # Recall@k and per-query latency of the local index for each embedding size
+    # and compression, against an exact scan of the full-size float32 vectors.
+    # The queries are indexed chunks (their own row is not counted), so no
+    # embeddings API is needed. Shorter vectors are the leading `dims` values,
+    # renormalized, which is what text-embedding-3 models return for
+    # `dimensions` (ada-002 vectors cannot be shortened this way).
+    from retrievers import LocalVectorIndex
+    from quantization import COMPRESSIONS
+
+    source = LocalVectorIndex.load(index_path, compression="none")
+    vectors = np.asarray(source.vectors)
+    records = source.records
+    if len(records) <= k:
+        raise ValueError(f"{index_path} has only {len(records)} vectors")
+    rows = {record["id"]: row for row, record in enumerate(records)}
+    rng = np.random.default_rng(seed)
+    query_rows = rng.choice(len(records), size=min(query_count, len(records)), replace=False)
+    exact = vectors[query_rows] @ vectors.T
+    exact[np.arange(len(query_rows)), query_rows] = -np.inf
+    truth = [set(np.argpartition(-scores, k - 1)[:k].tolist()) for scores in exact]
+
+    configs = []
+    for dims in dimensions:
+        dims = dims or vectors.shape[1]
+        if dims > vectors.shape[1]:
+            print(f"  skipping {dims} dimensions: the index stores {vectors.shape[1]}")
+            continue
+        shortened = vectors[:, :dims]
+        shortened = np.ascontiguousarray(shortened / np.maximum(np.linalg.norm(shortened, axis=1, keepdims=True), 1e-12))
+        for compression in COMPRESSIONS:
+            for rescore in ((False,) if compression == "none" else (False, True)):
+                index = LocalVectorIndex(shortened, records, compression=compression, rescore=rescore,
+                                         oversampling=oversampling)
+                latencies = []
+                hits = 0
+                for query_row, expected in zip(query_rows, truth):
+                    start = time.perf_counter()
+                    found = index.search(shortened[query_row], k + 1)
+                    latencies.append(time.perf_counter() - start)
+                    found_rows = [rows[result["id"]] for result in found if rows[result["id"]] != query_row][:k]
+                    hits += len(expected & set(found_rows))
+                config = {
+                    "dimensions": dims,
+                    "compression": compression,
+                    "rescore": rescore,
+                    "recall_at_k": round(hits / (k * len(query_rows)), 4),
+                    "scan_mb": round(index.scan_bytes / 2**20, 3),
+                    "latency": summarize(latencies),
+                }
+                configs.append(config)
+                print(f"  {dims:>5}d {compression:<6} rescore={str(rescore):<5} recall@{k}={config['recall_at_k']:.3f} "
+                      f"scan={config['scan_mb']:.2f}MB p50={config['latency']['p50_ms']:.2f}ms")
+    return {"vectors": len(records), "k": k, "queries": len(query_rows), "oversampling": oversampling,
+            "configs": configs}
+
+def compare(current, baseline):
+    # Print key metrics side by side with the baseline run
+    def metrics(result):
+        values = {}
+        query = result.get("query") or {}
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            values[f"query latency {key}"] = (query.get("latency") or {}).get(key)
+        values["query throughput_qps"] = query.get("throughput_qps")
+        for stage, summary in (query.get("stages") or {}).items():
+            values[f"stage {stage} p50_ms"] = summary.get("p50_ms")
+        for name, summary in (result.get("ingestion") or {}).items():
+            values[f"ingest {name} chunks/s"] = summary.get("pipeline_chunks_per_s")
+        for config in (result.get("vectors") or {}).get("configs", []):
+            name = f"vectors {config['dimensions']}d {config['compression']}{' rescored' if config['rescore'] else ''}"
+            values[f"{name} recall"] = config["recall_at_k"]
+            values[f"{name} p50_ms"] = config["latency"].get("p50_ms")
+        return values
+
+    old, new = metrics(baseline), metrics(current)
+    print(f"\nComparison with {baseline.get('commit')} -> {current.get('commit')}")
+    for key in new:
+        before, after = old.get(key), new.get(key)
+        if before is None or after is None:
+            continue
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        print(f"  {key:<45} {before:>10} -> {after:>10}  ({change})")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the question path and ingestion against local Azure stubs.")
+    parser.add_argument("--concurrency", type=int, default=4, help="questions in flight at once")
+    parser.add_argument("--iterations", type=int, default=3, help="times the question set is replayed")
+    parser.add_argument("--warmup", type=int, default=2, help="unrecorded questions before measuring")
+    parser.add_argument("--embed-latency-ms", type=float, default=40)
+    parser.add_argument("--search-latency-ms", type=float, default=30)
+    parser.add_argument("--chat-first-token-ms", type=float, default=300)
+    parser.add_argument("--chat-token-ms", type=float, default=10)
+    parser.add_argument("--chat-tokens", type=int, default=60, help="tokens per stub chat completion")
+    parser.add_argument("--jitter", type=float, default=0.2, help="latency standard deviation as a fraction of the mean")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of stub requests answered with 429/5xx")
+    parser.add_argument("--index-docs", type=int, default=500, help="seeded search documents per HR document")
+    parser.add_argument("--synthetic-pages", default="50,200", help="comma-separated page counts of synthetic PDFs")
+    parser.add_argument("--warm-caches", action="store_true", help="leave the query/embedding/semantic caches on")
+    parser.add_argument("--vector-index", default=None, help="local index (embed_to_ai_search.py --target local) for the vector recall benchmark")
+    parser.add_argument("--vector-dimensions", default="native,1024,512,256", help="comma-separated embedding sizes to compare")
+    parser.add_argument("--vector-queries", type=int, default=200, help="sampled chunks used as queries")
+    parser.add_argument("--vector-k", type=int, default=6, help="results per query (recall@k)")
+    parser.add_argument("--vector-oversampling", type=float, default=4.0, help="rescoring candidates per result")
+    parser.add_argument("--skip-query", action="store_true")
+    parser.add_argument("--skip-ingestion", action="store_true")
+    parser.add_argument("--output", default=None, help="JSON results path (default: benchmark_<commit>.json)")
+    parser.add_argument("--compare", default=None, help="earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    stub = StubAzure(
+        embed_latency_ms=args.embed_latency_ms,
+        search_latency_ms=args.search_latency_ms,
+        chat_first_token_ms=args.chat_first_token_ms,
+        chat_token_ms=args.chat_token_ms,
+        chat_tokens=args.chat_tokens,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+    )
+    stub.seed_index(args.index_docs)
+    stub_url = stub.start()
+    configure_environment(stub_url, args.warm_caches)
+    sys.path.insert(0, BENCHMARK_DIR)
+
+    commit = git_commit()
+    result = {
+        "commit": commit,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "config": vars(args),
+    }
+    try:
+        if not args.skip_query:
+            print(f"Query benchmark: {len(QUESTIONS) * args.iterations} questions at concurrency {args.concurrency}")
+            result["query"] = run_query_benchmark(QUESTIONS, args.concurrency, args.iterations, args.warmup)
+        if not args.skip_ingestion:
+            pages = [int(count) for count in args.synthetic_pages.split(",") if count.strip()]
+            print(f"Ingestion benchmark: sample.pdf + synthetic PDFs of {pages} pages")
+            result["ingestion"] = run_ingestion_benchmark(stub, stub_url, pages)
+        if args.vector_index:
+            dimensions = [None if size.strip() == "native" else int(size) for size in args.vector_dimensions.split(",")]
+            print(f"Vector benchmark: {args.vector_index}, recall@{args.vector_k} against exact full-size search")
+            result["vectors"] = run_vector_benchmark(args.vector_index, dimensions, args.vector_k,
+                                                     args.vector_queries, args.vector_oversampling)
+    finally:
+        result["stub"] = {"requests": dict(stub.requests), "injected_errors": dict(stub.injected_errors)}
+        stub.stop()
+
+    output = args.output or f"benchmark_{commit or 'unknown'}.json"
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(json.dumps({key: result[key] for key in ("query", "ingestion", "vectors") if key in result}, indent=2))
+    print(f"Results saved to {output}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(result, json.load(f))
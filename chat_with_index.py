@@ -1,9 +1,23 @@
 import os
+import json
 from dotenv import load_dotenv
-from openai import AzureOpenAI
-from azure.core.credentials import AzureKeyCredential
-from azure.search.documents import SearchClient
-import requests
+from openai import APITimeoutError
+import threading
+import time
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from embedding_cache import embed_texts
+from query_cache import TTLCache, normalize_query
+from semantic_cache import SemanticCache, SEMANTIC_CACHE_ENABLED
+from clients import get_chat_client, get_embedding_client
+from retrievers import get_retriever, reciprocal_rank_fusion, EMBEDDING_DIMENSIONS
+import re
+import tracing
+from context_builder import build_context, get_encoding
+from rate_limiter import INTERACTIVE, SchedulerTimeout, chat_scheduler
+from single_flight import SingleFlight
+from faq_answers import FaqAnswers, FAQ_FAST_PATH_ENABLED
+from query_router import route_query
 
 # Load environment variables
 load_dotenv(override=True)
@@ -21,29 +35,171 @@ AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT
 AZURE_OPENAI_CHAT_API_KEY = os.getenv("AZURE_OPENAI_CHAT_API_KEY")
 AZURE_OPENAI_CHAT_ENDPOINT = os.getenv("AZURE_OPENAI_CHAT_ENDPOINT")
 AZURE_OPENAI_CHAT_DEPLOYMENT = os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT")
-print(f"DEBUG - AZURE_OPENAI_CHAT_DEPLOYMENT: {AZURE_OPENAI_CHAT_DEPLOYMENT}")
 AZURE_OPENAI_CHAT_API_VERSION = os.getenv("AZURE_OPENAI_CHAT_API_VERSION")
-print("DEBUG - AZURE_OPENAI_CHAT_API_VERSION:", AZURE_OPENAI_CHAT_API_VERSION)
-print("DEBUG - OPENAI_API_VERSION:", os.getenv("OPENAI_API_VERSION"))
-
-# Clients
-embedding_client = AzureOpenAI(
-    api_key=AZURE_OPENAI_EMBEDDING_API_KEY,
-    api_version="2024-02-15-preview",
-    azure_endpoint=AZURE_OPENAI_EMBEDDING_ENDPOINT
-)
 
-chat_client = AzureOpenAI(
-    api_version=os.getenv("OPENAI_API_VERSION"),
-    azure_endpoint=os.getenv("AZURE_OPENAI_CHAT_ENDPOINT"),
-    api_key=os.getenv("AZURE_OPENAI_CHAT_API_KEY"),
-)
+# Clients (shared, connection-pooled; see clients.py)
+embedding_client = get_embedding_client()
+chat_client = get_chat_client()
 
-search_client = SearchClient(
-    endpoint=AZURE_SEARCH_ENDPOINT,
-    index_name="docs",
-    credential=AzureKeyCredential(AZURE_SEARCH_API_KEY)
-)
+# Retrieval backend: Azure AI Search or a local vector index (RETRIEVER_BACKEND, see retrievers.py)
+retriever = get_retriever()
+
+# Hybrid retrieval: a BM25 keyword leg runs alongside the vector leg and the two
+# rankings are merged with reciprocal rank fusion, so exact terms (clause
+# numbers, acronyms, policy names) are found even when the embedding misses them
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")  # "hybrid" or "vector"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))  # results per leg before fusion
+retrieval_executor = ThreadPoolExecutor(max_workers=int(os.getenv("RETRIEVAL_MAX_WORKERS", "8")))
+
+# --- Query caches (module-level, so shared by every Streamlit session) ---
+INDEX_VERSION_CHECK_SECONDS = float(os.getenv("INDEX_VERSION_CHECK_SECONDS", "60"))
+INDEX_MANIFEST_PATH = os.getenv("INDEX_MANIFEST_PATH", "index_manifest.json")  # written by embed_to_ai_search.py
+query_embedding_cache = TTLCache()
+search_results_cache = TTLCache()
+_index_version = {"value": None, "checked_at": float("-inf")}
+_indexed_documents = {"mtime": None, "documents": None}  # last manifest seen by check_index_version
+_index_version_lock = threading.Lock()
+semantic_cache = SemanticCache() if SEMANTIC_CACHE_ENABLED else None
+# Stored answers for FAQ questions, written by embed_to_ai_search.py
+faq_answers = FaqAnswers(AZURE_OPENAI_EMBEDDING_DEPLOYMENT) if FAQ_FAST_PATH_ENABLED else None
+
+# Identical questions asked while one is being answered (after synonym
+# expansion and normalization) share that answer instead of running the
+# pipeline again; see single_flight.py
+QUESTION_COALESCING_ENABLED = os.getenv("QUESTION_COALESCING_ENABLED", "true").lower() in ("1", "true", "yes")
+QUESTION_FLIGHT_MAX_WORKERS = int(os.getenv("QUESTION_FLIGHT_MAX_WORKERS", "16"))  # distinct questions answered at once
+question_flights = SingleFlight(ThreadPoolExecutor(max_workers=QUESTION_FLIGHT_MAX_WORKERS, thread_name_prefix="single-flight"))
+
+def check_index_version():
+    # Poll at most every INDEX_VERSION_CHECK_SECONDS (one caller does the request)
+    # and drop cached embeddings/results when the index has changed, and cached
+    # answers drawn from documents that were re-indexed
+    global retriever
+    now = time.monotonic()
+    with _index_version_lock:
+        if now - _index_version["checked_at"] < INDEX_VERSION_CHECK_SECONDS:
+            return
+        _index_version["checked_at"] = now
+    try:
+        version = retriever.version()
+    except Exception as e:
+        print("WARNING - index version check failed:", e)
+        return
+    with _index_version_lock:
+        changed = _index_version["value"] is not None and version != _index_version["value"]
+        _index_version["value"] = version
+    if changed:
+        # A local index is loaded in memory, so pick up the rebuilt one
+        retriever = get_retriever()
+        query_embedding_cache.clear()
+        search_results_cache.clear()
+    if semantic_cache is not None:
+        invalidate_reindexed_documents()
+
+def indexed_documents(path=INDEX_MANIFEST_PATH):
+    # Document name -> what is indexed for it (PDF hash and chunk IDs), from the manifest
+    with open(path, encoding="utf-8") as f:
+        documents = json.load(f).get("documents", {})
+    return {name: (entry.get("content_hash"), tuple(entry.get("chunks", ()))) for name, entry in documents.items()}
+
+def invalidate_reindexed_documents():
+    # Drop the cached answers drawn from documents that ingestion re-indexed or
+    # removed since the last check, going by the manifest it saves after every
+    # run. Without a manifest (ingestion on another host) entries still match
+    # only their exact chunk IDs, which are content hashes, so an edited chunk
+    # never serves an old answer.
+    try:
+        mtime = os.path.getmtime(INDEX_MANIFEST_PATH)
+        if mtime == _indexed_documents["mtime"]:
+            return
+        documents = indexed_documents(INDEX_MANIFEST_PATH)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        print("WARNING - index manifest could not be read:", e)
+        return
+    previous = _indexed_documents["documents"]
+    _indexed_documents.update(mtime=mtime, documents=documents)
+    if previous is not None:
+        changed = {name for name in previous.keys() | documents.keys() if previous.get(name) != documents.get(name)}
+        if changed:
+            semantic_cache.invalidate_documents(changed)
+
+# --- Chat completions ---
+CHAT_BLOCK_TIMEOUT_SECONDS = float(os.getenv("CHAT_BLOCK_TIMEOUT_SECONDS", "30"))  # per answer block
+CHAT_MAX_WORKERS = int(os.getenv("CHAT_MAX_WORKERS", "8"))
+SYSTEM_PROMPT = "You are a helpful HR assistant. Use the context below to answer accurately. If unsure, say so."
+TIMEOUT_ANSWER = "⚠️ This part of the answer took too long to generate. Please try asking again."
+CHAT_STREAM_USAGE = os.getenv("CHAT_STREAM_USAGE", "false").lower() in ("1", "true", "yes")  # token usage on streams (api-version 2024-09-01-preview+)
+CHAT_COMPLETION_TOKENS_ESTIMATE = int(os.getenv("CHAT_COMPLETION_TOKENS_ESTIMATE", "400"))  # reserved against the TPM budget per block
+chat_executor = ThreadPoolExecutor(max_workers=CHAT_MAX_WORKERS, thread_name_prefix="chat")
+
+def stream_answer(context, query, out, heading=None, deadline=None, cancelled=None):
+    # Runs on chat_executor: pushes ("delta", text) events for each token
+    # chunk, then ("end", None) or ("error", exception), onto the `out` queue.
+    # The request goes through the chat deployment's scheduler, which waits
+    # out throttling (Retry-After) until the block deadline. `deadline` is set
+    # when the block is submitted, so time spent waiting for a chat_executor
+    # thread counts; once the consumer sets `cancelled` (it gave up on the
+    # block), no request is started and a running stream is closed.
+    user_prompt = f"Context:\n{context}\n\nQuestion:\n{query}"
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": user_prompt}
+    ]
+    with tracing.span("chat_block", heading=heading) as span:
+        started = time.perf_counter()
+        if deadline is None:
+            deadline = time.monotonic() + CHAT_BLOCK_TIMEOUT_SECONDS
+        cancelled = cancelled or threading.Event()
+        chunks = 0
+        if cancelled.is_set() or time.monotonic() >= deadline:
+            span.set(completion_chunks=0, error="SchedulerTimeout")
+            out.put(("error", SchedulerTimeout("chat block expired before it started")))
+            return
+
+        def generate():
+            # Returns the total tokens used, when the stream reports usage
+            nonlocal chunks
+            total_tokens = None
+            stream = chat_client.chat.completions.create(
+                model=AZURE_OPENAI_CHAT_DEPLOYMENT,
+                messages=messages,
+                timeout=max(deadline - time.monotonic(), 1.0),
+                stream=True,
+                **({"stream_options": {"include_usage": True}} if CHAT_STREAM_USAGE else {})
+            )
+            for chunk in stream:
+                if cancelled.is_set():
+                    # Nobody reads this block any more: stop generating
+                    stream.close()
+                    span.set(cancelled=True)
+                    break
+                if getattr(chunk, "usage", None):
+                    total_tokens = chunk.usage.total_tokens
+                    span.set(prompt_tokens=chunk.usage.prompt_tokens,
+                             completion_tokens=chunk.usage.completion_tokens)
+                # Azure sends some chunks (e.g. content filter results) with no choices
+                if chunk.choices and chunk.choices[0].delta.content:
+                    if not chunks:
+                        span.set(first_token_ms=round((time.perf_counter() - started) * 1000, 1))
+                    chunks += 1
+                    out.put(("delta", chunk.choices[0].delta.content))
+            return total_tokens
+
+        try:
+            chat_scheduler(AZURE_OPENAI_CHAT_DEPLOYMENT).run(
+                generate,
+                tokens=len(get_encoding().encode(SYSTEM_PROMPT + user_prompt)) + CHAT_COMPLETION_TOKENS_ESTIMATE,
+                priority=INTERACTIVE,
+                deadline=deadline,
+                tokens_used=lambda total_tokens: total_tokens
+            )
+            span.set(completion_chunks=chunks)
+            out.put(("end", None))
+        except Exception as e:
+            span.set(completion_chunks=chunks, error=type(e).__name__)
+            out.put(("error", e))
 
 # Add at the top, after imports
 SYNONYM_MAP = {
@@ -54,41 +210,215 @@ SYNONYM_MAP = {
     # Add more as needed
 }
 
+# All phrases compiled into one pattern, longest first. The lookahead makes
+# matches overlap ("call in sick" also yields "sick"), so one pass over the
+# query finds the same phrases the per-phrase substring checks did. It only
+# reports the longest phrase at each position, so the shorter phrases that
+# start the same way (e.g. "sick" for "sick day") are added from
+# _SYNONYM_PREFIXES: exactly those also match wherever the longer one does.
+_SYNONYM_ORDER = {phrase: i for i, phrase in enumerate(SYNONYM_MAP)}
+_SYNONYM_PATTERN = re.compile(
+    "(?=(" + "|".join(re.escape(phrase) for phrase in sorted(SYNONYM_MAP, key=len, reverse=True)) + "))"
+)
+_SYNONYM_PREFIXES = {
+    phrase: [other for other in SYNONYM_MAP if other != phrase and phrase.startswith(other)]
+    for phrase in SYNONYM_MAP
+}
+
 def expand_query(query):
     expanded = query
-    for phrase, synonyms in SYNONYM_MAP.items():
-        if phrase in query.lower():
-            expanded += " (" + ", ".join(synonyms) + ")"
+    found = set()
+    for match in _SYNONYM_PATTERN.finditer(query.lower()):
+        found.add(match.group(1))
+        found.update(_SYNONYM_PREFIXES[match.group(1)])
+    for phrase in sorted(found, key=_SYNONYM_ORDER.get):
+        expanded += " (" + ", ".join(SYNONYM_MAP[phrase]) + ")"
     return expanded
 
-def ask_question(query):
-    # Expand the query with synonyms before embedding
-    query = expand_query(query)
-    # Step 1: Embed the query
-    query_embedding = embedding_client.embeddings.create(
-        input=[query],
-        model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT
-    ).data[0].embedding
-
-    # Step 2: Call Azure Search REST API for vector search
-    search_url = f"{AZURE_SEARCH_ENDPOINT}/indexes/docs/docs/search?api-version=2023-07-01-Preview"
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": AZURE_SEARCH_API_KEY
+def _scores(results):
+    return [round(result.get("@search.score") or 0.0, 4) for result in results]
+
+def keyword_search(active_retriever, query, filters=None):
+    with tracing.span("keyword_search") as span:
+        results = active_retriever.keyword_search(query, HYBRID_CANDIDATES, filters=filters)
+        span.set(result_count=len(results), scores=_scores(results))
+    return results
+
+def vector_search(active_retriever, query_embedding, k, filters=None):
+    with tracing.span("vector_search") as span:
+        results = active_retriever.search(query_embedding, k=k, filters=filters)
+        span.set(result_count=len(results), scores=_scores(results))
+    return results
+
+def start_keyword_searches(active_retriever, query, routes):
+    # The keyword legs need no embedding: start them first so they overlap
+    # the embedding and vector calls
+    if RETRIEVAL_MODE != "hybrid":
+        return None
+    return [retrieval_executor.submit(tracing.bind(keyword_search), active_retriever, query,
+                                      route.filters if route else None)
+            for route in routes]
+
+def search_routes(active_retriever, query_embedding, routes, keyword_futures):
+    # One vector search per route (in parallel), each fused with its keyword leg,
+    # then merged into the usual 6 results (see merge_routes)
+    k = 6
+    candidates = k if keyword_futures is None else HYBRID_CANDIDATES  # more results per leg before fusion
+    vector_futures = [retrieval_executor.submit(tracing.bind(vector_search), active_retriever, query_embedding,
+                                                candidates, route.filters)
+                      for route in routes[1:]]
+    vector_lists = [vector_search(active_retriever, query_embedding, candidates, routes[0].filters if routes[0] else None)]
+    vector_lists += [future.result() for future in vector_futures]
+    route_lists = []
+    for i, vector_results in enumerate(vector_lists):
+        if keyword_futures is None:
+            route_lists.append(vector_results[:k])
+            continue
+        try:
+            keyword_results = keyword_futures[i].result()
+        except Exception as e:
+            print("WARNING - keyword search failed, using vector results only:", e)
+            keyword_results = []
+        route_lists.append(reciprocal_rank_fusion([vector_results, keyword_results], k=k))
+    return merge_routes(route_lists, k)
+
+def _score(result):
+    return result.get("@search.score") or 0.0
+
+def merge_routes(route_lists, k):
+    # Each route contributes its best k / routes results, the same chunk found
+    # by several routes counts once. Every route also searches the all-staff
+    # documents, so an agreement only makes it into the answer (and gets its
+    # own block) when it ranks against them. Remaining places go to further
+    # passages of the documents already chosen.
+    if len(route_lists) == 1:
+        return route_lists[0][:k]
+    share = max(k // len(route_lists), 1)
+    merged = {}
+    for results in route_lists:
+        for result in results[:share]:
+            if result["id"] not in merged or _score(result) > _score(merged[result["id"]]):
+                merged[result["id"]] = result
+    documents = {result.get("document_name") for result in merged.values()}
+    extra = sorted((result for results in route_lists for result in results[share:]
+                    if result.get("document_name") in documents and result["id"] not in merged),
+                   key=_score, reverse=True)
+    for result in extra:
+        if len(merged) >= k:
+            break
+        merged.setdefault(result["id"], result)
+    return sorted(merged.values(), key=_score, reverse=True)[:k]
+
+def embed_queries(texts):
+    # Embeddings through query_embedding_cache; the misses go out in one request
+    keys = [normalize_query(text) for text in texts]
+    embeddings = [query_embedding_cache.get(key) for key in keys]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        fresh = embed_texts(embedding_client, [texts[i] for i in missing], AZURE_OPENAI_EMBEDDING_DEPLOYMENT, EMBEDDING_DIMENSIONS)
+        for i, embedding in zip(missing, fresh):
+            embeddings[i] = embedding
+            query_embedding_cache.set(keys[i], embedding)
+    return embeddings
+
+def retrieve(query):
+    # Returns (query embedding, search results) for an already-expanded query
+    cache_key = normalize_query(query)
+    check_index_version()
+    active_retriever = retriever
+
+    with tracing.span("retrieve", mode=RETRIEVAL_MODE) as span:
+        results = search_results_cache.get(cache_key)
+        span.set(search_cache_hit=results is not None)
+        routes = keyword_futures = None
+        if results is None:
+            # Filtered searches per employee group when the question names one
+            # (see query_router.py); [None] is a single unfiltered search
+            routes = route_query(query) or [None]
+            span.set(routes=[route.name if route else "all" for route in routes])
+            keyword_futures = start_keyword_searches(active_retriever, query, routes)
+
+        # Step 1: Embed the query
+        with tracing.span("embed") as embed_span:
+            query_embedding = query_embedding_cache.get(cache_key)
+            embed_span.set(query_cache_hit=query_embedding is not None)
+            if query_embedding is None:
+                query_embedding = embed_texts(embedding_client, [query], AZURE_OPENAI_EMBEDDING_DEPLOYMENT, EMBEDDING_DIMENSIONS)[0]
+                query_embedding_cache.set(cache_key, query_embedding)
+
+        # Step 2: Vector search (+ keyword search, fused), per route
+        if results is None:
+            try:
+                results = search_routes(active_retriever, query_embedding, routes, keyword_futures)
+            except Exception as e:
+                if routes == [None]:
+                    raise
+                print("WARNING - routed search failed, searching all documents:", e)
+                results = []
+            if not results and routes != [None]:
+                # e.g. an index built before employee_group existed
+                routes = [None]
+                span.set(routes=["all"], route_fallback=True)
+                results = search_routes(active_retriever, query_embedding, routes,
+                                        start_keyword_searches(active_retriever, query, routes))
+            search_results_cache.set(cache_key, results)
+        span.set(result_count=len(results), scores=_scores(results))
+    return query_embedding, results
+
+def result_source(result, doc_name=None):
+    return {
+        "document_name": doc_name or result.get("document_name", "Unknown Document"),
+        "section_number": result.get("section_number", "N/A"),
+        "section_title": result.get("section_title", "Untitled Section"),
+        "document_url": result.get("document_url", ""),
     }
-    body = {
-        "vectors": [{
-            "value": query_embedding,
-            "fields": "embedding",
-            "k": 6  # get more results to allow for both docs
-        }],
-        "top": 6
+
+def format_citation(source):
+    doc_name = source["document_name"]
+    section_number = source["section_number"]
+    section_title = source["section_title"]
+    document_url = source["document_url"]
+    if document_url:
+        return f"{doc_name} — Section {section_number}: {section_title} ([Link to Document]({document_url}))"
+    return f"{doc_name} — Section {section_number}: {section_title}"
+
+def format_sources(sources):
+    return "\n".join(f"- {format_citation(source)}" for source in sources)
+
+def format_block(block):
+    return f"### {block['heading']}\n{block['answer']}\n\n📚 **Sources:**\n{format_sources(block['sources'])}"
+
+def unique_sources(results, doc_name=None):
+    sources = []
+    seen = set()
+    for result in results:
+        source = result_source(result, doc_name)
+        key = tuple(source.values())
+        if key in seen:
+            continue
+        seen.add(key)
+        sources.append(source)
+    return sources
+
+def faq_block(entry):
+    return {
+        "heading": f"For {entry['document_name']}:",
+        "answer": entry["answer"],
+        "sources": [result_source(entry)],
     }
 
-    response = requests.post(search_url, headers=headers, json=body)
-    response.raise_for_status()
-    results = response.json()["value"]
+def replay_blocks(blocks):
+    # Events for answer blocks that are already complete
+    for i, block in enumerate(blocks):
+        yield {"type": "heading", "block": i, "text": block["heading"]}
+        yield {"type": "delta", "block": i, "text": block["answer"]}
+        yield {"type": "sources", "block": i, "sources": block["sources"]}
+    yield {"type": "done", "blocks": blocks}
 
+def plan_answer_blocks(results):
+    # Returns (blocks, document names) where each block is
+    # {"heading", "context", "sources", "context_stats"}; each context is packed
+    # into the token budget by build_context (see context_builder.py)
     # --- Group results by document type ---
     grouped = {}
     for result in results:
@@ -101,71 +431,149 @@ def ask_question(query):
     present_contract = contract_doc in grouped
     present_non_contract = non_contract_doc in grouped
 
-    # --- Prepare answer blocks ---
-    answer_blocks = []
+    blocks = []
     if present_contract and present_non_contract:
         # Show both contract and non-contract answers
         doc_order = [non_contract_doc, contract_doc]
         for doc_name in doc_order:
             doc_results = grouped[doc_name]
-            context = "\n---\n".join(r["content"] for r in doc_results)
             heading = ("For Non-Contract Employees:" if doc_name == non_contract_doc else "For Contract (Nurse) Employees:")
-            system_prompt = "You are a helpful HR assistant. Use the context below to answer accurately. If unsure, say so."
-            user_prompt = f"Context:\n{context}\n\nQuestion:\n{query}"
-            chat_response = chat_client.chat.completions.create(
-                model=AZURE_OPENAI_CHAT_DEPLOYMENT,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ]
-            )
-            answer = chat_response.choices[0].message.content.strip()
-            sources = []
-            seen = set()
-            for result in doc_results:
-                section_number = result.get("section_number", "N/A")
-                section_title = result.get("section_title", "Untitled Section")
-                document_url = result.get("document_url", "")
-                key = (doc_name, section_number, section_title, document_url)
-                if key in seen:
+            context, used, stats = build_context(doc_results)
+            blocks.append({
+                "heading": heading,
+                "context": context,
+                "sources": unique_sources(used, doc_name),
+                "context_stats": stats,
+            })
+    elif results:
+        # Answer from the best document only, packing its top passages
+        best_result = results[0]
+        doc_name = best_result.get("document_name", "Unknown Document")
+        context, used, stats = build_context(grouped[doc_name])
+        blocks.append({
+            "heading": f"For {result_source(best_result)['document_name']}:",
+            "context": context,
+            "sources": unique_sources(used),
+            "context_stats": stats,
+        })
+    return blocks, list(grouped)
+
+def ask_question_stream(query):
+    # Yields structured events as the answer is produced:
+    #   {"type": "heading", "block": i, "text": ...}
+    #   {"type": "delta", "block": i, "text": ...}       (answer tokens)
+    #   {"type": "sources", "block": i, "sources": [...]}
+    #   {"type": "done", "blocks": [{"heading", "answer", "sources"}, ...]}
+    with tracing.span("ask_question") as span:
+        # Expand the query with synonyms before embedding
+        with tracing.span("expand_query"):
+            expanded = expand_query(query)
+        if not QUESTION_COALESCING_ENABLED:
+            yield from _ask_question_stream(query, expanded, span)
+            return
+        events, leader = question_flights.stream(normalize_query(expanded),
+                                                 lambda: _ask_question_stream(query, expanded, span))
+        span.set(coalesced=not leader)
+        yield from events
+
+def _ask_question_stream(question, query, span):
+    # `question` as asked, `query` after synonym expansion
+
+    # --- FAQ questions are answered with their stored answer, no search or completion ---
+    # (skipped, with its embedding, while no FAQ answers are stored)
+    if faq_answers is not None and faq_answers.has_entries():
+        with tracing.span("faq_match") as faq_span:
+            # Stored questions are embedded as plain questions, so match the
+            # question as asked; the expanded query is embedded in the same
+            # request and cached for retrieve()
+            question_embedding = embed_queries([question, query] if query != question else [question])[0]
+            entry, closest, similarity, runner_up = faq_answers.match(question_embedding)
+            faq_span.set(faq_cache_hit=entry is not None, faq_similarity=round(similarity, 4),
+                         faq_runner_up=round(runner_up, 4),
+                         faq_question=closest["question"] if closest else None)
+        if entry is not None:
+            span.set(answer_blocks=1, faq=True)
+            yield from replay_blocks([faq_block(entry)])
+            return
+
+    query_embedding, results = retrieve(query)
+
+    # --- Reuse the answer to a near-duplicate question over the same chunks ---
+    source_ids = {result.get("id") for result in results}
+    if semantic_cache is not None and results:
+        with tracing.span("semantic_cache") as cache_span:
+            cached_blocks = semantic_cache.lookup(query_embedding, source_ids)
+            cache_span.set(semantic_cache_hit=cached_blocks is not None)
+        if cached_blocks is not None:
+            span.set(answer_blocks=len(cached_blocks), cached=True)
+            yield from replay_blocks(cached_blocks)
+            return
+
+    # --- Generate answer blocks ---
+    # All completions are submitted at once under one deadline, counted from
+    # submission; blocks are emitted in order, so a slow block yields a
+    # partial answer, and a block given up on is cancelled
+    with tracing.span("build_context") as context_span:
+        blocks, documents = plan_answer_blocks(results)
+        context_span.set(
+            context_tokens=sum(block["context_stats"]["tokens"] for block in blocks),
+            saved_context_tokens=sum(block["context_stats"]["saved_tokens"] for block in blocks),
+            duplicate_passages=sum(block["context_stats"]["duplicates"] for block in blocks),
+        )
+    outputs = [queue.Queue() for _ in blocks]
+    cancels = [threading.Event() for _ in blocks]
+    deadline = time.monotonic() + CHAT_BLOCK_TIMEOUT_SECONDS
+    for block, out, cancelled in zip(blocks, outputs, cancels):
+        chat_executor.submit(tracing.bind(stream_answer), block["context"], query, out, block["heading"],
+                             deadline, cancelled)
+    try:
+        answer_blocks = []
+        complete = True  # False when a block timed out; partial answers are not cached
+        for i, (block, out) in enumerate(zip(blocks, outputs)):
+            yield {"type": "heading", "block": i, "text": block["heading"]}
+            parts = []
+            while True:
+                try:
+                    kind, value = out.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    kind, value = "timeout", None
+                if kind == "delta":
+                    parts.append(value)
+                    yield {"type": "delta", "block": i, "text": value}
                     continue
-                seen.add(key)
-                if document_url:
-                    citation = f"{doc_name} — Section {section_number}: {section_title} ([Link to Document]({document_url}))"
-                else:
-                    citation = f"{doc_name} — Section {section_number}: {section_title}"
-                sources.append(citation)
-            formatted_sources = "\n".join(f"- {src}" for src in sources)
-            answer_blocks.append(f"### {heading}\n{answer}\n\n📚 **Sources:**\n{formatted_sources}")
-    else:
-        # Show only the single best/highest-confidence answer
-        if results:
-            best_result = results[0]
-            doc_name = best_result.get("document_name", "Unknown Document")
-            context = best_result["content"]
-            heading = f"For {doc_name}:"
-            system_prompt = "You are a helpful HR assistant. Use the context below to answer accurately. If unsure, say so."
-            user_prompt = f"Context:\n{context}\n\nQuestion:\n{query}"
-            chat_response = chat_client.chat.completions.create(
-                model=AZURE_OPENAI_CHAT_DEPLOYMENT,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt}
-                ]
-            )
-            answer = chat_response.choices[0].message.content.strip()
-            section_number = best_result.get("section_number", "N/A")
-            section_title = best_result.get("section_title", "Untitled Section")
-            document_url = best_result.get("document_url", "")
-            if document_url:
-                citation = f"{doc_name} — Section {section_number}: {section_title} ([Link to Document]({document_url}))"
-            else:
-                citation = f"{doc_name} — Section {section_number}: {section_title}"
-            answer_blocks.append(f"### {heading}\n{answer}\n\n📚 **Sources:**\n- {citation}")
-    return "\n\n".join(answer_blocks)
+                if kind == "error" and not isinstance(value, (APITimeoutError, SchedulerTimeout)):
+                    raise value
+                if kind != "end":
+                    # Deadline passed, the request timed out, or throttling outlasted the deadline
+                    cancels[i].set()
+                    print("WARNING - chat completion timed out:", block["heading"])
+                    notice = ("\n\n" if parts else "") + TIMEOUT_ANSWER
+                    parts.append(notice)
+                    yield {"type": "delta", "block": i, "text": notice}
+                    complete = False
+                break
+            yield {"type": "sources", "block": i, "sources": block["sources"]}
+            answer_blocks.append({"heading": block["heading"], "answer": "".join(parts).strip(), "sources": block["sources"]})
+        if semantic_cache is not None and answer_blocks and complete:
+            semantic_cache.store(query_embedding, source_ids, documents, answer_blocks)
+        span.set(answer_blocks=len(answer_blocks), complete=complete)
+        yield {"type": "done", "blocks": answer_blocks}
+    finally:
+        # Also reached when the consumer stops early: stop unread completions
+        for cancelled in cancels:
+            cancelled.set()
+
+def ask_question(query):
+    # Blocking variant: returns the full markdown answer
+    for event in ask_question_stream(query):
+        if event["type"] == "done":
+            return "\n\n".join(format_block(block) for block in event["blocks"])
 
 # --- Test ---
 if __name__ == "__main__":
+    print(f"DEBUG - AZURE_OPENAI_CHAT_DEPLOYMENT: {AZURE_OPENAI_CHAT_DEPLOYMENT}")
+    print("DEBUG - AZURE_OPENAI_CHAT_API_VERSION:", AZURE_OPENAI_CHAT_API_VERSION)
+    print("DEBUG - OPENAI_API_VERSION:", os.getenv("OPENAI_API_VERSION"))
     while True:
         question = input("\nAsk your HR question: ")
         if question.lower() in ["exit", "quit"]:
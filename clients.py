@@ -0,0 +1,94 @@
+import os
+import threading
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+from openai import AzureOpenAI
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from azure.search.documents import SearchClient
+
+# Shared clients for the question path. Each one is created once per process on
+# first use and reused by every caller (all Streamlit sessions, worker threads).
+# The OpenAI clients (httpx) and requests sessions are thread-safe and keep
+# pooled keep-alive connections, so each question skips the TCP/TLS handshake.
+
+load_dotenv(override=True)
+
+# Azure config
+AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
+AZURE_SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY")
+AZURE_OPENAI_EMBEDDING_API_KEY = os.getenv("AZURE_OPENAI_EMBEDDING_API_KEY")
+AZURE_OPENAI_EMBEDDING_ENDPOINT = os.getenv("AZURE_OPENAI_EMBEDDING_ENDPOINT")
+SEARCH_INDEX_NAME = os.getenv("SEARCH_INDEX_NAME", "docs")  # index alias the app queries (see create_index.py)
+
+# Connection pool config
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "32"))  # max connections per client
+HTTP_KEEPALIVE_SECONDS = float(os.getenv("HTTP_KEEPALIVE_SECONDS", "120"))  # idle time before a pooled connection closes
+HTTP_CONNECT_TIMEOUT_SECONDS = float(os.getenv("HTTP_CONNECT_TIMEOUT_SECONDS", "5"))
+HTTP_READ_TIMEOUT_SECONDS = float(os.getenv("HTTP_READ_TIMEOUT_SECONDS", "60"))
+
+_clients = {}
+_clients_lock = threading.RLock()  # factories may build other shared clients
+
+def _shared(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = factory()
+                _clients[name] = client
+    return client
+
+def _openai_http_client():
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_connections=HTTP_POOL_SIZE,
+            max_keepalive_connections=HTTP_POOL_SIZE,
+            keepalive_expiry=HTTP_KEEPALIVE_SECONDS,
+        ),
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT_SECONDS, connect=HTTP_CONNECT_TIMEOUT_SECONDS),
+    )
+
+def get_http_session():
+    # requests session used for Azure Search (SDK transport and REST calls)
+    def create():
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    return _shared("http_session", create)
+
+def get_embedding_client():
+    return _shared("embedding", lambda: AzureOpenAI(
+        api_key=AZURE_OPENAI_EMBEDDING_API_KEY,
+        api_version="2024-02-15-preview",
+        azure_endpoint=AZURE_OPENAI_EMBEDDING_ENDPOINT,
+        http_client=_openai_http_client(),
+        max_retries=0,  # retried by the request scheduler (rate_limiter.py)
+    ))
+
+def get_chat_client():
+    return _shared("chat", lambda: AzureOpenAI(
+        api_version=os.getenv("OPENAI_API_VERSION"),
+        azure_endpoint=os.getenv("AZURE_OPENAI_CHAT_ENDPOINT"),
+        api_key=os.getenv("AZURE_OPENAI_CHAT_API_KEY"),
+        http_client=_openai_http_client(),
+        max_retries=0,  # retried by the request scheduler (rate_limiter.py)
+    ))
+
+def get_search_client(index_name=SEARCH_INDEX_NAME):
+    return _shared(f"search:{index_name}", lambda: SearchClient(
+        endpoint=AZURE_SEARCH_ENDPOINT,
+        index_name=index_name,
+        credential=AzureKeyCredential(AZURE_SEARCH_API_KEY),
+        transport=RequestsTransport(
+            session=get_http_session(),
+            session_owner=False,
+            connection_timeout=HTTP_CONNECT_TIMEOUT_SECONDS,
+            read_timeout=HTTP_READ_TIMEOUT_SECONDS,
+        ),
+    ))
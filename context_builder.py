@@ -0,0 +1,102 @@
+import os
+from functools import lru_cache
+import tiktoken
+
+# Token-budgeted prompt context for an answer block. Retrieved passages are
+# taken in score order; near-duplicates of an already chosen passage are
+# dropped, text that overlaps a neighbouring chunk of the same section is
+# trimmed, and passages are packed until CONTEXT_MAX_TOKENS is reached.
+
+# Context config
+CONTEXT_MAX_TOKENS = int(os.getenv("CONTEXT_MAX_TOKENS", "1500"))  # per answer block
+CONTEXT_DEDUPE_THRESHOLD = float(os.getenv("CONTEXT_DEDUPE_THRESHOLD", "0.8"))  # shingle containment that counts as a duplicate
+CONTEXT_SEPARATOR = "\n---\n"
+SHINGLE_WORDS = 5
+MIN_OVERLAP_WORDS = 8  # shorter shared runs are left alone
+
+@lru_cache(maxsize=1)
+def get_encoding():
+    return tiktoken.get_encoding("cl100k_base")
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    # Cached: the same chunks come back for many questions
+    return len(get_encoding().encode(text))
+
+def _shingles(words):
+    if len(words) <= SHINGLE_WORDS:
+        return {tuple(words)}
+    return {tuple(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+def _containment(a, b):
+    # Share of the smaller passage's shingles found in the other one
+    if not a or not b:
+        return 0.0
+    return len(a & b) / min(len(a), len(b))
+
+def _overlap(left, right):
+    # Longest run of words that ends `left` and starts `right`
+    best = 0
+    start = max(0, len(left) - len(right))
+    for i in range(start, len(left)):
+        if left[i] == right[0] and left[i:] == right[:len(left) - i]:
+            best = len(left) - i
+            break
+    return best if best >= MIN_OVERLAP_WORDS else 0
+
+def _truncate(text, max_tokens):
+    encoding = get_encoding()
+    return encoding.decode(encoding.encode(text)[:max_tokens])
+
+def build_context(results, max_tokens=CONTEXT_MAX_TOKENS, dedupe_threshold=CONTEXT_DEDUPE_THRESHOLD):
+    # Returns (context, used results, stats). stats: tokens (context size),
+    # candidate_tokens (all passages joined), saved_tokens, duplicates, trimmed,
+    # over_budget (passages left out for lack of room)
+    ranked = sorted(results, key=lambda result: result.get("@search.score") or 0.0, reverse=True)
+    separator_tokens = count_tokens(CONTEXT_SEPARATOR)
+    candidate_tokens = sum(count_tokens(result["content"]) for result in ranked)
+    candidate_tokens += separator_tokens * max(len(ranked) - 1, 0)
+    chosen = []  # (result, words, shingles, text)
+    stats = {"duplicates": 0, "trimmed": 0, "over_budget": 0}
+    used_tokens = 0
+    for result in ranked:
+        words = result["content"].split()
+        if not words:
+            continue
+        shingles = _shingles(words)
+        if any(_containment(shingles, other) >= dedupe_threshold for _, _, other, _ in chosen):
+            stats["duplicates"] += 1
+            continue
+        # Neighbouring chunks of one section repeat their overlap; send it once
+        section = (result.get("document_name"), result.get("section_number"))
+        for other, other_words, _, _ in chosen:
+            if (other.get("document_name"), other.get("section_number")) != section:
+                continue
+            head = _overlap(other_words, words)
+            if head:
+                words = words[head:]
+            tail = _overlap(words, other_words) if words else 0
+            if tail:
+                words = words[:-tail]
+            if head or tail:
+                stats["trimmed"] += 1
+            if not words:
+                break
+        if not words:
+            stats["duplicates"] += 1
+            continue
+        text = " ".join(words) if len(words) != len(result["content"].split()) else result["content"]
+        tokens = count_tokens(text) + (separator_tokens if chosen else 0)
+        if used_tokens + tokens > max_tokens:
+            if chosen:
+                stats["over_budget"] += 1
+                continue
+            # Never send an empty context: cut the best passage to fit
+            text = _truncate(text, max_tokens)
+            tokens = count_tokens(text)
+        chosen.append((result, words, shingles, text))
+        used_tokens += tokens
+    context = CONTEXT_SEPARATOR.join(text for _, _, _, text in chosen)
+    stats.update(tokens=used_tokens, candidate_tokens=candidate_tokens,
+                 saved_tokens=max(candidate_tokens - used_tokens, 0))
+    return context, [result for result, _, _, _ in chosen], stats
@@ -1,58 +1,190 @@
 from azure.search.documents.indexes import SearchIndexClient
 from azure.search.documents.indexes.models import (
     SearchIndex, SimpleField, SearchableField, SearchField, SearchFieldDataType,
-    VectorSearch, HnswAlgorithmConfiguration, VectorSearchProfile
+    VectorSearch, HnswAlgorithmConfiguration, VectorSearchProfile,
+    ScalarQuantizationCompression, ScalarQuantizationParameters, BinaryQuantizationCompression,
+    RescoringOptions, VectorSearchCompressionRescoreStorageMethod, SearchAlias
 )
+from azure.core.exceptions import ResourceNotFoundError
 from azure.core.credentials import AzureKeyCredential
 import os
+import re
+import argparse
 from dotenv import load_dotenv
+from clients import SEARCH_INDEX_NAME
+from retrievers import INDEX_VECTOR_DIMENSIONS, VECTOR_COMPRESSION, VECTOR_RESCORE, VECTOR_OVERSAMPLING
 
 load_dotenv()
 
 AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
 AZURE_SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY")
+INDEX_MANIFEST_PATH = os.getenv("INDEX_MANIFEST_PATH", "index_manifest.json")
+SEARCH_INDEX_KEEP_VERSIONS = int(os.getenv("SEARCH_INDEX_KEEP_VERSIONS", "1"))  # old versions kept for rollback
+
+# Blue/green index versions: every rebuild goes into a new index
+# "<SEARCH_INDEX_NAME>-v<N>", and SEARCH_INDEX_NAME is an alias pointing at the
+# live one. The app and incremental ingestion only use the alias, so a rebuild
+# (embed_to_ai_search.py --rebuild) loads the new version while the old one
+# keeps serving, then repoints the alias in one call.
 
 index_client = SearchIndexClient(
     endpoint=AZURE_SEARCH_ENDPOINT,
     credential=AzureKeyCredential(AZURE_SEARCH_API_KEY)
 )
 
-index_name = "docs"  # Must match your actual index name
-
 fields = [
     SimpleField(name="id", type=SearchFieldDataType.String, key=True),
     SearchableField(name="content", type=SearchFieldDataType.String),
-    SimpleField(name="section_number", type=SearchFieldDataType.String),
+    SimpleField(name="section_number", type=SearchFieldDataType.String, filterable=True, facetable=True),
     SearchableField(name="section_title", type=SearchFieldDataType.String),
-    SimpleField(name="document_name", type=SearchFieldDataType.String),
+    SimpleField(name="document_name", type=SearchFieldDataType.String, filterable=True, facetable=True),
+    SimpleField(name="employee_group", type=SearchFieldDataType.String, filterable=True, facetable=True),  # "contract", "non_contract" or "all"
     SimpleField(name="document_url", type=SearchFieldDataType.String),
     SimpleField(name="section", type=SearchFieldDataType.String),  # <-- This fixes the error
+    SimpleField(name="page_start", type=SearchFieldDataType.Int32),  # first/last PDF page of the chunk
+    SimpleField(name="page_end", type=SearchFieldDataType.Int32),
     SearchField(
         name="embedding",
         type=SearchFieldDataType.Collection(SearchFieldDataType.Single),
         searchable=True,
-        vector_search_dimensions=1536,
+        vector_search_dimensions=INDEX_VECTOR_DIMENSIONS,
         vector_search_profile_name="my-vector-config"
     )
 ]
 
+# Optional int8 / binary quantization of the HNSW vectors (VECTOR_COMPRESSION).
+# The originals are kept so queries can re-score the oversampled matches.
+compressions = []
+if VECTOR_COMPRESSION != "none":
+    rescoring = RescoringOptions(
+        enable_rescoring=VECTOR_RESCORE,
+        default_oversampling=VECTOR_OVERSAMPLING if VECTOR_RESCORE else None,
+        rescore_storage_method=VectorSearchCompressionRescoreStorageMethod.PRESERVE_ORIGINALS
+    )
+    if VECTOR_COMPRESSION == "scalar":
+        compressions.append(ScalarQuantizationCompression(
+            compression_name="my-compression",
+            parameters=ScalarQuantizationParameters(quantized_data_type="int8"),
+            rescoring_options=rescoring
+        ))
+    elif VECTOR_COMPRESSION == "binary":
+        compressions.append(BinaryQuantizationCompression(compression_name="my-compression", rescoring_options=rescoring))
+    else:
+        raise ValueError(f"Unknown VECTOR_COMPRESSION: {VECTOR_COMPRESSION}")
+
 vector_search = VectorSearch(
     algorithms=[HnswAlgorithmConfiguration(name="my-hnsw")],
-    profiles=[VectorSearchProfile(name="my-vector-config", algorithm_configuration_name="my-hnsw")]
+    profiles=[VectorSearchProfile(
+        name="my-vector-config",
+        algorithm_configuration_name="my-hnsw",
+        compression_name="my-compression" if compressions else None
+    )],
+    compressions=compressions
 )
 
-index = SearchIndex(
-    name=index_name,
-    fields=fields,
-    vector_search=vector_search
-)
+def index_versions(alias=SEARCH_INDEX_NAME):
+    # [(version number, index name)] in ascending order
+    pattern = re.compile(rf"^{re.escape(alias)}-v(\d+)$")
+    versions = []
+    for name in index_client.list_index_names():
+        match = pattern.match(name)
+        if match:
+            versions.append((int(match.group(1)), name))
+    return sorted(versions)
 
-# Delete and recreate (careful! deletes old data)
-try:
-    index_client.delete_index(index_name)
-except:
-    pass
+def live_index(alias=SEARCH_INDEX_NAME):
+    # Index the alias points at; the alias name itself for a pre-alias plain
+    # index; None when neither exists
+    try:
+        return index_client.get_alias(alias).indexes[0]
+    except ResourceNotFoundError:
+        pass
+    try:
+        index_client.get_index(alias)
+        return alias
+    except ResourceNotFoundError:
+        return None
 
-index_client.create_index(index)
+def create_next_version(alias=SEARCH_INDEX_NAME):
+    versions = index_versions(alias)
+    name = f"{alias}-v{versions[-1][0] + 1 if versions else 1}"
+    index_client.create_index(SearchIndex(name=name, fields=fields, vector_search=vector_search))
+    return name
+
+def switch_alias(index_name, alias=SEARCH_INDEX_NAME):
+    # Repoint the alias in one update; queries move to the new index atomically
+    if live_index(alias) == alias:
+        # First switch: a plain index still holds the alias name. Deleting it
+        # leaves a short gap before the alias exists; later switches have none.
+        print(f"Replacing the plain index '{alias}' with an alias (one-time migration)")
+        index_client.delete_index(alias)
+    index_client.create_or_update_alias(SearchAlias(name=alias, indexes=[index_name]))
+
+def vector_dimensions(alias=SEARCH_INDEX_NAME):
+    # Size of the live index's embedding field; None when there is no index
+    try:
+        index = index_client.get_index(live_index(alias) or alias)
+    except ResourceNotFoundError:
+        return None
+    return next(field.vector_search_dimensions for field in index.fields if field.name == "embedding")
+
+def add_missing_fields(alias=SEARCH_INDEX_NAME):
+    # Adds the fields of `fields` the live index lacks (e.g. page_start /
+    # page_end on an index built before them); Azure AI Search allows adding
+    # fields in place but not changing existing ones. Returns the added names.
+    index = index_client.get_index(live_index(alias) or alias)
+    existing = {field.name for field in index.fields}
+    missing = [field for field in fields if field.name not in existing]
+    if missing:
+        index.fields = list(index.fields) + missing
+        index_client.create_or_update_index(index)
+    return [field.name for field in missing]
+
+def delete_old_versions(keep=SEARCH_INDEX_KEEP_VERSIONS, alias=SEARCH_INDEX_NAME):
+    # Drop versions older than the live one beyond the `keep` most recent
+    # (abandoned builds numbered below it included). Never touches the live
+    # index or anything newer, which may be a rebuild in progress; a failed
+    # newer build is removed with delete_version(). Returns the deleted names.
+    live = live_index(alias)
+    versions = index_versions(alias)
+    live_number = next((number for number, name in versions if name == live), None)
+    if live_number is None:
+        return []
+    older = [name for number, name in versions if number < live_number]
+    doomed = older[:max(len(older) - keep, 0)]
+    for name in doomed:
+        index_client.delete_index(name)
+    return doomed
+
+def delete_version(index_name, alias=SEARCH_INDEX_NAME):
+    # Delete one index version, e.g. a failed rebuild; refuses the live index
+    if index_name == live_index(alias):
+        raise ValueError(f"'{index_name}' is the live index behind '{alias}'")
+    index_client.delete_index(index_name)
 
-print(f"✅ Index '{index_name}' created with new schema!")
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage versioned Azure AI Search indexes behind the SEARCH_INDEX_NAME alias.")
+    parser.add_argument("--create", action="store_true", help="create the next, empty index version (not live)")
+    parser.add_argument("--switch", metavar="INDEX", help="point the alias at INDEX, e.g. to roll back")
+    parser.add_argument("--gc", action="store_true", help=f"delete old versions beyond SEARCH_INDEX_KEEP_VERSIONS={SEARCH_INDEX_KEEP_VERSIONS}")
+    parser.add_argument("--delete", metavar="INDEX", help="delete a version that is not live, e.g. an interrupted rebuild")
+    args = parser.parse_args()
+    if args.create:
+        name = create_next_version()
+        print(f"✅ Index '{name}' created with new schema "
+              f"({INDEX_VECTOR_DIMENSIONS}-dimension vectors, compression: {VECTOR_COMPRESSION})!")
+    if args.switch:
+        switch_alias(args.switch)
+        # The ingestion manifest describes the previous index; the next run rebuilds it from the index contents
+        if os.path.exists(INDEX_MANIFEST_PATH):
+            os.remove(INDEX_MANIFEST_PATH)
+        print(f"✅ '{SEARCH_INDEX_NAME}' now serves '{args.switch}'")
+    if args.gc:
+        for name in delete_old_versions():
+            print(f"Deleted old index version '{name}'")
+    if args.delete:
+        delete_version(args.delete)
+        print(f"Deleted index version '{args.delete}'")
+    print(f"Live index: {live_index()}; versions: {[name for _, name in index_versions()]}")
+    if not (args.create or args.switch or args.gc or args.delete):
+        print("Rebuild and switch over with: python embed_to_ai_search.py --rebuild")
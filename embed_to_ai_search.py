@@ -4,12 +4,30 @@ from tqdm import tqdm
 import tiktoken
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
+from azure.search.documents.models import VectorizedQuery
 from openai import AzureOpenAI
 import os
 from dotenv import load_dotenv
 import requests
-from io import BytesIO
-import uuid
+import hashlib
+import json
+import argparse
+import queue
+import threading
+import mmap
+import sys
+import tempfile
+import time
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from embedding_cache import embed_texts, get_embedding_cache
+from retrievers import (
+    LocalVectorIndex, LOCAL_INDEX_PATH, EMBEDDING_DIMENSIONS, INDEX_VECTOR_DIMENSIONS, NATIVE_EMBEDDING_DIMENSIONS
+)
+from rate_limiter import BULK
+from faq_answers import FAQ_DOCUMENTS, FAQ_ANSWERS_PATH, faq_entries, load_faq_file, save_faq_file
+from clients import SEARCH_INDEX_NAME
+import create_index
 
 # Load .env
 load_dotenv()
@@ -21,10 +39,42 @@ AZURE_OPENAI_EMBEDDING_API_KEY = os.getenv("AZURE_OPENAI_EMBEDDING_API_KEY")
 AZURE_OPENAI_EMBEDDING_ENDPOINT = os.getenv("AZURE_OPENAI_EMBEDDING_ENDPOINT")
 AZURE_OPENAI_EMBEDDING_DEPLOYMENT = os.getenv("AZURE_OPENAI_EMBEDDING_DEPLOYMENT")
 
+# Batching config
+EMBEDDING_BATCH_MAX_INPUTS = int(os.getenv("EMBEDDING_BATCH_MAX_INPUTS", "64"))  # inputs per embeddings request
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv("EMBEDDING_BATCH_MAX_TOKENS", "60000"))  # total tokens per embeddings request
+UPLOAD_BATCH_SIZE = int(os.getenv("UPLOAD_BATCH_SIZE", "500"))  # documents per upload request
+UPLOAD_ACTION = os.getenv("UPLOAD_ACTION", "merge_or_upload")  # "upload" or "merge_or_upload"
+
+# Pipeline concurrency config (workers per stage)
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", "4"))
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", str(os.cpu_count() or 1)))
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "4"))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "2"))
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "16"))  # max items waiting between stages
+REBUILD_UPLOAD_WORKERS = int(os.getenv("REBUILD_UPLOAD_WORKERS", "8"))  # --rebuild loads an index no one queries yet
+
+# Blue/green rebuild config (--rebuild, see create_index.py)
+REBUILD_SMOKE_TIMEOUT_SECONDS = float(os.getenv("REBUILD_SMOKE_TIMEOUT_SECONDS", "120"))  # wait for the new index to be searchable
+
+# Incremental indexing config
+INDEX_MANIFEST_PATH = os.getenv("INDEX_MANIFEST_PATH", "index_manifest.json")  # record of what is indexed
+
+# Chunking config
+CHUNK_TOKENS = 500  # max tokens per chunk
+FULL_DOCUMENT_CHUNK_TOKENS = 1000  # for documents chunked as one section (EARL Employee Guide)
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "0"))  # tokens repeated between consecutive chunks
+CHUNKER_VERSION = 1  # bump when section parsing or chunk cutting changes, so incremental runs re-chunk
+
+# PDF extraction config
+PDF_TEXT_CACHE_DIR = os.getenv("PDF_TEXT_CACHE_DIR", ".pdf_text_cache")  # extracted text by PDF content hash
+PDF_TEXT_CACHE_ENABLED = os.getenv("PDF_TEXT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "16"))  # pages per process-pool task
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
 # Clients
 search_client = SearchClient(
     endpoint=AZURE_SEARCH_ENDPOINT,
-    index_name="docs",
+    index_name=SEARCH_INDEX_NAME,  # the alias: incremental runs update the live index
     credential=AzureKeyCredential(AZURE_SEARCH_API_KEY)
 )
 
@@ -32,87 +82,261 @@ embedding_client = AzureOpenAI(
     api_key=AZURE_OPENAI_EMBEDDING_API_KEY,
     azure_endpoint=AZURE_OPENAI_EMBEDDING_ENDPOINT,
     api_version="2024-02-15-preview",
+    max_retries=0,  # retried by the request scheduler (rate_limiter.py)
 )
 
-# Document list
+# Document list. employee_group: who the document applies to ("contract",
+# "non_contract" or "all"), the field the question router filters on
 documents = [
     {
         "url": "https://mespaihrchatbotstorage.blob.core.windows.net/phchrchatbotmvpfiles/Common%20Themes%20of%20Questions%20that%20Employees%20.pdf",
-        "name": "Common Themes of Questions that Employees Ask"
+        "name": "Common Themes of Questions that Employees Ask",
+        "employee_group": "all"
     },
     {
         "url": "https://mespaihrchatbotstorage.blob.core.windows.net/phchrchatbotmvpfiles/PHC%20NEE%20FAQ%202025.pdf",
-        "name": "PHC New Employee Onboarding FAQ 2025"
+        "name": "PHC New Employee Onboarding FAQ 2025",
+        "employee_group": "all"
     },
     {
         "url": "https://mespaihrchatbotstorage.blob.core.windows.net/phchrchatbotmvpfiles/Terms%20and%20Conditions%20of%20Employment%20for%20Non%20Contract%20Employees.pdf",
-        "name": "Terms and Conditions of Employment for Non-Contract Employees"
+        "name": "Terms and Conditions of Employment for Non-Contract Employees",
+        "employee_group": "non_contract"
     },
     {
         "url": "https://mespaihrchatbotstorage.blob.core.windows.net/phchrchatbotmvpfiles/Nurses%20Bargaining%20Association%202022-2025%20Collective%20Agreement.pdf",
-        "name": "Nurses Bargaining Association 2022-2025 Collective Agreement"
+        "name": "Nurses Bargaining Association 2022-2025 Collective Agreement",
+        "employee_group": "contract"
     },
     {
         "url": "https://mespaihrchatbotstorage.blob.core.windows.net/phchrchatbotmvpfiles/Andgo%20Login%20Guide.pdf",
-        "name": "Andgo Login Guide"
+        "name": "Andgo Login Guide",
+        "employee_group": "all"
     },
     {
         "url": "https://mespaihrchatbotstorage.blob.core.windows.net/phchrchatbotmvpfiles/Andgo%20User%20A%20Guide%20-%20How%20to%20Apply%20for%20Shifts%20and%20Blocks.pdf",
-        "name": "Andgo User A Guide - How to Apply for Shifts and Blocks"
+        "name": "Andgo User A Guide - How to Apply for Shifts and Blocks",
+        "employee_group": "all"
     },
     {
         "url": "https://mespaihrchatbotstorage.blob.core.windows.net/phchrchatbotmvpfiles/Andgo%20User%20Guide%20-%20How%20to%20Change%20Your%20Smart%20Call%20Preferences.pdf",
-        "name": "Andgo User Guide - How to Change Your Smart Call Preferences"
+        "name": "Andgo User Guide - How to Change Your Smart Call Preferences",
+        "employee_group": "all"
     },
     {
         "url": "https://mespaihrchatbotstorage.blob.core.windows.net/phchrchatbotmvpfiles/Andgo%20User%20Guide%20-%20How%20to%20View%20MySchedule.pdf",
-        "name": "Andgo User Guide - How to View MySchedule"
+        "name": "Andgo User Guide - How to View MySchedule",
+        "employee_group": "all"
     },
     {
         "url": "https://mespaihrchatbotstorage.blob.core.windows.net/phchrchatbotmvpfiles/Angdo%20User%20Guide%20-%20How%20to%20View%20My%20Information.pdf",
-        "name": "Angdo User Guide - How to View My Information"
+        "name": "Angdo User Guide - How to View My Information",
+        "employee_group": "all"
     },
     {
         "url": "https://mespaihrchatbotstorage.blob.core.windows.net/phchrchatbotmvpfiles/EARL%20Employee%20Guide.pdf",
-        "name": "EARL Employee Guide"
+        "name": "EARL Employee Guide",
+        "employee_group": "all"
     }
 ]
 
+encoding = tiktoken.get_encoding("cl100k_base")
+
 # Chunking function
-def chunk_text(text, max_tokens=500):
-    encoding = tiktoken.get_encoding("cl100k_base")
-    words = text.split()
-    chunks = []
-    current = []
-    current_tokens = 0
-
-    for word in words:
-        tokens = len(encoding.encode(word))
-        if current_tokens + tokens > max_tokens:
-            chunks.append(" ".join(current))
-            current = [word]
-            current_tokens = tokens
-        else:
-            current.append(word)
-            current_tokens += tokens
+SENTENCE_ENDINGS = ".!?:;"
 
-    if current:
-        chunks.append(" ".join(current))
+def _is_cut_point(text, offsets, k, sentence):
+    # Token k starts on whitespace, so cutting before it never splits a word.
+    # A sentence cut additionally needs the preceding character to end a sentence/line.
+    start = offsets[k]
+    if start >= len(text) or not text[start].isspace():
+        return False
+    if not sentence:
+        return True
+    return text[start] == "\n" or text[start - 1] in SENTENCE_ENDINGS
 
-    return chunks
+def _snap_cut(text, offsets, lo, hi):
+    # Best token index in (lo, hi] to cut at: a sentence boundary, else whitespace, else hi
+    for sentence in (True, False):
+        for k in range(hi, lo, -1):
+            if _is_cut_point(text, offsets, k, sentence):
+                return k
+    return hi
+
+def chunk_text(text, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP_TOKENS):
+    for _, _, chunk in chunk_spans(text, max_tokens, overlap):
+        yield chunk
+
+def chunk_spans(text, max_tokens=CHUNK_TOKENS, overlap=CHUNK_OVERLAP_TOKENS):
+    # Encode the section once and cut on token offsets, yielding
+    # (start char, end char, chunk) lazily
+    tokens = encoding.encode(text)
+    n = len(tokens)
+    if not n:
+        return
+    text, offsets = encoding.decode_with_offsets(tokens)
+    overlap = min(overlap, max_tokens // 2)
+    start = 0
+    while start < n:
+        end = start + max_tokens
+        if end >= n:
+            cut = n
+        else:
+            # Only look back over the second half of the window for a clean cut
+            cut = _snap_cut(text, offsets, start + max_tokens // 2, end)
+        chunk_end = offsets[cut] if cut < n else len(text)
+        chunk = " ".join(text[offsets[start]:chunk_end].split())
+        if chunk:
+            yield offsets[start], chunk_end, chunk
+        if cut >= n:
+            break
+        next_start = cut
+        if overlap:
+            # Back up by `overlap` tokens, then forward to the next word start
+            next_start = max(cut - overlap, start + 1)
+            while next_start < cut and not _is_cut_point(text, offsets, next_start, False):
+                next_start += 1
+        start = next_start
 
 # Fetch and parse remote PDF
-def fetch_and_parse_pdf(url):
-    response = requests.get(url)
-    response.raise_for_status()
-    pdf_bytes = BytesIO(response.content)
-    reader = PdfReader(pdf_bytes)
-    text = ""
-    for page in reader.pages:
-        page_text = page.extract_text()
+def download_pdf(url, headers=None):
+    # Streams the body to a temp file, hashing it on the way. Returns None on
+    # 304 Not Modified, else (path, etag, last_modified, content hash); the
+    # caller deletes the file.
+    with requests.get(url, headers=headers, stream=True) as response:
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+        digest = hashlib.sha256()
+        fd, path = tempfile.mkstemp(suffix=".pdf")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for block in response.iter_content(DOWNLOAD_CHUNK_BYTES):
+                    f.write(block)
+                    digest.update(block)
+        except BaseException:
+            os.remove(path)
+            raise
+        return path, response.headers.get("ETag"), response.headers.get("Last-Modified"), digest.hexdigest()
+
+def _open_pdf(pdf_path):
+    # Memory-map the file instead of reading it into memory
+    with open(pdf_path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+def extract_page_range(pdf_path, start, stop=None):
+    # Runs in the process pool: (page count, text of pages [start, stop)), stop
+    # clipped to the page count (None for the rest of the document)
+    with _open_pdf(pdf_path) as data:
+        reader = PdfReader(data)
+        page_count = len(reader.pages)
+        stop = page_count if stop is None else min(stop, page_count)
+        return page_count, [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+def join_pages(pages):
+    # Same layout as before (non-empty pages, each followed by a newline), plus
+    # the character offset at which every page starts
+    page_offsets = []
+    position = 0
+    for page_text in pages:
+        page_offsets.append(position)
         if page_text:
-            text += page_text + "\n"
-    return text
+            position += len(page_text) + 1
+    return "".join(page_text + "\n" for page_text in pages if page_text), page_offsets
+
+def _text_cache_path(pdf_hash):
+    return os.path.join(PDF_TEXT_CACHE_DIR, f"{pdf_hash}.json")
+
+def extract_pdf_text(pdf_path, pdf_hash=None, pool=None):
+    # Returns (text, page offsets). Page ranges are extracted in parallel when a
+    # process pool is given. Results are cached on disk by content hash, so an
+    # unchanged PDF is never parsed twice.
+    if pdf_hash is None:
+        with _open_pdf(pdf_path) as data:
+            pdf_hash = content_hash(data)
+    cache_path = _text_cache_path(pdf_hash)
+    if PDF_TEXT_CACHE_ENABLED and os.path.exists(cache_path):
+        try:
+            with open(cache_path, encoding="utf-8") as f:
+                return join_pages(json.load(f)["pages"])
+        except (OSError, ValueError, KeyError) as e:
+            print("WARNING - unreadable PDF text cache entry:", cache_path, e)
+
+    if pool is None:
+        _, pages = extract_page_range(pdf_path, 0)
+    else:
+        # The first range also returns the page count, so a short PDF is a
+        # single task and the calling thread never parses the PDF itself
+        page_count, pages = pool.submit(extract_page_range, pdf_path, 0, PDF_PAGES_PER_TASK).result()
+        futures = [pool.submit(extract_page_range, pdf_path, start, start + PDF_PAGES_PER_TASK)
+                   for start in range(PDF_PAGES_PER_TASK, page_count, PDF_PAGES_PER_TASK)]
+        pages += [text for future in futures for text in future.result()[1]]
+
+    if PDF_TEXT_CACHE_ENABLED:
+        os.makedirs(PDF_TEXT_CACHE_DIR, exist_ok=True)
+        with open(f"{cache_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"pages": pages}, f)
+        os.replace(f"{cache_path}.tmp", cache_path)
+    return join_pages(pages)
+
+def fetch_and_parse_pdf(url):
+    pdf_path, _, _, pdf_hash = download_pdf(url)
+    try:
+        with ProcessPoolExecutor() as pool:
+            return extract_pdf_text(pdf_path, pdf_hash, pool)[0]
+    finally:
+        os.remove(pdf_path)
+
+def fetch_pdf_if_changed(url, entry=None):
+    # Conditional GET against the manifest entry. Returns None when the server
+    # says the file is unchanged, else (pdf_path, etag, last_modified, content
+    # hash) for a temp file the caller deletes.
+    headers = {}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    return download_pdf(url, headers)
+
+# --- Manifest of indexed content ---
+def content_hash(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+def chunking_settings():
+    # Recorded in the manifest: chunks indexed under other settings are stale
+    return {
+        "version": CHUNKER_VERSION,
+        "chunk_tokens": CHUNK_TOKENS,
+        "full_document_chunk_tokens": FULL_DOCUMENT_CHUNK_TOKENS,
+        "overlap_tokens": CHUNK_OVERLAP_TOKENS,
+    }
+
+def load_manifest(path=INDEX_MANIFEST_PATH):
+    # {"embedding_dimensions": n, "chunking": chunking_settings(),
+    #  "documents": {name: {"url", "etag", "last_modified", "content_hash", "chunks": [ids]}}}
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_manifest(manifest, path=INDEX_MANIFEST_PATH):
+    # Write to a temp file first so an interrupted run never leaves a torn manifest
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def manifest_from_index():
+    # Seed a manifest from whatever is already in the index (e.g. chunks with the
+    # old random IDs) so the first incremental run can clean them up
+    documents = {}
+    for result in search_client.search(search_text="*", select=["id", "document_name"]):
+        entry = documents.setdefault(result.get("document_name") or "Unknown Document", {"chunks": []})
+        entry["chunks"].append(result["id"])
+    return {"documents": documents}
 
 def parse_faq_sections(text):
     # Split on Q: or Q. or bullet points (\u2022 or -)
@@ -175,42 +399,563 @@ def parse_sections(text):
     # Fallback: treat whole doc as one section
     return [{"number": "1", "title": "Full Document", "content": text}]
 
-# Main embed loop
-print("RUNNING:", __file__)
-for doc in documents:
-    print(f"Fetching and parsing: {doc['url']}")
-    content = fetch_and_parse_pdf(doc["url"])
+# --- Batching ---
+def batch_records(records, max_inputs=EMBEDDING_BATCH_MAX_INPUTS, max_tokens=EMBEDDING_BATCH_MAX_TOKENS):
+    # Pack records into batches capped by input count and total token count.
+    # A single record larger than max_tokens still goes out alone.
+    batch = []
+    batch_tokens = 0
+    for record in records:
+        tokens = len(encoding.encode(record["content"]))
+        if batch and (len(batch) >= max_inputs or batch_tokens + tokens > max_tokens):
+            yield batch
+            batch = []
+            batch_tokens = 0
+        batch.append(record)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+def embed_batch(batch):
+    # Cached chunks are served locally; only misses go to the embeddings API,
+    # queued behind interactive (question) traffic on the same deployment
+    embeddings = embed_texts(
+        embedding_client,
+        [record["content"] for record in batch],
+        AZURE_OPENAI_EMBEDDING_DEPLOYMENT,
+        EMBEDDING_DIMENSIONS,
+        priority=BULK
+    )
+    for record, embedding in zip(batch, embeddings):
+        record["embedding"] = embedding
+    return batch
+
+def upload_batch(batch, client=None):
+    # Returns a list of (id, error) for every document that failed
+    client = client or search_client
+    if UPLOAD_ACTION == "upload":
+        upload = client.upload_documents
+    else:
+        upload = client.merge_or_upload_documents
+    try:
+        results = upload(documents=batch)
+    except Exception as e:
+        return [(doc["id"], str(e)) for doc in batch]
+    return [
+        (result.key, f"{result.status_code}: {result.error_message}")
+        for result in results
+        if not result.succeeded
+    ]
+
+def delete_ids(ids, batch_size=UPLOAD_BATCH_SIZE):
+    # Returns a list of (id, error) for every delete that failed
+    failures = []
+    ids = list(ids)
+    for i in range(0, len(ids), batch_size):
+        batch = [{"id": doc_id} for doc_id in ids[i:i + batch_size]]
+        try:
+            results = search_client.delete_documents(documents=batch)
+        except Exception as e:
+            failures.extend((doc["id"], f"delete failed: {e}") for doc in batch)
+            continue
+        failures.extend(
+            (result.key, f"delete failed: {result.status_code}: {result.error_message}")
+            for result in results
+            if not result.succeeded
+        )
+    return failures
+
+def backfill_employee_groups():
+    # Sets employee_group on chunks indexed before the field existed, which
+    # every routed search would leave out, without re-embedding them.
+    # Returns (chunks updated, failures).
+    groups = {doc["name"]: doc["employee_group"] for doc in documents}
+    pending = [
+        {"id": result["id"], "employee_group": groups.get(result.get("document_name"), "all")}
+        for result in search_client.search(search_text="*", filter="employee_group eq null",
+                                           select=["id", "document_name"])
+    ]
+    failures = []
+    for i in range(0, len(pending), UPLOAD_BATCH_SIZE):
+        batch = pending[i:i + UPLOAD_BATCH_SIZE]
+        try:
+            results = search_client.merge_documents(documents=batch)
+        except Exception as e:
+            failures.extend((doc["id"], f"employee_group backfill failed: {e}") for doc in batch)
+            continue
+        failures.extend(
+            (result.key, f"employee_group backfill failed: {result.status_code}: {result.error_message}")
+            for result in results
+            if not result.succeeded
+        )
+    return len(pending) - len(failures), failures
+
+# --- Document processing (runs in the process pool) ---
+def build_records(doc, content, page_offsets=None):
     # For EARL Employee Guide, treat the whole doc as one section and use larger chunk size
     if doc["name"] == "EARL Employee Guide":
         sections = [{"number": "1", "title": "Full Document", "content": content}]
-        chunk_size = 1000
+        chunk_size = FULL_DOCUMENT_CHUNK_TOKENS
     else:
         sections = parse_sections(content)
-        chunk_size = 500
+        chunk_size = CHUNK_TOKENS
     safe_name = re.sub(r'[^A-Za-z0-9_\-=]', '_', doc['name'])
+    records = []
+    seen_ids = set()
+    cursor = 0
     for section in sections:
+        # Sections are slices of `content` in order; their position maps chunks to pages
+        section_start = content.find(section["content"], cursor) if page_offsets else -1
+        if section_start >= 0:
+            cursor = section_start
         section_number = section["number"] if section["number"] else ""
         section_title = section["title"] if section["title"] else ""
-        section_chunks = chunk_text(section["content"], max_tokens=chunk_size)
+        safe_section = re.sub(r'[^A-Za-z0-9_\-=]', '_', section_number)
         # Print out chunks for EARL Employee Guide
         if doc["name"] == "EARL Employee Guide":
             print(f"\n--- Chunks for EARL Employee Guide, Section: {section_title} ---")
-            for idx, chunk in enumerate(section_chunks):
-                print(f"Chunk {idx+1}:\n{chunk}\n{'-'*40}")
-        for j, chunk in enumerate(section_chunks):
-            response = embedding_client.embeddings.create(
-                input=[chunk],
-                model=AZURE_OPENAI_EMBEDDING_DEPLOYMENT
-            )
-            embedding = response.data[0].embedding
-            metadata = {
-                "id": f"{safe_name}_section_{section_number}_{j+1}_{uuid.uuid4().hex[:8]}",
+        for j, (chunk_start, chunk_end, chunk) in enumerate(chunk_spans(section["content"], max_tokens=chunk_size)):
+            if doc["name"] == "EARL Employee Guide":
+                print(f"Chunk {j+1}:\n{chunk}\n{'-'*40}")
+            # Stable ID: same document, section and text always map to the same key
+            chunk_id = f"{safe_name}_section_{safe_section}_{content_hash(section_title + chr(10) + chunk)[:16]}"
+            if chunk_id in seen_ids:
+                continue
+            seen_ids.add(chunk_id)
+            page_start = page_end = None
+            if section_start >= 0:
+                page_start = bisect_right(page_offsets, section_start + chunk_start)
+                page_end = bisect_right(page_offsets, section_start + max(chunk_end - 1, chunk_start))
+            records.append({
+                "id": chunk_id,
                 "content": chunk,
-                "embedding": embedding,
                 "document_name": doc["name"],
                 "document_url": doc["url"],
                 "section_number": section_number,
-                "section_title": section_title
-            }
-            search_client.upload_documents(documents=[metadata])
-print("✅ All documents embedded and uploaded to Azure AI Search.")
\ No newline at end of file
+                "section_title": section_title,
+                "employee_group": doc.get("employee_group", "all"),
+                "page_start": page_start,
+                "page_end": page_end
+            })
+    return records
+
+def chunk_document(doc, content, page_offsets=None, skip_ids=frozenset()):
+    # CPU-bound: section parsing, chunking and token counting for batching.
+    # Returns every chunk ID plus batches of the chunks not already indexed.
+    records = build_records(doc, content, page_offsets)
+    new_records = [record for record in records if record["id"] not in skip_ids]
+    return [record["id"] for record in records], list(batch_records(new_records))
+
+def parse_document(doc, pdf_path, skip_ids=frozenset(), pdf_hash=None):
+    # Text extraction (cached) followed by chunk_document, in this process
+    content, page_offsets = extract_pdf_text(pdf_path, pdf_hash)
+    return chunk_document(doc, content, page_offsets, skip_ids)
+
+# --- FAQ answers (fast path for the question flow, see faq_answers.py) ---
+def document_text(doc, entry=None):
+    # Extracted text of a document: from the text cache when the manifest entry
+    # has its content hash, otherwise downloaded and parsed again
+    pdf_hash = (entry or {}).get("content_hash")
+    if pdf_hash and PDF_TEXT_CACHE_ENABLED and os.path.exists(_text_cache_path(pdf_hash)):
+        with open(_text_cache_path(pdf_hash), encoding="utf-8") as f:
+            return join_pages(json.load(f)["pages"])[0]
+    return fetch_and_parse_pdf(doc["url"])
+
+def build_faq_answers(manifest, path=FAQ_ANSWERS_PATH):
+    # One stored answer per FAQ section, its question embedded on its own.
+    # A document that cannot be read keeps its entries from the last run.
+    previous = load_faq_file(path) or {}
+    old_entries = {entry["id"]: entry for entry in previous.get("entries", [])}
+    # Stored question embeddings stay valid while the model and size are the same
+    reusable = (previous.get("deployment") == AZURE_OPENAI_EMBEDDING_DEPLOYMENT
+                and previous.get("dimensions") == EMBEDDING_DIMENSIONS)
+    entries = []
+    failures = []
+    for doc in documents:
+        if doc["name"] not in FAQ_DOCUMENTS:
+            continue
+        try:
+            text = document_text(doc, (manifest or {}).get("documents", {}).get(doc["name"]))
+            doc_entries = faq_entries(doc, parse_faq_sections(text), old_entries)
+        except Exception as e:
+            failures.append((doc["name"], f"FAQ answers not rebuilt: {e}"))
+            if reusable:
+                entries.extend(entry for entry in old_entries.values() if entry["document_name"] == doc["name"])
+            continue
+        for entry in doc_entries:
+            if reusable and entry["id"] in old_entries:
+                entry["embedding"] = old_entries[entry["id"]]["embedding"]
+        entries.extend(doc_entries)
+    missing = [entry for entry in entries if "embedding" not in entry]
+    for start in range(0, len(missing), EMBEDDING_BATCH_MAX_INPUTS):
+        batch = missing[start:start + EMBEDDING_BATCH_MAX_INPUTS]
+        embeddings = embed_texts(embedding_client, [entry["question"] for entry in batch],
+                                 AZURE_OPENAI_EMBEDDING_DEPLOYMENT, EMBEDDING_DIMENSIONS, priority=BULK)
+        for entry, embedding in zip(batch, embeddings):
+            entry["embedding"] = embedding
+    save_faq_file(entries, AZURE_OPENAI_EMBEDDING_DEPLOYMENT, EMBEDDING_DIMENSIONS, path)
+    return len(entries), failures
+
+# --- Staged pipeline ---
+_DONE = object()
+
+def start_stage(name, func, in_queue, out_queue, workers, finish=None, on_error=None):
+    # Run `workers` threads that feed each item of in_queue through func and put
+    # whatever it yields on out_queue. A single _DONE sentinel shuts the stage
+    # down: each worker re-posts it for its siblings, and the last one to exit
+    # runs `finish` (for leftovers) and passes _DONE downstream. An exception
+    # from func (or finish, with item None) goes to on_error(item, error) and
+    # the stage carries on, so shutdown always reaches the last stage.
+    remaining = [workers]
+    lock = threading.Lock()
+
+    def failed(item, error):
+        if on_error is not None:
+            on_error(item, error)
+        else:
+            print(f"WARNING - {name} stage failed:", error)
+
+    def loop():
+        try:
+            while True:
+                item = in_queue.get()
+                if item is _DONE:
+                    in_queue.put(_DONE)
+                    break
+                try:
+                    for result in func(item):
+                        if out_queue is not None:
+                            out_queue.put(result)
+                except Exception as e:
+                    failed(item, e)
+        finally:
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                try:
+                    if finish is not None:
+                        for result in finish():
+                            if out_queue is not None:
+                                out_queue.put(result)
+                except Exception as e:
+                    failed(None, e)
+                finally:
+                    if out_queue is not None:
+                        out_queue.put(_DONE)
+
+    threads = [threading.Thread(target=loop, name=f"{name}-{i}", daemon=True) for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+def run_pipeline(documents,
+                 manifest=None,
+                 fetch_workers=FETCH_WORKERS,
+                 parse_workers=PARSE_WORKERS,
+                 embed_workers=EMBED_WORKERS,
+                 upload_workers=UPLOAD_WORKERS,
+                 queue_size=PIPELINE_QUEUE_SIZE,
+                 upload_batch_size=UPLOAD_BATCH_SIZE,
+                 incremental=True,
+                 upload_func=None):
+    # fetch (threads, streamed to temp files) -> extract pages/chunk/tokenize
+    # (processes) -> embed (threads) -> upload (threads)
+    # With incremental=True, unchanged files (ETag/Last-Modified/content hash) and
+    # already-indexed chunks are skipped. Chunks that disappeared are deleted after
+    # all uploads finish. Returns (stats, failures, new manifest); failures never
+    # abort the run. upload_func(batch) -> failures replaces the Azure upload
+    # (e.g. to collect records for a local index).
+    upload_func = upload_func or upload_batch
+    old_docs = (manifest or {}).get("documents", {})
+    new_docs = {}
+    failures = []
+    stats = {"documents_unchanged": 0, "chunks_total": 0, "chunks_uploaded": 0, "chunks_deleted": 0}
+    fetch_q = queue.Queue(maxsize=queue_size)
+    parse_q = queue.Queue(maxsize=queue_size)
+    embed_q = queue.Queue(maxsize=queue_size)
+    upload_q = queue.Queue(maxsize=queue_size)
+    progress = tqdm(total=len(documents), desc="Documents parsed")
+    pending = []
+    lock = threading.Lock()
+
+    def fetch(doc):
+        print(f"Fetching: {doc['url']}")
+        entry = old_docs.get(doc["name"])
+        try:
+            fetched = fetch_pdf_if_changed(doc["url"], entry if incremental else None)
+        except Exception as e:
+            failures.append((doc["name"], f"fetch failed: {e}"))
+            progress.update(1)
+            return
+        pdf_hash = fetched[3] if fetched else None
+        if incremental and entry and (fetched is None or pdf_hash == entry.get("content_hash")):
+            if fetched:
+                os.remove(fetched[0])
+            with lock:
+                new_docs[doc["name"]] = dict(entry, **({"etag": fetched[1], "last_modified": fetched[2]} if fetched else {}))
+                stats["documents_unchanged"] += 1
+                stats["chunks_total"] += len(entry["chunks"])
+            progress.update(1)
+            return
+        pdf_path, etag, last_modified, _ = fetched
+        yield doc, pdf_path, {"url": doc["url"], "etag": etag, "last_modified": last_modified, "content_hash": pdf_hash}
+
+    def parse(item):
+        doc, pdf_path, entry = item
+        known = frozenset(old_docs.get(doc["name"], {}).get("chunks", ())) if incremental else frozenset()
+        try:
+            # Page ranges and chunking both run in the process pool
+            try:
+                content, page_offsets = extract_pdf_text(pdf_path, entry["content_hash"], pool)
+            finally:
+                os.remove(pdf_path)
+            chunk_ids, batches = pool.submit(chunk_document, doc, content, page_offsets, known).result()
+        except Exception as e:
+            failures.append((doc["name"], f"parse failed: {e}"))
+            progress.update(1)
+            return
+        progress.update(1)
+        with lock:
+            new_docs[doc["name"]] = dict(entry, chunks=chunk_ids)
+            stats["chunks_total"] += len(chunk_ids)
+            stats["chunks_uploaded"] += sum(len(batch) for batch in batches)
+        yield from batches
+
+    def embed(batch):
+        try:
+            yield embed_batch(batch)
+        except Exception as e:
+            failures.extend((record["id"], f"embedding failed: {e}") for record in batch)
+
+    def upload(batch):
+        # Re-pack embedded batches into large upload batches
+        nonlocal pending
+        with lock:
+            pending.extend(batch)
+            ready = []
+            while len(pending) >= upload_batch_size:
+                ready.append(pending[:upload_batch_size])
+                pending = pending[upload_batch_size:]
+        for full in ready:
+            upload_records(full)
+        return ()
+
+    def flush_uploads():
+        if pending:
+            upload_records(pending)
+        return ()
+
+    def upload_records(records):
+        try:
+            failures.extend(upload_func(records))
+        except Exception as e:
+            failures.extend((record["id"], f"upload failed: {e}") for record in records)
+
+    def stage_failed(stage):
+        # Records an unexpected stage error against the chunks of a batch, or
+        # the document of a fetch/parse item, so the manifest keeps its old entry
+        def on_error(item, error):
+            if item is None:
+                ids = [stage]
+            elif isinstance(item, list):
+                ids = [record["id"] for record in item]
+            else:
+                ids = [(item[0] if isinstance(item, tuple) else item)["name"]]
+            failures.extend((doc_id, f"{stage} failed: {error}") for doc_id in ids)
+        return on_error
+
+    with ProcessPoolExecutor(max_workers=parse_workers) as pool:
+        start_stage("fetch", fetch, fetch_q, parse_q, fetch_workers, on_error=stage_failed("fetch"))
+        start_stage("parse", parse, parse_q, embed_q, parse_workers, on_error=stage_failed("parse"))
+        start_stage("embed", embed, embed_q, upload_q, embed_workers, on_error=stage_failed("embed"))
+        upload_threads = start_stage("upload", upload, upload_q, None, upload_workers,
+                                     finish=flush_uploads, on_error=stage_failed("upload"))
+        for doc in documents:
+            fetch_q.put(doc)
+        fetch_q.put(_DONE)
+        for thread in upload_threads:
+            thread.join()
+    progress.close()
+
+    # Delete chunks that are no longer produced, including whole documents that
+    # were dropped from the list. Documents that failed to fetch/parse keep theirs.
+    failed_ids = {doc_id for doc_id, _ in failures}
+    stale = {}
+    for name, entry in old_docs.items():
+        if name not in new_docs and name in failed_ids:
+            new_docs[name] = entry
+            continue
+        gone = set(entry["chunks"]) - set(new_docs.get(name, {}).get("chunks", ()))
+        if gone:
+            stale[name] = gone
+    delete_failures = delete_ids(set().union(*stale.values())) if stale else []
+    failures.extend(delete_failures)
+    undeleted = {doc_id for doc_id, _ in delete_failures}
+    stats["chunks_deleted"] = sum(len(ids) for ids in stale.values()) - len(undeleted)
+
+    # Only record what actually made it into the index. A document with failed
+    # chunks forgets its hashes so the next run re-processes it, and failed
+    # deletes stay listed so they are retried.
+    for name in set(new_docs) | set(stale):
+        entry = new_docs.get(name, {"chunks": []})
+        chunks = [doc_id for doc_id in entry["chunks"] if doc_id not in failed_ids]
+        leftovers = sorted(stale.get(name, set()) & undeleted)
+        if len(chunks) < len(entry["chunks"]) or leftovers:
+            entry = dict(entry, etag=None, last_modified=None, content_hash=None)
+        new_docs[name] = dict(entry, chunks=chunks + leftovers)
+        if not new_docs[name]["chunks"] and name not in {doc["name"] for doc in documents}:
+            del new_docs[name]
+    return stats, failures, {"embedding_dimensions": INDEX_VECTOR_DIMENSIONS, "chunking": chunking_settings(),
+                             "documents": new_docs}
+
+# --- Blue/green rebuild ---
+def smoke_test(client, expected_count, sample, timeout=REBUILD_SMOKE_TIMEOUT_SECONDS):
+    # Waits until the new index holds every uploaded chunk and a vector query
+    # for one of them finds it. Returns None on success, else the problem.
+    deadline = time.monotonic() + timeout
+    problem = None
+    while True:
+        try:
+            count = client.get_document_count()
+            if count < expected_count:
+                problem = f"{count} of {expected_count} documents searchable"
+            elif sample is not None:
+                ids = [result["id"] for result in client.search(
+                    search_text=None,
+                    vector_queries=[VectorizedQuery(vector=sample["embedding"], k_nearest_neighbors=5, fields="embedding")],
+                    select=["id"],
+                    top=5
+                )]
+                problem = None if sample["id"] in ids else f"vector query for {sample['id']} returned {ids}"
+            else:
+                problem = None
+        except Exception as e:
+            problem = f"smoke query failed: {e}"
+        if problem is None or time.monotonic() >= deadline:
+            return problem
+        time.sleep(2)
+
+def discard_version(index_name):
+    # A failed build is not live, so nothing else deletes it; free its quota now
+    try:
+        create_index.delete_version(index_name)
+        print(f"Deleted the failed index version '{index_name}'")
+    except Exception as e:
+        print(f"WARNING - could not delete '{index_name}' (retry with create_index.py --delete {index_name}):", e)
+
+def rebuild_index(documents):
+    # Full re-ingest into a new index version while the alias keeps serving
+    # the old one; the alias only moves once the new index passes a smoke
+    # test, and a build that fails is deleted. Returns (stats, failures,
+    # manifest), manifest None when the alias was not switched.
+    index_name = create_index.create_next_version()
+    print(f"Building index '{index_name}' (live: {create_index.live_index()})")
+    client = SearchClient(
+        endpoint=AZURE_SEARCH_ENDPOINT,
+        index_name=index_name,
+        credential=AzureKeyCredential(AZURE_SEARCH_API_KEY)
+    )
+    samples = []
+
+    def upload_new(batch):
+        if not samples:
+            samples.append(batch[0])
+        return upload_batch(batch, client)
+
+    stats, failures, manifest = run_pipeline(documents, None, incremental=False,
+                                             upload_workers=REBUILD_UPLOAD_WORKERS, upload_func=upload_new)
+    problem = "the rebuild had failures" if failures else \
+        smoke_test(client, stats["chunks_uploaded"], samples[0] if samples else None)
+    if problem:
+        print(f"⚠️ Not switching to '{index_name}': {problem}")
+        discard_version(index_name)
+        return stats, failures or [(index_name, problem)], None
+    create_index.switch_alias(index_name)
+    print(f"✅ '{SEARCH_INDEX_NAME}' now serves '{index_name}'")
+    for name in create_index.delete_old_versions():
+        print(f"Deleted old index version '{name}'")
+    return stats, failures, manifest
+
+# Main embed loop
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Embed HR documents into Azure AI Search.")
+    parser.add_argument("--full", action="store_true",
+                        help="re-fetch and re-embed every document instead of only new or changed chunks")
+    parser.add_argument("--target", choices=["azure", "local"], default="azure",
+                        help="upload to Azure AI Search, or write a local vector index to LOCAL_INDEX_PATH")
+    parser.add_argument("--rebuild", action="store_true",
+                        help="re-ingest everything into a new index version and switch the alias to it when done")
+    args = parser.parse_args()
+    print("RUNNING:", __file__)
+    if args.target == "azure" and args.rebuild:
+        stats, failures, manifest = rebuild_index(documents)
+        if manifest is None:
+            # The old index is still live, and so are its manifest and FAQ answers
+            manifest = load_manifest() or {"documents": {}}
+        else:
+            save_manifest(manifest)
+    elif args.target == "local":
+        # Always a full rebuild; the embedding cache keeps unchanged chunks free
+        local_records = []
+        records_lock = threading.Lock()
+
+        def collect(batch):
+            with records_lock:
+                local_records.extend(batch)
+            return []
+
+        stats, failures, manifest = run_pipeline(documents, None, incremental=False, upload_func=collect)
+        LocalVectorIndex.from_records(local_records).save(LOCAL_INDEX_PATH)
+        print(f"Local index written to {LOCAL_INDEX_PATH}")
+    else:
+        # An index cannot change its vector size in place: that takes a new index version
+        indexed_dimensions = create_index.vector_dimensions()
+        if indexed_dimensions is None:
+            sys.exit(f"No search index '{SEARCH_INDEX_NAME}'; build one with: python embed_to_ai_search.py --rebuild")
+        if indexed_dimensions != INDEX_VECTOR_DIMENSIONS:
+            sys.exit(f"The search index holds {indexed_dimensions}-dimension vectors but EMBEDDING_DIMENSIONS "
+                     f"gives {INDEX_VECTOR_DIMENSIONS}; re-ingest into a new index with: "
+                     f"python embed_to_ai_search.py --rebuild")
+        manifest = load_manifest()
+        if manifest is None:
+            print(f"No manifest at {INDEX_MANIFEST_PATH}; reading current index contents.")
+            manifest = manifest_from_index()
+        # The manifest lags behind an index rebuilt outside this script: re-embed everything
+        resized = manifest.get("embedding_dimensions", NATIVE_EMBEDDING_DIMENSIONS) != INDEX_VECTOR_DIMENSIONS
+        if resized and not args.full:
+            print("Manifest was written for other embedding dimensions; re-embedding all documents.")
+        # Unchanged PDFs would keep chunks cut under the old settings: re-chunk everything
+        # (unchanged chunk text still comes from the embedding cache)
+        rechunked = manifest.get("chunking") != chunking_settings()
+        if rechunked and not args.full:
+            print("Manifest was written for other chunking settings; re-chunking all documents.")
+        # The index rejects documents with fields it does not have: add new ones first
+        added = create_index.add_missing_fields()
+        if added:
+            print(f"Added fields {added} to the search index.")
+        # Chunks uploaded before page numbers existed have none: re-upload them all
+        repaged = bool({"page_start", "page_end"} & set(added))
+        if repaged and not args.full:
+            print("Re-processing all documents to fill in page numbers.")
+        stats, failures, manifest = run_pipeline(documents, manifest, incremental=not (args.full or resized or repaged or rechunked))
+        # Unchanged chunks are not re-uploaded, so the field added above is still empty on them
+        backfilled, backfill_failures = backfill_employee_groups()
+        failures.extend(backfill_failures)
+        if backfilled:
+            print(f"Set employee_group on {backfilled} chunks indexed before it existed.")
+        save_manifest(manifest)
+    faq_count, faq_failures = build_faq_answers(manifest)
+    failures.extend(faq_failures)
+    print(f"FAQ answers written to {FAQ_ANSWERS_PATH} ({faq_count} questions)")
+    if failures:
+        print(f"⚠️ {len(failures)} failures:")
+        for doc_id, error in failures:
+            print(f"  - {doc_id}: {error}")
+    print(f"✅ {stats['chunks_total']} chunks indexed "
+          f"({stats['chunks_uploaded']} embedded and uploaded, {stats['chunks_deleted']} deleted, "
+          f"{stats['documents_unchanged']} documents unchanged).")
+    cache = get_embedding_cache()
+    if cache is not None:
+        cache.flush()
+        print("Embedding cache:", cache.stats())
@@ -0,0 +1,342 @@
+import os
+import json
+import time
+import atexit
+import hashlib
+import re
+import threading
+import contextlib
+import numpy as np
+import tracing
+from context_builder import count_tokens
+from rate_limiter import INTERACTIVE, embedding_scheduler
+
+# Persistent embedding cache shared by ingestion (embed_to_ai_search.py) and
+# the query path (chat_with_index.py). Entries are keyed by
+# (deployment, dimensions, normalized text hash). Each (deployment, dimensions)
+# pair gets its own directory holding a float32 memory-mapped vector matrix
+# plus a small key/clock index, so lookups never load the whole cache into RAM.
+# The files start small and double as the cache fills, up to
+# EMBEDDING_CACHE_MAX_ENTRIES rows; only then are entries evicted.
+# Every process using the cache (Streamlit, API workers, ingestion) shares
+# the directory: the key/clock index is memory-mapped as well, writers hold an
+# exclusive lock on the directory and readers a shared one (see _Store).
+# Lookups read the vector's row of the memory map in place, but hand out a
+# list of floats rather than a view of it: another process may evict and
+# overwrite the slot as soon as the lock is released, and every caller needs
+# a list (API payloads, index records) anyway.
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking; give each process its own EMBEDDING_CACHE_DIR
+    fcntl = None
+
+# Cache config
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", ".embedding_cache")
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "20000"))  # vectors per deployment/dimensions
+EMBEDDING_CACHE_INITIAL_ENTRIES = 1024  # rows allocated when a store is created
+EMBEDDING_CACHE_FLUSH_EVERY = int(os.getenv("EMBEDDING_CACHE_FLUSH_EVERY", "64"))  # writes between index flushes
+EVICT_FRACTION = 0.1  # share of the least recently used entries dropped when a store is full
+
+KEY_BYTES = 16
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+def cache_key(text, deployment, dimensions=None):
+    raw = f"{deployment}\0{dimensions or ''}\0{normalize_text(text)}".encode("utf-8")
+    return hashlib.sha256(raw).digest()[:KEY_BYTES]
+
+class _Store:
+    # One fixed-dimension vector matrix. Slot i is live when clock[i] > 0;
+    # clock holds the last-used time (ns) for LRU eviction. vectors, keys and
+    # clock are all raw memory-mapped files, so a write is visible to the other
+    # processes at once. Writes (and slot allocation, growth) happen under an
+    # exclusive flock of the directory's lock file, reads under a shared one.
+    # The row count is the clock file's size: every locked operation first
+    # re-maps when another process grew or recreated the files. Files are only
+    # ever extended in place (never truncated), so a process with a smaller
+    # capacity keeps using the larger store. self.slots is only this process's
+    # key -> slot index: every read checks the slot against the shared keys,
+    # and a miss searches them.
+    def __init__(self, directory, dim, capacity):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.vectors_path = os.path.join(directory, "vectors.f32")
+        self.keys_path = os.path.join(directory, "keys.u8")
+        self.clock_path = os.path.join(directory, "clock.u64")
+        self.lock_file = open(os.path.join(directory, "lock"), "a+b")
+        self.dim = dim
+        self.capacity = capacity
+        self.mapped = None  # (inode, size) of the clock file the maps were made from
+        self.dirty = 0
+
+        with self._locked(exclusive=True):
+            existing = None
+            if os.path.exists(self.meta_path):
+                with open(self.meta_path, encoding="utf-8") as f:
+                    existing = json.load(f)
+            paths = (self.vectors_path, self.keys_path, self.clock_path)
+            if existing != {"dim": dim} or not all(os.path.exists(path) for path in paths):
+                self._create()
+            self._sync()
+
+    def _row_bytes(self):
+        return ((self.vectors_path, self.dim * 4), (self.keys_path, KEY_BYTES), (self.clock_path, 8))
+
+    def _create(self):
+        # Shape changed (or first use): start over rather than misread old
+        # vectors. New files replace the old ones, so maps other processes
+        # hold stay valid until their next _sync(). Caller holds the exclusive lock.
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+        for legacy in ("keys.npy", "clock.npy"):  # fixed-capacity layout
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(self.directory, legacy))
+        rows = min(EMBEDDING_CACHE_INITIAL_ENTRIES, self.capacity)
+        for path, row_bytes in self._row_bytes():
+            with open(f"{path}.tmp", "wb") as f:
+                f.truncate(rows * row_bytes)
+            os.replace(f"{path}.tmp", path)
+        with open(self.meta_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim}, f)
+
+    def _sync(self):
+        # Map the files again if another process grew or recreated them since
+        # the last locked operation. Caller holds the lock.
+        stat = os.stat(self.clock_path)
+        if self.mapped == (stat.st_ino, stat.st_size):
+            return
+        if self.mapped is not None and self.mapped[0] != stat.st_ino:
+            with open(self.meta_path, encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]  # recreated, possibly for another vector size
+        rows = stat.st_size // 8
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(rows, self.dim))
+        self.keys = np.memmap(self.keys_path, dtype=np.uint8, mode="r+", shape=(rows, KEY_BYTES))
+        self.clock = np.memmap(self.clock_path, dtype=np.uint64, mode="r+", shape=(rows,))
+        self.key_words = self.keys.view(np.uint64)  # (rows, 2): keys compared as two words
+        self.slots = {self.keys[i].tobytes(): int(i) for i in np.flatnonzero(self.clock)}
+        self.free = []
+        self.mapped = (stat.st_ino, stat.st_size)
+
+    def _grow(self):
+        # Double the rows, up to capacity; False when already there. Caller
+        # holds the exclusive lock. Extending a mapped file leaves existing
+        # maps valid, so readers in other processes are unaffected.
+        rows = len(self.clock)
+        new_rows = min(rows * 2, self.capacity)
+        if new_rows <= rows:
+            return False
+        self.flush()
+        for path, row_bytes in self._row_bytes():
+            with open(path, "r+b") as f:
+                f.truncate(new_rows * row_bytes)
+        self._sync()
+        return True
+
+    @contextlib.contextmanager
+    def _locked(self, exclusive):
+        if fcntl is None:
+            yield
+            return
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def _holds(self, slot, key):
+        return self.clock[slot] > 0 and self.keys[slot].tobytes() == key
+
+    def _find(self, key):
+        # Slot holding key in the shared index (e.g. written by another process), or None
+        words = np.frombuffer(key, dtype=np.uint64)
+        matches = np.flatnonzero((self.key_words[:, 0] == words[0]) & (self.key_words[:, 1] == words[1]))
+        for slot in matches.tolist():
+            if self.clock[slot] > 0:
+                return slot
+        return None
+
+    def _lookup(self, key):
+        slot = self.slots.get(key)
+        if slot is not None and self._holds(slot, key):
+            return slot
+        slot = self._find(key)
+        if slot is None:
+            self.slots.pop(key, None)
+        else:
+            self.slots[key] = slot
+        return slot
+
+    def _free_slot(self):
+        # A slot free in the shared clock; other processes may have taken the
+        # ones this process last saw free
+        while True:
+            if not self.free:
+                self.free = np.flatnonzero(self.clock == 0)[::-1].tolist()
+                if not self.free:
+                    return None
+            slot = self.free.pop()
+            if self.clock[slot] == 0:
+                return slot
+
+    def get(self, key):
+        # Returns the vector as a list of floats, or None
+        with self._locked(exclusive=False):
+            self._sync()
+            slot = self._lookup(key)
+            if slot is None:
+                return None
+            self.clock[slot] = time.time_ns()
+            return self.vectors[slot].tolist()
+
+    def put(self, key, vector):
+        # Returns the number of entries evicted to make room
+        with self._locked(exclusive=True):
+            self._sync()
+            if len(vector) != self.dim or self._lookup(key) is not None:
+                return 0
+            evicted = 0
+            slot = self._free_slot()
+            if slot is None and self._grow():
+                slot = self._free_slot()
+            if slot is None:
+                evicted = self.evict()
+                slot = self._free_slot()
+            self.vectors[slot] = vector
+            self.keys[slot] = np.frombuffer(key, dtype=np.uint8)
+            self.clock[slot] = time.time_ns()
+            self.slots[key] = slot
+            self.dirty += 1
+            if self.dirty >= EMBEDDING_CACHE_FLUSH_EVERY:
+                self.flush()
+            return evicted
+
+    def evict(self):
+        # Caller holds the exclusive lock
+        count = max(1, int(len(self.clock) * EVICT_FRACTION))
+        oldest = np.argpartition(self.clock, count - 1)[:count]
+        for slot in oldest.tolist():
+            self.slots.pop(self.keys[slot].tobytes(), None)
+            self.clock[slot] = 0
+        self.free = []
+        return count
+
+    def flush(self):
+        # Other processes already see the writes; this persists them to disk
+        self.vectors.flush()
+        self.keys.flush()
+        self.clock.flush()
+        self.dirty = 0
+
+class EmbeddingCache:
+    def __init__(self, directory=EMBEDDING_CACHE_DIR, max_entries=EMBEDDING_CACHE_MAX_ENTRIES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.stores = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _store(self, deployment, dimensions, dim=None):
+        namespace = (deployment, dimensions)
+        store = self.stores.get(namespace)
+        if store is not None:
+            return store
+        directory = os.path.join(self.directory, re.sub(r'[^A-Za-z0-9_\-]', '_', f"{deployment}-{dimensions or 'native'}"))
+        meta_path = os.path.join(directory, "meta.json")
+        if dim is None:
+            # Lookups only open stores that already exist on disk
+            if not os.path.exists(meta_path):
+                return None
+            with open(meta_path, encoding="utf-8") as f:
+                dim = json.load(f)["dim"]
+        store = _Store(directory, dim, self.max_entries)
+        self.stores[namespace] = store
+        return store
+
+    def get(self, text, deployment, dimensions=None):
+        # Returns the cached vector as a list of floats, or None on a miss
+        with self.lock:
+            store = self._store(deployment, dimensions)
+            vector = store.get(cache_key(text, deployment, dimensions)) if store else None
+            if vector is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return vector
+
+    def put(self, text, deployment, vector, dimensions=None):
+        with self.lock:
+            store = self._store(deployment, dimensions, dim=len(vector))
+            self.evictions += store.put(cache_key(text, deployment, dimensions), vector)
+
+    def flush(self):
+        with self.lock:
+            for store in self.stores.values():
+                if store.dirty:
+                    store.flush()
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": sum(int(np.count_nonzero(store.clock)) for store in self.stores.values()),
+            }
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_embedding_cache():
+    # Process-wide cache, or None when disabled via EMBEDDING_CACHE_ENABLED
+    global _cache
+    if not EMBEDDING_CACHE_ENABLED:
+        return None
+    with _cache_lock:
+        if _cache is None:
+            _cache = EmbeddingCache()
+            atexit.register(_cache.flush)
+        return _cache
+
+def embed_texts(client, texts, model, dimensions=None, priority=INTERACTIVE):
+    # Embed texts through the cache: hits are served from disk and all misses
+    # go to the embeddings API in a single request, through the deployment's
+    # request scheduler. Returns lists of floats.
+    cache = get_embedding_cache()
+    vectors = [None] * len(texts)
+    if cache is not None:
+        for i, text in enumerate(texts):
+            vectors[i] = cache.get(text, model, dimensions)
+    missing = {}
+    for i, vector in enumerate(vectors):
+        if vector is None:
+            missing.setdefault(texts[i], []).append(i)
+    if missing:
+        unique_texts = list(missing)
+        kwargs = {"dimensions": dimensions} if dimensions else {}
+        response = embedding_scheduler(model).run(
+            lambda: client.embeddings.create(
+                input=unique_texts,
+                model=model,
+                **kwargs
+            ),
+            tokens=sum(count_tokens(text) for text in unique_texts),
+            priority=priority,
+            tokens_used=lambda response: response.usage.prompt_tokens if getattr(response, "usage", None) else None
+        )
+        if getattr(response, "usage", None):
+            tracing.annotate(embedding_tokens=response.usage.prompt_tokens)
+        # Results carry an index; don't rely on response order
+        for item in response.data:
+            text = unique_texts[item.index]
+            for i in missing[text]:
+                vectors[i] = item.embedding
+            if cache is not None:
+                cache.put(text, model, item.embedding, dimensions)
+    tracing.annotate(embedding_cache_hits=len(texts) - sum(len(ids) for ids in missing.values()))
+    return vectors
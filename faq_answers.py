@@ -0,0 +1,138 @@
+import os
+import re
+import json
+import hashlib
+import threading
+import numpy as np
+
+# Stored answers for the FAQ documents. Ingestion (embed_to_ai_search.py)
+# writes one entry per FAQ section: the question, the section text as its
+# answer, the citation fields, and an embedding of the question on its own.
+# When a query embedding is within FAQ_MATCH_THRESHOLD cosine similarity of a
+# stored question, and beats the runner-up by FAQ_MATCH_MARGIN, the question
+# path answers with the stored text and skips the chat completion. A hit
+# bypasses retrieval and the LLM, so both cutoffs err towards a miss. An entry
+# edited by hand and marked "reviewed": true keeps its answer across
+# ingestion runs while the FAQ section is unchanged.
+
+# FAQ config
+FAQ_FAST_PATH_ENABLED = os.getenv("FAQ_FAST_PATH_ENABLED", "true").lower() in ("1", "true", "yes")
+FAQ_ANSWERS_PATH = os.getenv("FAQ_ANSWERS_PATH", "faq_answers.json")
+FAQ_MATCH_THRESHOLD = float(os.getenv("FAQ_MATCH_THRESHOLD", "0.95"))  # min cosine similarity; tune per embedding model
+FAQ_MATCH_MARGIN = float(os.getenv("FAQ_MATCH_MARGIN", "0.02"))  # min lead over the second-best question
+FAQ_DOCUMENTS = (
+    "Common Themes of Questions that Employees Ask",
+    "PHC New Employee Onboarding FAQ 2025",
+)
+
+QUESTION_PREFIX = re.compile(r"^(?:Q[:.]|[\u2022\-])\s*")  # as split by parse_faq_sections
+
+def _hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+def faq_entries(doc, sections, previous=None):
+    # Entries for the parse_faq_sections() output of one document. `previous`
+    # maps entry id -> entry from the last run, for reviewed answers.
+    entries = []
+    for section in sections:
+        question = QUESTION_PREFIX.sub("", section["title"] or "").strip()
+        answer = (section["content"] or "").strip()
+        if not question or not answer:
+            continue
+        entry_id = _hash(f"{doc['name']}\n{question}")
+        source_hash = _hash(answer)
+        old = (previous or {}).get(entry_id)
+        reviewed = bool(old and old.get("reviewed") and old.get("source_hash") == source_hash)
+        entries.append({
+            "id": entry_id,
+            "question": question,
+            "answer": old["answer"] if reviewed else answer,
+            "reviewed": reviewed,
+            "source_hash": source_hash,
+            "document_name": doc["name"],
+            "document_url": doc["url"],
+            "section_number": section["number"] or "",
+            "section_title": section["title"] or "",
+        })
+    return entries
+
+def load_faq_file(path=FAQ_ANSWERS_PATH):
+    # {"deployment", "dimensions", "entries": [{..., "embedding": [...]}]}, or None
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def save_faq_file(entries, deployment, dimensions, path=FAQ_ANSWERS_PATH):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"deployment": deployment, "dimensions": dimensions, "entries": entries}, f, indent=1)
+    os.replace(tmp_path, path)
+
+class FaqAnswers:
+    # Question matcher over the stored entries; picks up a rewritten file on
+    # the next lookup. Entries embedded with another deployment are ignored.
+    def __init__(self, deployment, path=FAQ_ANSWERS_PATH, threshold=FAQ_MATCH_THRESHOLD,
+                 margin=FAQ_MATCH_MARGIN):
+        self.deployment = deployment
+        self.path = path
+        self.threshold = threshold
+        self.margin = margin
+        self.loaded_mtime = None
+        self.loaded = ([], None)  # (entries, unit question embeddings, one row per entry)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _refresh(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            mtime = None
+        if mtime == self.loaded_mtime:
+            return
+        with self.lock:
+            if mtime == self.loaded_mtime:
+                return
+            entries, matrix = [], None
+            try:
+                data = load_faq_file(self.path) if mtime is not None else None
+            except (OSError, ValueError) as e:
+                print("WARNING - unreadable FAQ answers file:", self.path, e)
+                data = None
+            if data and data.get("deployment") != self.deployment:
+                print(f"WARNING - {self.path} was embedded with {data.get('deployment')}, not {self.deployment}; ignored")
+            elif data and data.get("entries"):
+                matrix = np.asarray([entry["embedding"] for entry in data["entries"]], dtype=np.float32)
+                norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+                matrix /= np.where(norms == 0, 1, norms)
+                entries = [{key: value for key, value in entry.items() if key != "embedding"}
+                           for entry in data["entries"]]
+            self.loaded = (entries, matrix)
+            self.loaded_mtime = mtime
+
+    def has_entries(self):
+        # False while there is nothing to match (no file yet, or no FAQ sections)
+        self._refresh()
+        return self.loaded[1] is not None
+
+    def match(self, embedding):
+        # Returns (entry, closest, similarity, runner-up similarity): closest
+        # is the nearest stored entry, entry the same one when it is above the
+        # threshold and clear of the runner-up, else None
+        self._refresh()
+        entries, matrix = self.loaded
+        if matrix is None or len(embedding) != matrix.shape[1]:
+            return None, None, 0.0, 0.0
+        query = np.asarray(embedding, dtype=np.float32)
+        scores = matrix @ (query / (np.linalg.norm(query) or 1))
+        best = int(np.argmax(scores))
+        score = float(scores[best])
+        runner_up = float(np.partition(scores, -2)[-2]) if len(scores) > 1 else -1.0
+        hit = score >= self.threshold and score - runner_up >= self.margin
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return (entries[best] if hit else None), entries[best], score, runner_up
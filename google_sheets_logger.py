@@ -1,6 +1,26 @@
+import os
+import re
+import json
+import time
+import uuid
+import queue
+import atexit
+import threading
+from collections import OrderedDict
 import gspread
 from google.oauth2.service_account import Credentials
 
+# Logger config
+SHEETS_LOG_BATCH_SIZE = int(os.getenv("SHEETS_LOG_BATCH_SIZE", "50"))  # rows per append_rows call
+SHEETS_LOG_FLUSH_SECONDS = float(os.getenv("SHEETS_LOG_FLUSH_SECONDS", "2"))  # max wait before a partial batch is written
+SHEETS_LOG_QUEUE_SIZE = int(os.getenv("SHEETS_LOG_QUEUE_SIZE", "1000"))
+SHEETS_LOG_MAX_RETRIES = int(os.getenv("SHEETS_LOG_MAX_RETRIES", "5"))
+SHEETS_LOG_SPILL_PATH = os.getenv("SHEETS_LOG_SPILL_PATH", "sheets_log_spill.jsonl")  # used while Sheets is unavailable
+
+FEEDBACK_COLUMN = 4  # D: user_email, question, answer, feedback[, timestamp]
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+MAX_TRACKED_ROWS = 10000
+
 # --- Setup Google Sheets Access ---
 def connect_to_sheets(sheet_name):
     scopes = [
@@ -16,6 +36,182 @@ def connect_to_sheets(sheet_name):
     spreadsheet = client.open(sheet_name)
     return spreadsheet.sheet1  # Open first sheet
 
+# --- Background, batched logging ---
+def _column_letter(column):
+    letters = ""
+    while column:
+        column, remainder = divmod(column - 1, 26)
+        letters = chr(ord("A") + remainder) + letters
+    return letters
+
+def _first_row(response):
+    # append_rows responds with e.g. {"updates": {"updatedRange": "Sheet1!A12:E14"}}
+    updated_range = ((response or {}).get("updates") or {}).get("updatedRange", "")
+    match = re.search(r"![A-Z]+(\d+)", updated_range)
+    return int(match.group(1)) if match else None
+
+class SheetsLogger:
+    # Rows are queued by the request path and written by one background thread
+    # in append_rows batches (size/time trigger). Quota and server errors are
+    # retried with exponential backoff; if Sheets stays unavailable the batch is
+    # spilled to a local JSONL file and replayed after the next successful write.
+    # Cell updates (feedback) rewrite the row that was already logged.
+    def __init__(self, sheet, batch_size=SHEETS_LOG_BATCH_SIZE, flush_seconds=SHEETS_LOG_FLUSH_SECONDS,
+                 queue_size=SHEETS_LOG_QUEUE_SIZE, max_retries=SHEETS_LOG_MAX_RETRIES,
+                 spill_path=SHEETS_LOG_SPILL_PATH):
+        self.sheet = sheet
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_retries = max_retries
+        self.spill_path = spill_path
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.rows = OrderedDict()  # log id -> sheet row number
+        self.spilled_ids = set()
+        self.spill_lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="sheets-logger", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def append(self, row):
+        # Queue a row; returns an id that update_cell() can refer to later
+        log_id = uuid.uuid4().hex
+        self._enqueue({"op": "append", "id": log_id, "row": list(row)})
+        return log_id
+
+    def update_cell(self, log_id, column, value):
+        self._enqueue({"op": "update", "id": log_id, "column": column, "value": value})
+
+    def _enqueue(self, op):
+        try:
+            self.queue.put_nowait(op)
+        except queue.Full:
+            # Never block the request path; keep the row locally instead
+            self._spill([op])
+
+    def close(self, timeout=10):
+        self.stopping.set()
+        self.thread.join(timeout)
+
+    def _run(self):
+        while not (self.stopping.is_set() and self.queue.empty()):
+            ops = self._next_batch()
+            if ops:
+                try:
+                    self._flush(ops)
+                except Exception as e:
+                    print("WARNING - Sheets logging failed:", e)
+                    self._spill(ops)
+
+    def _next_batch(self):
+        try:
+            ops = [self.queue.get(timeout=self.flush_seconds)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_seconds
+        while len(ops) < self.batch_size and not self.stopping.is_set():
+            try:
+                ops.append(self.queue.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return ops
+
+    def _flush(self, ops):
+        appends = OrderedDict()
+        updates = []
+        for op in ops:
+            if op["op"] == "append":
+                appends[op["id"]] = op["row"]
+            elif op["id"] in appends:
+                # Row not written yet: fold the update into it
+                appends[op["id"]][op["column"] - 1] = op["value"]
+            else:
+                updates.append(op)
+
+        if appends:
+            response = self._with_retry(self.sheet.append_rows, list(appends.values()), value_input_option="RAW")
+            if response is None:
+                self._spill([{"op": "append", "id": log_id, "row": row} for log_id, row in appends.items()])
+            else:
+                first_row = _first_row(response)
+                if first_row is not None:
+                    for offset, log_id in enumerate(appends):
+                        self.rows[log_id] = first_row + offset
+                    while len(self.rows) > MAX_TRACKED_ROWS:
+                        self.rows.popitem(last=False)
+
+        data = []
+        for op in updates:
+            row = self.rows.get(op["id"])
+            if row is not None:
+                data.append({"range": f"{_column_letter(op['column'])}{row}", "values": [[op["value"]]]})
+            elif op["id"] in self.spilled_ids:
+                # Its row is waiting in the spill file; keep the update with it
+                self._spill([op])
+            else:
+                print("WARNING - no sheet row known for log id", op["id"])
+        if data and self._with_retry(self.sheet.batch_update, data) is None:
+            self._spill([op for op in updates if op["id"] in self.rows])
+
+        if (appends or data) and not self.stopping.is_set():
+            self._replay_spill()
+
+    def _with_retry(self, func, *args, **kwargs):
+        # Returns func's result ({} for an empty response), or None after giving up
+        delay = 1.0
+        for attempt in range(self.max_retries + 1):
+            try:
+                result = func(*args, **kwargs)
+                return result if result is not None else {}
+            except gspread.exceptions.APIError as e:
+                status = getattr(getattr(e, "response", None), "status_code", None)
+                if status not in RETRYABLE_STATUS or attempt == self.max_retries:
+                    print("WARNING - Sheets API error:", e)
+                    return None
+            except Exception as e:
+                # Network errors: Sheets is unreachable
+                if attempt == self.max_retries:
+                    print("WARNING - Sheets unavailable:", e)
+                    return None
+            time.sleep(delay)
+            delay = min(delay * 2, 60.0)
+        return None
+
+    def _spill(self, ops):
+        with self.spill_lock:
+            with open(self.spill_path, "a", encoding="utf-8") as f:
+                for op in ops:
+                    f.write(json.dumps(op) + "\n")
+                    if op["op"] == "append":
+                        self.spilled_ids.add(op["id"])
+
+    def _replay_spill(self):
+        # Sheets is reachable again: move spilled rows back onto the queue
+        with self.spill_lock:
+            if not os.path.exists(self.spill_path):
+                return
+            with open(self.spill_path, encoding="utf-8") as f:
+                ops = [json.loads(line) for line in f if line.strip()]
+            os.remove(self.spill_path)
+            self.spilled_ids.clear()
+        for op in ops:
+            self._enqueue(op)
+
+_loggers = {}
+_loggers_lock = threading.Lock()
+
+def get_sheets_logger(sheet):
+    # One background logger per sheet handle, shared across the process
+    with _loggers_lock:
+        logger = _loggers.get(id(sheet))
+        if logger is None:
+            logger = SheetsLogger(sheet)
+            _loggers[id(sheet)] = logger
+        return logger
+
 def log_interaction(sheet, user_email, user_input, bot_response, feedback):
-    sheet.append_row([user_email, user_input, bot_response, feedback])
-    
\ No newline at end of file
+    # Returns the log id; pass it to update_feedback() instead of logging a second row
+    return get_sheets_logger(sheet).append([user_email, user_input, bot_response, feedback])
+
+def update_feedback(sheet, log_id, feedback):
+    get_sheets_logger(sheet).update_cell(log_id, FEEDBACK_COLUMN, feedback)
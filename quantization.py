@@ -0,0 +1,116 @@
+import os
+import numpy as np
+
+# Compressed copies of the local index vectors for a cheaper first pass:
+#   scalar: int8 codes with one scale per dimension (value ~= code * scale)
+#   binary: one sign bit per dimension, packed 8 per byte
+# The quantized scan only shortlists candidates; LocalVectorIndex re-scores
+# them against the full-precision vectors, like the compression + rescoring
+# create_index.py configures in Azure AI Search.
+
+COMPRESSIONS = ("none", "scalar", "binary")
+SCAN_ROWS = 65536  # rows processed per block, bounds scratch memory
+DECODE_ROWS = 128  # int8 rows widened to float32 at a time; small blocks stay in CPU cache
+
+if hasattr(np, "bitwise_count"):
+    _popcount = np.bitwise_count
+else:  # numpy < 2.0
+    _POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(values):
+        return _POPCOUNT_TABLE[values]
+
+def _write(array, path):
+    array.tofile(f"{path}.tmp")
+    os.replace(f"{path}.tmp", path)
+
+class ScalarQuantizer:
+    kind = "scalar"
+    files = ("vectors.int8", "scales.f32")
+
+    def __init__(self, codes, scales):
+        self.codes = codes
+        self.scales = scales
+
+    @classmethod
+    def fit(cls, vectors):
+        scales = np.zeros(vectors.shape[1], dtype=np.float32)
+        for start in range(0, len(vectors), SCAN_ROWS):
+            block = np.abs(np.asarray(vectors[start:start + SCAN_ROWS]))
+            scales = np.maximum(scales, block.max(axis=0))
+        scales = np.where(scales == 0, 1, scales / 127).astype(np.float32)
+        codes = np.empty(vectors.shape, dtype=np.int8)
+        for start in range(0, len(vectors), SCAN_ROWS):
+            block = np.asarray(vectors[start:start + SCAN_ROWS]) / scales
+            codes[start:start + len(block)] = np.clip(np.rint(block), -127, 127)
+        return cls(codes, scales)
+
+    def scores(self, queries):
+        # Approximate dot products, shape (queries, rows)
+        weighted = (queries * self.scales).astype(np.float32)
+        scores = np.empty((len(queries), len(self.codes)), dtype=np.float32)
+        for start in range(0, len(self.codes), DECODE_ROWS):
+            block = self.codes[start:start + DECODE_ROWS].astype(np.float32)
+            scores[:, start:start + len(block)] = (block @ weighted.T).T
+        return scores
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + self.scales.nbytes
+
+    def save(self, path):
+        _write(self.codes, os.path.join(path, "vectors.int8"))
+        _write(self.scales, os.path.join(path, "scales.f32"))
+
+    @classmethod
+    def load(cls, path, rows, dim):
+        codes = np.memmap(os.path.join(path, "vectors.int8"), dtype=np.int8, mode="r", shape=(rows, dim))
+        scales = np.fromfile(os.path.join(path, "scales.f32"), dtype=np.float32)
+        return cls(codes, scales)
+
+class BinaryQuantizer:
+    kind = "binary"
+    files = ("vectors.bits",)
+
+    def __init__(self, bits, dim):
+        self.bits = bits
+        self.dim = dim
+
+    @classmethod
+    def fit(cls, vectors):
+        bits = np.empty((len(vectors), (vectors.shape[1] + 7) // 8), dtype=np.uint8)
+        for start in range(0, len(vectors), SCAN_ROWS):
+            block = np.asarray(vectors[start:start + SCAN_ROWS])
+            bits[start:start + len(block)] = np.packbits(block > 0, axis=1)
+        return cls(bits, vectors.shape[1])
+
+    def scores(self, queries):
+        # Share of matching signs mapped to [-1, 1]: (dim - 2 * Hamming distance) / dim
+        query_bits = np.packbits(np.asarray(queries) > 0, axis=1)
+        scores = np.empty((len(queries), len(self.bits)), dtype=np.float32)
+        for start in range(0, len(self.bits), SCAN_ROWS):
+            block = self.bits[start:start + SCAN_ROWS]
+            for i, query in enumerate(query_bits):
+                distances = _popcount(block ^ query).sum(axis=1, dtype=np.int32)
+                scores[i, start:start + len(block)] = (self.dim - 2 * distances) / self.dim
+        return scores
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def save(self, path):
+        _write(self.bits, os.path.join(path, "vectors.bits"))
+
+    @classmethod
+    def load(cls, path, rows, dim):
+        bits = np.memmap(os.path.join(path, "vectors.bits"), dtype=np.uint8, mode="r", shape=(rows, (dim + 7) // 8))
+        return cls(bits, dim)
+
+QUANTIZERS = {"scalar": ScalarQuantizer, "binary": BinaryQuantizer}
+
+def get_quantizer(compression):
+    # None for "none"
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown vector compression {compression!r}; expected one of {COMPRESSIONS}")
+    return QUANTIZERS.get(compression)
@@ -0,0 +1,57 @@
+import os
+import re
+from collections import namedtuple
+
+# Keyword routing of a question to the employee groups whose documents should
+# answer it. Every route becomes its own filtered search on the
+# `employee_group` field (see create_index.py / embed_to_ai_search.py):
+#   - nurses, the union, an article number -> the Nurses collective agreement
+#     (plus the documents for all staff),
+#   - non-contract staff -> their terms and conditions (plus all-staff ones),
+#   - the scheduling / HR systems (Andgo, EARL) -> the all-staff guides,
+#   - entitlements that differ between the two agreements (sick leave,
+#     vacation, overtime, ...) -> each agreement (plus the all-staff
+#     documents) separately, so neither agreement crowds out the other; each
+#     still has to rank against the all-staff documents to get its own
+#     answer block (see merge_routes in chat_with_index.py).
+# Anything else is searched unfiltered, as before routing.
+
+# Routing config
+QUERY_ROUTING_ENABLED = os.getenv("QUERY_ROUTING_ENABLED", "true").lower() in ("1", "true", "yes")
+
+Route = namedtuple("Route", ["name", "filters"])
+
+CONTRACT_PATTERN = re.compile(
+    r"\b(nurses?|rns?|lpns?|nba|union|collective agreement|bargaining|article \d+|grievances?|seniority)\b"
+    r"|(?<!non-)(?<!non )\bcontract (employees?|staff)\b"
+)
+NON_CONTRACT_PATTERN = re.compile(r"\b(non[- ]?contract|excluded|exempt)\b")
+SYSTEMS_PATTERN = re.compile(r"\b(andgo|earl|log ?in|password|smart ?call|my ?schedule|my information)\b")
+SPLIT_TOPICS_PATTERN = re.compile(
+    r"\b(sick|illness|vacation|annual leave|overtime|statutory|stat holidays?|holidays?|benefits?|pension"
+    r"|bereavement|premiums?|probation(ary)?|leave of absence|wages?|pay rates?|hours of work|layoffs?)\b"
+)
+
+CONTRACT_ROUTE = Route("contract", {"employee_group": ["contract", "all"]})
+NON_CONTRACT_ROUTE = Route("non_contract", {"employee_group": ["non_contract", "all"]})
+SYSTEMS_ROUTE = Route("systems", {"employee_group": ["all"]})
+SPLIT_ROUTES = [NON_CONTRACT_ROUTE, CONTRACT_ROUTE]
+
+def route_query(query):
+    # Returns the routes to search, or None for one unfiltered search
+    if not QUERY_ROUTING_ENABLED:
+        return None
+    text = query.lower()
+    contract = CONTRACT_PATTERN.search(text) is not None
+    non_contract = NON_CONTRACT_PATTERN.search(text) is not None
+    if contract and not non_contract:
+        return [CONTRACT_ROUTE]
+    if non_contract and not contract:
+        return [NON_CONTRACT_ROUTE]
+    if contract and non_contract:
+        return SPLIT_ROUTES
+    if SYSTEMS_PATTERN.search(text):
+        return [SYSTEMS_ROUTE]
+    if SPLIT_TOPICS_PATTERN.search(text):
+        return SPLIT_ROUTES
+    return None
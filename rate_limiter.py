@@ -0,0 +1,219 @@
+import os
+import time
+import random
+import threading
+from collections import deque
+from openai import APIConnectionError
+import tracing
+
+# Shared request scheduler for Azure OpenAI deployments. Every embeddings/chat
+# call goes through the scheduler of its deployment, which
+#   - keeps requests and tokens within the RPM/TPM quota (token buckets),
+#   - adapts concurrency AIMD-style: +1/limit per success, halved on 429/503
+#     (with a TCP-like slow start, +1 per success, until the first throttle),
+#   - pauses the whole deployment for Retry-After after a throttle (else backs
+#     off exponentially per request) and retries; connection errors, timeouts
+#     and transient statuses are retried too, without a concurrency decrease,
+#   - serves interactive (chat-path) requests before bulk (ingestion) ones and
+#     keeps SCHEDULER_BULK_SHARE of the token budget as the ceiling for bulk
+#     traffic, leaving headroom for chat in other processes on the same quota.
+# The OpenAI clients are created with max_retries=0 so retries happen here.
+
+# Scheduler config (0 = no budget, concurrency control only)
+OPENAI_EMBEDDING_TPM = int(os.getenv("OPENAI_EMBEDDING_TPM", "0"))
+OPENAI_EMBEDDING_RPM = int(os.getenv("OPENAI_EMBEDDING_RPM", "0"))
+OPENAI_CHAT_TPM = int(os.getenv("OPENAI_CHAT_TPM", "0"))
+OPENAI_CHAT_RPM = int(os.getenv("OPENAI_CHAT_RPM", "0"))
+SCHEDULER_INITIAL_CONCURRENCY = float(os.getenv("SCHEDULER_INITIAL_CONCURRENCY", "4"))
+SCHEDULER_MAX_CONCURRENCY = float(os.getenv("SCHEDULER_MAX_CONCURRENCY", "32"))
+SCHEDULER_MAX_RETRIES = int(os.getenv("SCHEDULER_MAX_RETRIES", "6"))
+SCHEDULER_BULK_SHARE = float(os.getenv("SCHEDULER_BULK_SHARE", "0.8"))  # fraction of the budget bulk traffic may use
+
+INTERACTIVE = 0
+BULK = 1
+THROTTLE_STATUS = {429, 503}
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+BURST_SECONDS = 10  # Azure enforces per-minute quotas over short windows
+
+class SchedulerTimeout(Exception):
+    # The request could not be started (or retried) before its deadline
+    pass
+
+class _Bucket:
+    # Token bucket refilled at per_minute / 60 per second
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60
+        self.capacity = max(per_minute * BURST_SECONDS / 60, 1)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now, share=1.0):
+        # Seconds until `amount` can be taken while leaving (1 - share) of capacity
+        self._refill(now)
+        amount = min(amount, self.capacity * share)
+        missing = amount + self.capacity * (1 - share) - self.level
+        return max(missing, 0.0) / self.rate
+
+    def take(self, amount):
+        self.level -= min(amount, self.capacity)
+
+    def give_back(self, amount):
+        self.level = min(self.capacity, self.level + amount)
+
+def _retry_after(error):
+    # Seconds from Retry-After / retry-after-ms, or None
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass  # HTTP-date form; fall back to backoff
+    return None
+
+def _retryable(error):
+    # Errors the OpenAI SDK would retry itself: connection failures and
+    # timeouts (APITimeoutError is an APIConnectionError) and transient statuses
+    return isinstance(error, APIConnectionError) or getattr(error, "status_code", None) in RETRYABLE_STATUS
+
+class RequestScheduler:
+    def __init__(self, name, tpm=0, rpm=0, initial_concurrency=SCHEDULER_INITIAL_CONCURRENCY,
+                 max_concurrency=SCHEDULER_MAX_CONCURRENCY, max_retries=SCHEDULER_MAX_RETRIES,
+                 bulk_share=SCHEDULER_BULK_SHARE):
+        self.name = name
+        self.tokens = _Bucket(tpm) if tpm else None
+        self.requests = _Bucket(rpm) if rpm else None
+        self.limit = float(initial_concurrency)
+        self.max_concurrency = float(max_concurrency)
+        self.max_retries = max_retries
+        self.bulk_share = bulk_share
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.last_decrease = 0.0
+        self.slow_start = True
+        self.waiting = (deque(), deque())  # per priority, FIFO
+        self.cond = threading.Condition()
+        self.counts = {"requests": 0, "throttled": 0, "retries": 0, "wait_seconds": 0.0}
+
+    def _wait_time(self, ticket, tokens, priority, now):
+        # 0 when the request may start now, else how long to sleep (None: until notified)
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.waiting[priority][0] is not ticket:
+            return None
+        if priority == BULK and self.waiting[INTERACTIVE]:
+            return None
+        if self.in_flight >= max(int(self.limit), 1):
+            return None
+        share = self.bulk_share if priority == BULK else 1.0
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(1, now, share))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens, now, share))
+        return wait
+
+    def acquire(self, tokens=1, priority=INTERACTIVE, deadline=None):
+        started = time.monotonic()
+        ticket = object()
+        with self.cond:
+            self.waiting[priority].append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = self._wait_time(ticket, tokens, priority, now)
+                    if wait == 0:
+                        break
+                    if deadline is not None and (now >= deadline or (wait is not None and now + wait > deadline)):
+                        raise SchedulerTimeout(f"{self.name}: no capacity before the deadline")
+                    timeout = 1.0 if wait is None else wait
+                    if deadline is not None:
+                        timeout = min(timeout, deadline - now)
+                    self.cond.wait(timeout)
+            finally:
+                self.waiting[priority].remove(ticket)
+                self.cond.notify_all()
+            if self.requests is not None:
+                self.requests.take(1)
+            if self.tokens is not None:
+                self.tokens.take(tokens)
+            self.in_flight += 1
+            self.counts["requests"] += 1
+            self.counts["wait_seconds"] += time.monotonic() - started
+
+    def release(self, succeeded=True, throttled=False, retry_after=None, tokens_reserved=0, tokens_used=None):
+        with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                self.counts["throttled"] += 1
+                # One decrease per throttle episode, not per request caught in it
+                self.slow_start = False
+                if now - self.last_decrease > 1.0:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.last_decrease = now
+                if retry_after is not None:
+                    self.paused_until = max(self.paused_until, now + retry_after)
+            elif succeeded:
+                self.limit = min(self.max_concurrency, self.limit + (1 if self.slow_start else 1 / self.limit))
+            if self.tokens is not None and tokens_used is not None and tokens_used < tokens_reserved:
+                self.tokens.give_back(tokens_reserved - tokens_used)
+            self.cond.notify_all()
+
+    def run(self, func, tokens=1, priority=INTERACTIVE, deadline=None, tokens_used=None):
+        # Call func() within the quota, retrying throttled and transient errors.
+        # `tokens` is the estimate reserved up front; tokens_used(result), if
+        # given, returns the real count so unused budget is handed back.
+        delay = 0.5
+        wait_started = time.monotonic()
+        for attempt in range(self.max_retries + 1):
+            self.acquire(tokens, priority, deadline)
+            try:
+                result = func()
+            except Exception as e:
+                status = getattr(e, "status_code", None)
+                if not _retryable(e) or attempt == self.max_retries:
+                    self.release(succeeded=False, throttled=status in THROTTLE_STATUS, retry_after=_retry_after(e))
+                    raise
+                retry_after = _retry_after(e)
+                self.release(succeeded=False, throttled=status in THROTTLE_STATUS, retry_after=retry_after)
+                with self.cond:
+                    self.counts["retries"] += 1
+                sleep = retry_after if retry_after is not None else delay * (0.5 + random.random())
+                delay = min(delay * 2, 60.0)
+                if deadline is not None and time.monotonic() + sleep > deadline:
+                    raise SchedulerTimeout(f"{self.name}: throttled until past the deadline") from e
+                time.sleep(sleep)
+                continue
+            self.release(tokens_reserved=tokens, tokens_used=tokens_used(result) if tokens_used else None)
+            tracing.annotate(scheduler_wait_ms=round((time.monotonic() - wait_started) * 1000, 1),
+                             scheduler_attempts=attempt + 1)
+            return result
+
+    def stats(self):
+        with self.cond:
+            return dict(self.counts, concurrency_limit=round(self.limit, 2), in_flight=self.in_flight,
+                        waiting_interactive=len(self.waiting[INTERACTIVE]), waiting_bulk=len(self.waiting[BULK]))
+
+_schedulers = {}
+_schedulers_lock = threading.Lock()
+
+def get_scheduler(deployment, tpm=0, rpm=0):
+    # One scheduler per deployment, shared by every caller in the process
+    with _schedulers_lock:
+        scheduler = _schedulers.get(deployment)
+        if scheduler is None:
+            scheduler = RequestScheduler(deployment, tpm=tpm, rpm=rpm)
+            _schedulers[deployment] = scheduler
+        return scheduler
+
+def embedding_scheduler(deployment):
+    return get_scheduler(deployment, OPENAI_EMBEDDING_TPM, OPENAI_EMBEDDING_RPM)
+
+def chat_scheduler(deployment):
+    return get_scheduler(deployment, OPENAI_CHAT_TPM, OPENAI_CHAT_RPM)
@@ -0,0 +1,343 @@
+import os
+import re
+import json
+import math
+from collections import Counter, defaultdict
+import numpy as np
+from azure.search.documents.models import VectorizedQuery
+from quantization import get_quantizer
+
+try:
+    import hnswlib
+except ImportError:  # optional: only needed for LOCAL_INDEX_HNSW
+    hnswlib = None
+
+# Retrieval backends for the question path. Every retriever exposes
+#   search(query_embedding, k, filters=None) -> list of result dicts (id, content,
+#       document_name, document_url, section_number, section_title, @search.score)
+#   keyword_search(query_text, k, filters=None) -> same shape, BM25 over content/section_title
+#   version() -> a value that changes whenever the underlying index changes
+# `filters` restricts results to records whose field has one of the listed
+# values, e.g. {"employee_group": ["contract", "all"]} (see query_router.py).
+# AzureSearchRetriever queries the live service; LocalVectorIndex answers from
+# a memory-mapped float32 matrix built from the records embed_to_ai_search.py
+# produces (see `embed_to_ai_search.py --target local`), optionally scanning a
+# quantized copy first and re-scoring the shortlist at full precision.
+
+# Retriever config
+RETRIEVER_BACKEND = os.getenv("RETRIEVER_BACKEND", "azure")  # "azure" or "local"
+LOCAL_INDEX_PATH = os.getenv("LOCAL_INDEX_PATH", "local_index")
+LOCAL_INDEX_HNSW = os.getenv("LOCAL_INDEX_HNSW", "false").lower() in ("1", "true", "yes")
+HNSW_MIN_VECTORS = 5000  # below this an exact scan is faster than a graph walk
+
+# Vector config: create_index.py, ingestion and queries all read these, so the
+# index schema, stored vectors and query vectors agree. Changing dimensions
+# needs a new index (create_index.py) and a full re-embed.
+NATIVE_EMBEDDING_DIMENSIONS = 1536  # text-embedding-ada-002 / text-embedding-3-small
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS") or 0) or None  # shortened vectors (text-embedding-3 models only); unset = native size
+INDEX_VECTOR_DIMENSIONS = EMBEDDING_DIMENSIONS or NATIVE_EMBEDDING_DIMENSIONS
+VECTOR_COMPRESSION = os.getenv("VECTOR_COMPRESSION", "none")  # "none", "scalar" (int8) or "binary"
+VECTOR_RESCORE = os.getenv("VECTOR_RESCORE", "true").lower() in ("1", "true", "yes")  # re-rank with full-precision vectors
+VECTOR_OVERSAMPLING = float(os.getenv("VECTOR_OVERSAMPLING", "4"))  # candidates per requested result when re-scoring
+SEARCH_ALIAS_API_VERSION = os.getenv("SEARCH_ALIAS_API_VERSION", "2025-05-01-preview")  # REST version with index aliases
+
+# Fields returned to the answer step (skips shipping the stored vectors back)
+RESULT_FIELDS = ["id", "content", "document_name", "document_url", "section_number", "section_title"]
+KEYWORD_FIELDS = ["content", "section_title"]
+FILTER_FIELDS = ["employee_group"]  # filterable fields kept by the local index besides RESULT_FIELDS
+
+# Hybrid retrieval config
+RRF_K = int(os.getenv("RRF_K", "60"))  # reciprocal rank fusion damping constant
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Keeps clause numbers ("14.02") and hyphenated terms together
+TOKEN_PATTERN = re.compile(r"\w+(?:[.\-]\w+)*")
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+def reciprocal_rank_fusion(result_lists, k, rrf_k=RRF_K):
+    # Merge ranked lists by summing 1 / (rrf_k + rank); the fused score
+    # replaces @search.score
+    scores = defaultdict(float)
+    first_seen = {}
+    for results in result_lists:
+        for rank, result in enumerate(results, start=1):
+            scores[result["id"]] += 1.0 / (rrf_k + rank)
+            first_seen.setdefault(result["id"], result)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [dict(first_seen[doc_id], **{"@search.score": scores[doc_id]}) for doc_id in ranked]
+
+def odata_filter(filters):
+    # {"employee_group": ["contract", "all"]} -> search.in(employee_group, 'contract|all', '|')
+    if not filters:
+        return None
+    clauses = []
+    for field, values in sorted(filters.items()):
+        allowed = "|".join(str(value).replace("'", "''") for value in values)
+        clauses.append(f"search.in({field}, '{allowed}', '|')")
+    return " and ".join(clauses)
+
+class AzureSearchRetriever:
+    def __init__(self, search_client, http_session, endpoint, api_key, index_name="docs", timeout=None):
+        self.search_client = search_client
+        self.http_session = http_session
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.index_name = index_name
+        self.timeout = timeout
+
+    def search(self, query_embedding, k=6, filters=None):
+        # With compression, Search re-scores the oversampled matches against the original vectors
+        options = {"oversampling": VECTOR_OVERSAMPLING} if VECTOR_COMPRESSION != "none" and VECTOR_RESCORE else {}
+        vector_query = VectorizedQuery(vector=query_embedding, k_nearest_neighbors=k, fields="embedding", **options)
+        return [
+            dict(result)
+            for result in self.search_client.search(
+                search_text=None,
+                vector_queries=[vector_query],
+                filter=odata_filter(filters),  # applied before the nearest-neighbour search
+                select=RESULT_FIELDS,
+                top=k
+            )
+        ]
+
+    def keyword_search(self, query_text, k=6, filters=None):
+        return [
+            dict(result)
+            for result in self.search_client.search(
+                search_text=query_text,
+                search_fields=KEYWORD_FIELDS,
+                filter=odata_filter(filters),
+                select=RESULT_FIELDS,
+                top=k
+            )
+        ]
+
+    def live_index(self):
+        # Index behind the alias (see create_index.py); the name itself when
+        # it is a plain index
+        alias_url = f"{self.endpoint}/aliases/{self.index_name}?api-version={SEARCH_ALIAS_API_VERSION}"
+        response = self.http_session.get(alias_url, headers={"api-key": self.api_key}, timeout=self.timeout)
+        if response.status_code == 404:
+            return self.index_name
+        response.raise_for_status()
+        return response.json()["indexes"][0]
+
+    def version(self):
+        # Document count + storage size changes whenever ingestion touches the
+        # index; the index name changes when a rebuild is switched in
+        index_name = self.live_index()
+        stats_url = f"{self.endpoint}/indexes/{index_name}/stats?api-version=2023-11-01"
+        response = self.http_session.get(stats_url, headers={"api-key": self.api_key}, timeout=self.timeout)
+        response.raise_for_status()
+        stats = response.json()
+        return (index_name, stats.get("documentCount"), stats.get("storageSize"))
+
+class LocalVectorIndex:
+    # Rows of `vectors` are unit-normalized embeddings, so a dot product is the
+    # cosine similarity Azure Search uses for the `embedding` field. With a
+    # compression, the exact scan runs over the quantized copy and the best
+    # k * oversampling rows are re-scored against `vectors` (which stay on
+    # disk, memory-mapped; only the shortlisted rows are read).
+    def __init__(self, vectors, records, path=None, compression=VECTOR_COMPRESSION, quantizer=None,
+                 rescore=VECTOR_RESCORE, oversampling=VECTOR_OVERSAMPLING):
+        self.vectors = vectors
+        self.records = records
+        self.path = path
+        self.hnsw = None
+        self.postings = None
+        self.masks = {}  # filters key -> boolean row mask
+        self.quantizer = None
+        self.rescore = rescore
+        self.oversampling = oversampling
+        if LOCAL_INDEX_HNSW and hnswlib is not None and len(records) >= HNSW_MIN_VECTORS:
+            self._build_hnsw()
+        elif records and get_quantizer(compression) is not None:
+            self.quantizer = quantizer or get_quantizer(compression).fit(vectors)
+
+    @classmethod
+    def from_records(cls, records):
+        # records: dicts with "embedding" plus the RESULT_FIELDS metadata
+        vectors = np.asarray([record["embedding"] for record in records], dtype=np.float32)
+        if len(vectors):
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            vectors /= np.where(norms == 0, 1, norms)
+        metadata = [{field: record.get(field, "") for field in RESULT_FIELDS + FILTER_FIELDS} for record in records]
+        return cls(np.ascontiguousarray(vectors), metadata)
+
+    def save(self, path=LOCAL_INDEX_PATH):
+        # Write-then-rename so a running app never maps a half-written file;
+        # records.json goes last since its mtime is the index version
+        os.makedirs(path, exist_ok=True)
+        vectors_path = os.path.join(path, "vectors.f32")
+        records_path = os.path.join(path, "records.json")
+        self.vectors.tofile(f"{vectors_path}.tmp")
+        os.replace(f"{vectors_path}.tmp", vectors_path)
+        if self.quantizer is not None:
+            self.quantizer.save(path)
+        with open(f"{records_path}.tmp", "w", encoding="utf-8") as f:
+            json.dump({"dim": int(self.vectors.shape[1]) if self.vectors.ndim == 2 else 0,
+                       "compression": self.quantizer.kind if self.quantizer is not None else "none",
+                       "records": self.records}, f)
+        os.replace(f"{records_path}.tmp", records_path)
+        self.path = path
+
+    @classmethod
+    def load(cls, path=LOCAL_INDEX_PATH, compression=VECTOR_COMPRESSION):
+        with open(os.path.join(path, "records.json"), encoding="utf-8") as f:
+            data = json.load(f)
+        records = data["records"]
+        quantizer = None
+        if records:
+            vectors = np.memmap(os.path.join(path, "vectors.f32"), dtype=np.float32, mode="r",
+                                shape=(len(records), data["dim"]))
+            # Codes saved with the index are reused; otherwise they are built on load
+            quantizer_cls = get_quantizer(compression)
+            if quantizer_cls is not None and data.get("compression") == compression:
+                quantizer = quantizer_cls.load(path, len(records), data["dim"])
+        else:
+            vectors = np.zeros((0, data["dim"]), dtype=np.float32)
+        return cls(vectors, records, path, compression=compression, quantizer=quantizer)
+
+    def _build_hnsw(self):
+        index = hnswlib.Index(space="ip", dim=self.vectors.shape[1])
+        index.init_index(max_elements=len(self.records), ef_construction=200, M=16)
+        index.add_items(np.asarray(self.vectors), np.arange(len(self.records)))
+        index.set_ef(64)
+        self.hnsw = index
+
+    def _unit(self, embeddings):
+        queries = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(queries, axis=-1, keepdims=True)
+        return queries / np.where(norms == 0, 1, norms)
+
+    def _results(self, rows, scores):
+        return [dict(self.records[row], **{"@search.score": float(score)}) for row, score in zip(rows, scores)]
+
+    def _mask(self, filters):
+        # Rows allowed by `filters`, or None for no filtering
+        if not filters:
+            return None
+        key = tuple(sorted((field, tuple(sorted(values))) for field, values in filters.items()))
+        mask = self.masks.get(key)
+        if mask is None:
+            mask = np.ones(len(self.records), dtype=bool)
+            for field, values in filters.items():
+                allowed = set(values)
+                mask &= np.fromiter((record.get(field) in allowed for record in self.records),
+                                    dtype=bool, count=len(self.records))
+            self.masks[key] = mask
+        return mask
+
+    def _shortlist(self, query, approx_scores, k):
+        # Best rows by quantized score, re-ranked by exact cosine when rescoring
+        size = min(len(approx_scores), max(k, math.ceil(k * self.oversampling)) if self.rescore else k)
+        candidates = np.argpartition(-approx_scores, size - 1)[:size]
+        candidates = candidates[np.isfinite(approx_scores[candidates])]  # filtered-out rows
+        if self.rescore:
+            candidates = np.sort(candidates)  # in file order for the memmap reads
+            scores = np.asarray(self.vectors[candidates]) @ query
+        else:
+            scores = approx_scores[candidates]
+        order = np.argsort(-scores)[:k]
+        return self._results(candidates[order].tolist(), scores[order])
+
+    @property
+    def scan_bytes(self):
+        # Memory the similarity scan reads per query
+        return self.quantizer.nbytes if self.quantizer is not None else self.vectors.nbytes
+
+    def search(self, query_embedding, k=6, filters=None):
+        return self.search_batch([query_embedding], k, filters)[0]
+
+    def search_batch(self, query_embeddings, k=6, filters=None):
+        # Top-k for many queries with one matrix product
+        mask = self._mask(filters)
+        k = min(k, len(self.records) if mask is None else int(mask.sum()))
+        if not k:
+            return [[] for _ in query_embeddings]
+        queries = self._unit(query_embeddings)
+        if self.hnsw is not None:
+            allowed = None if mask is None else (lambda row: bool(mask[row]))
+            labels, distances = self.hnsw.knn_query(queries, k=k, filter=allowed)
+            # hnswlib's "ip" distance is 1 - dot product
+            return [self._results(rows, 1 - dists) for rows, dists in zip(labels.tolist(), distances)]
+        if self.quantizer is not None:
+            approx = self.quantizer.scores(queries)
+            if mask is not None:
+                approx[:, ~mask] = -np.inf
+            return [self._shortlist(query, scores, k) for query, scores in zip(queries, approx)]
+        scores = queries @ np.asarray(self.vectors).T
+        if mask is not None:
+            scores[:, ~mask] = -np.inf
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for query_scores, candidates in zip(scores, top):
+            ranked = candidates[np.argsort(-query_scores[candidates])]
+            results.append(self._results(ranked.tolist(), query_scores[ranked]))
+        return results
+
+    def _build_inverted_index(self):
+        # term -> (rows, term frequencies) as arrays, for vectorized BM25 scoring
+        postings = defaultdict(lambda: ([], []))
+        lengths = np.zeros(len(self.records), dtype=np.float32)
+        for row, record in enumerate(self.records):
+            terms = Counter(tokenize(" ".join(str(record.get(field) or "") for field in KEYWORD_FIELDS)))
+            lengths[row] = sum(terms.values())
+            for term, tf in terms.items():
+                postings[term][0].append(row)
+                postings[term][1].append(tf)
+        self.doc_lengths = lengths
+        self.avg_doc_length = float(lengths.mean()) if len(lengths) else 0.0
+        # Assigned last: concurrent callers only use the index once it is complete
+        self.postings = {
+            term: (np.asarray(rows, dtype=np.int64), np.asarray(tfs, dtype=np.float32))
+            for term, (rows, tfs) in postings.items()
+        }
+
+    def keyword_search(self, query_text, k=6, filters=None):
+        if not self.records:
+            return []
+        if self.postings is None:
+            self._build_inverted_index()
+        n = len(self.records)
+        scores = np.zeros(n, dtype=np.float32)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths / max(self.avg_doc_length, 1e-9))
+        for term in set(tokenize(query_text)):
+            if term not in self.postings:
+                continue
+            rows, tfs = self.postings[term]
+            idf = math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * tfs * (BM25_K1 + 1) / (tfs + norm[rows])
+        mask = self._mask(filters)
+        if mask is not None:
+            scores[~mask] = 0
+        matched = np.flatnonzero(scores)
+        if not len(matched):
+            return []
+        top = matched[np.argsort(-scores[matched])[:k]]
+        return self._results(top.tolist(), scores[top])
+
+    def version(self):
+        if self.path is None:
+            return id(self)
+        return os.path.getmtime(os.path.join(self.path, "records.json"))
+
+def get_retriever(backend=RETRIEVER_BACKEND):
+    if backend == "local":
+        return LocalVectorIndex.load(LOCAL_INDEX_PATH)
+    # Imported here so the local backend works without Azure settings
+    from clients import (
+        get_search_client, get_http_session, AZURE_SEARCH_ENDPOINT, AZURE_SEARCH_API_KEY, SEARCH_INDEX_NAME,
+        HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS,
+    )
+    return AzureSearchRetriever(
+        get_search_client(SEARCH_INDEX_NAME),
+        get_http_session(),
+        AZURE_SEARCH_ENDPOINT,
+        AZURE_SEARCH_API_KEY,
+        index_name=SEARCH_INDEX_NAME,
+        timeout=(HTTP_CONNECT_TIMEOUT_SECONDS, HTTP_READ_TIMEOUT_SECONDS),
+    )
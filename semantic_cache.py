@@ -0,0 +1,110 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Semantic answer cache for near-duplicate questions. An entry holds the final
+# answer blocks, the query embedding and the set of chunk IDs retrieved for it.
+# A new question reuses an entry only when it retrieved exactly the same chunks
+# and its embedding is within SEMANTIC_CACHE_THRESHOLD cosine similarity.
+# Entries are bucketed by their chunk set, so each lookup is one vectorized
+# dot product over the few entries that could match. Chunk IDs are derived
+# from chunk content, so an edited chunk stops matching on its own; entries
+# also record the documents their answer drew on, and the question path drops
+# those of re-indexed documents (invalidate_documents, from the manifest).
+
+# Cache config
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.95"))  # min cosine similarity
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "20000"))
+SEMANTIC_CACHE_TTL_SECONDS = float(os.getenv("SEMANTIC_CACHE_TTL_SECONDS", "86400"))
+
+class SemanticCache:
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, max_entries=SEMANTIC_CACHE_MAX_ENTRIES,
+                 ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # entry id -> {"sources", "documents", "answer_blocks", "expires_at"}
+        self.buckets = {}  # sources -> {"ids": [entry ids], "matrix": unit vectors, one row per id}
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _unit(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def lookup(self, embedding, sources):
+        # Returns the cached answer blocks, or None
+        sources = frozenset(sources)
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(sources)
+            if bucket is not None:
+                scores = bucket["matrix"] @ self._unit(embedding)
+                for row in np.argsort(-scores).tolist():
+                    if scores[row] < self.threshold:
+                        break
+                    entry_id = bucket["ids"][row]
+                    entry = self.entries[entry_id]
+                    if entry["expires_at"] <= now:
+                        continue
+                    self.entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return entry["answer_blocks"]
+            self.misses += 1
+            return None
+
+    def store(self, embedding, sources, documents, answer_blocks):
+        sources = frozenset(sources)
+        with self.lock:
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = {
+                "sources": sources,
+                "documents": frozenset(documents),
+                "answer_blocks": list(answer_blocks),
+                "expires_at": time.monotonic() + self.ttl_seconds,
+            }
+            vector = self._unit(embedding)[None, :]
+            bucket = self.buckets.get(sources)
+            if bucket is None:
+                self.buckets[sources] = {"ids": [entry_id], "matrix": vector}
+            else:
+                bucket["ids"].append(entry_id)
+                bucket["matrix"] = np.vstack([bucket["matrix"], vector])
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, entry_id):
+        entry = self.entries.pop(entry_id)
+        bucket = self.buckets[entry["sources"]]
+        row = bucket["ids"].index(entry_id)
+        del bucket["ids"][row]
+        if bucket["ids"]:
+            bucket["matrix"] = np.delete(bucket["matrix"], row, axis=0)
+        else:
+            del self.buckets[entry["sources"]]
+
+    def invalidate_documents(self, document_names):
+        # Drop every entry whose answer drew on one of these documents
+        document_names = set(document_names)
+        with self.lock:
+            stale = [entry_id for entry_id, entry in self.entries.items() if entry["documents"] & document_names]
+            for entry_id in stale:
+                self._remove(entry_id)
+            return len(stale)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.buckets.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.entries)}
@@ -0,0 +1,108 @@
+import threading
+import tracing
+
+# Request coalescing for streamed answers. The first caller for a key starts
+# the event generator on a producer thread; every caller for the same key that
+# arrives while it runs subscribes to the same flight and receives all of its
+# events from the beginning. An exception in the generator is re-raised to
+# every subscriber after the events produced before it. When the last
+# subscriber goes away the generator is closed. Finished flights are dropped,
+# so later callers start a fresh one. Producers run on the given executor, so
+# the number of flights running at once stays bounded.
+
+class _Flight:
+    def __init__(self):
+        self.events = []
+        self.done = False
+        self.error = None
+        self.cancelled = False
+        self.subscribers = 0
+        self.cond = threading.Condition()
+
+class SingleFlight:
+    def __init__(self, executor):
+        self.executor = executor
+        self.flights = {}  # key -> in-progress _Flight
+        self.lock = threading.Lock()
+        self.counts = {"leaders": 0, "followers": 0, "cancelled": 0}
+
+    def stream(self, key, factory):
+        # Returns (event iterator, True if this call started the flight).
+        # factory() must return the event generator.
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = True
+            if flight is not None:
+                # cancelled is set under flight.cond when the last subscriber
+                # leaves, so check and join under it too
+                with flight.cond:
+                    if not flight.cancelled:
+                        flight.subscribers += 1
+                        leader = False
+            if leader:
+                flight = _Flight()
+                flight.subscribers = 1
+                self.flights[key] = flight
+            self.counts["leaders" if leader else "followers"] += 1
+        if leader:
+            # bind: spans opened by the generator belong to the leader's trace
+            self.executor.submit(tracing.bind(self._produce), key, flight, factory)
+        return self._subscribe(key, flight), leader
+
+    def _produce(self, key, flight, factory):
+        try:
+            if flight.cancelled:
+                return  # every subscriber left while it waited for the executor
+            generator = factory()
+            try:
+                for event in generator:
+                    with flight.cond:
+                        if flight.cancelled:
+                            break
+                        flight.events.append(event)
+                        flight.cond.notify_all()
+            finally:
+                generator.close()
+        except Exception as e:
+            with flight.cond:
+                flight.error = e
+        finally:
+            self._forget(key, flight)
+            with flight.cond:
+                flight.done = True
+                flight.cond.notify_all()
+
+    def _subscribe(self, key, flight):
+        position = 0
+        try:
+            while True:
+                with flight.cond:
+                    while position >= len(flight.events) and not flight.done:
+                        flight.cond.wait()
+                    if position < len(flight.events):
+                        event = flight.events[position]
+                    elif flight.error is not None:
+                        raise flight.error
+                    else:
+                        return
+                position += 1
+                yield event
+        finally:
+            with flight.cond:
+                flight.subscribers -= 1
+                abandoned = flight.subscribers == 0 and not flight.done
+                if abandoned:
+                    flight.cancelled = True
+            if abandoned:
+                self._forget(key, flight)
+                with self.lock:
+                    self.counts["cancelled"] += 1
+
+    def _forget(self, key, flight):
+        with self.lock:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, in_flight=len(self.flights))
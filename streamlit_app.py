@@ -5,10 +5,23 @@ import json
 import gspread
 from google.oauth2.service_account import Credentials
 from dotenv import load_dotenv
+import itertools
+import threading
+import time
 from datetime import datetime
 from PIL import Image  # <--- Add this for image handling
+from google_sheets_logger import get_sheets_logger, FEEDBACK_COLUMN
+import tracing
 
-load_dotenv()
+# Every interaction re-runs this script; time it against a budget (see check_rerun_budget)
+RERUN_STARTED = time.perf_counter()
+
+@st.cache_resource
+def load_environment():
+    # Read .env once per process instead of on every rerun
+    load_dotenv()
+
+load_environment()
 
 # --- SET PAGE CONFIG AT VERY TOP ---
 st.set_page_config(page_title="HR Chatbot", page_icon="💬", layout="wide")
@@ -41,21 +54,28 @@ def is_valid_domain(email):
         return False
 
 # --- Connect to Google Sheets ---
+class DummySheet:
+    # Stands in for the worksheet during local development
+    def __init__(self):
+        self.row_count = 0
+
+    def append_rows(self, rows, value_input_option=None):
+        first_row = self.row_count + 1
+        self.row_count += len(rows)
+        return {"updates": {"updatedRange": f"Sheet1!A{first_row}:E{self.row_count}"}}
+
+    def batch_update(self, data):
+        pass
+
 def connect_to_sheets(sheet_name):
     gcp_service_account = os.getenv("GCP_SERVICE_ACCOUNT")
     if not gcp_service_account:
         # Bypass for local development
-        class DummySheet:
-            def append_row(self, row):
-                pass
         return DummySheet()
     try:
         service_account_info = json.loads(gcp_service_account)
     except Exception:
         # If JSON is invalid, bypass as well
-        class DummySheet:
-            def append_row(self, row):
-                pass
         return DummySheet()
     SCOPES = [
         "https://www.googleapis.com/auth/spreadsheets",
@@ -69,16 +89,72 @@ def connect_to_sheets(sheet_name):
     sheet = client.open(sheet_name).sheet1
     return sheet
 
+# --- Process-wide cached resources ---
+SHEET_NAME = "PHC HR Chatbot Analytics"  # <-- Your Sheet Name
+LOGO_PATH = "phc_logo.png"
+RERUN_BUDGET_MS = float(os.getenv("RERUN_BUDGET_MS", "100"))
+
+@st.cache_resource
+def start_warmup():
+    # Runs once per process: build the AI clients (importing chat_with_index)
+    # and the Sheets handle in the background, so they are ready by the time
+    # the user gets past the login screen
+    resources = {}
+
+    def warm_up():
+        started = time.perf_counter()
+        try:
+            import chat_with_index  # noqa: F401  (creates the shared clients and caches)
+        except Exception as e:
+            print("WARNING - AI client warm-up failed:", e)
+        try:
+            resources["sheet"] = connect_to_sheets(SHEET_NAME)
+        except Exception as e:
+            print("WARNING - Google Sheets warm-up failed:", e)
+        print(f"Warm-up finished in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+    thread.start()
+    return thread, resources
+
+@st.cache_resource
+def get_sheet():
+    thread, resources = start_warmup()
+    thread.join()
+    if "sheet" not in resources:
+        return connect_to_sheets(SHEET_NAME)
+    return resources["sheet"]
+
+@st.cache_resource
+def load_logo():
+    # Raw PNG bytes, read once; Streamlit serves them without re-decoding
+    with open(LOGO_PATH, "rb") as f:
+        return f.read()
+
+def check_rerun_budget(page):
+    elapsed_ms = (time.perf_counter() - RERUN_STARTED) * 1000
+    if elapsed_ms > RERUN_BUDGET_MS:
+        print(f"WARNING - {page} page rerun took {elapsed_ms:.1f} ms (budget {RERUN_BUDGET_MS:.0f} ms)")
+
+start_warmup()
+
 # --- Log interaction ---
+# Rows are queued and written to Sheets in batches by a background thread
+# (see google_sheets_logger.SheetsLogger), so logging never blocks a chat turn
 def log_interaction(sheet, user_email, question, answer, feedback):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    sheet.append_row([user_email, question, answer, feedback, timestamp])
+    with tracing.span("sheets_log"):
+        return get_sheets_logger(sheet).append([user_email, question, answer, feedback, timestamp])
+
+def record_feedback(sheet, log_id, feedback):
+    # Updates the feedback cell of the row logged for this answer
+    get_sheets_logger(sheet).update_cell(log_id, FEEDBACK_COLUMN, feedback)
 
 # --- Login Screen ---
 # --- Login Screen ---
 if "user_email" not in st.session_state:
     # One column, align left
-    st.image("phc_logo.png", width=200)  # Make the logo bigger (adjust width as needed)
+    st.image(load_logo(), width=200)  # Make the logo bigger (adjust width as needed)
     st.markdown("<h1 style='text-align: left; margin-top: 0;'>HR Chatbot Login</h1>", unsafe_allow_html=True)
     st.caption("Please enter your work email to continue.")
 
@@ -123,13 +199,13 @@ if "user_email" not in st.session_state:
     </div>
     """, unsafe_allow_html=True)
 
+    check_rerun_budget("login")
     st.stop()
 
 # ✅ If logged in, proceed with app!
 
-# Connect to Google Sheet
-SHEET_NAME = "PHC HR Chatbot Analytics"  # <-- Your Sheet Name
-sheet = connect_to_sheets(SHEET_NAME)
+# Connect to Google Sheet (cached for the whole process)
+sheet = get_sheet()
 
 # Load environment variables
 AZURE_OPENAI_CHAT_ENDPOINT = os.getenv("AZURE_OPENAI_CHAT_ENDPOINT")
@@ -144,12 +220,12 @@ AZURE_SEARCH_ENDPOINT = os.getenv("AZURE_SEARCH_ENDPOINT")
 AZURE_SEARCH_API_KEY = os.getenv("AZURE_SEARCH_API_KEY")
 
 # Import after environment is loaded
-from chat_with_index import ask_question
+from chat_with_index import ask_question_stream, format_sources
 
 # After successful login (Main Page)
 
 # Load PHC logo
-st.image("phc_logo.png", width=200)  # Adjust width as needed
+st.image(load_logo(), width=200)  # Adjust width as needed
 
 # Title without emoji
 st.title("How can I help you today?")
@@ -158,55 +234,68 @@ st.title("How can I help you today?")
 if "messages" not in st.session_state:
     st.session_state.messages = []
 
+def render_sources(sources):
+    if sources:
+        st.markdown(f"📚 **Sources:**\n{format_sources(sources)}", unsafe_allow_html=True)
+
 # Display chat messages (only completed ones)
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
         if message["role"] == "assistant":
-            st.markdown(message["content"], unsafe_allow_html=True)
-            if message.get("sources"):
-                st.markdown(f"📚 **Sources:**\n{message['sources']}", unsafe_allow_html=True)
+            for block in message.get("blocks", []):
+                st.markdown(f"### {block['heading']}\n{block['answer']}", unsafe_allow_html=True)
+                render_sources(block["sources"])
         else:
             st.markdown(message["content"], unsafe_allow_html=True)
 
 # Chat input box
 user_input = st.chat_input("Ask your HR question here...")
 
+# Everything above is the rerun hot path (no network or file I/O once warm)
+check_rerun_budget("chat")
+
 if user_input:
-    # Show spinner below the chat while waiting for assistant response
-    with st.spinner("Thinking..."):
-        answer = ask_question(user_input)
-        # Split answer and sources
-        if "📚 **Sources:**" in answer:
-            main_answer, sources = answer.split("📚 **Sources:**", 1)
-        else:
-            main_answer, sources = answer, ""
-        user_message = {"role": "user", "content": user_input}
-        assistant_message = {
-            "role": "assistant",
-            "content": main_answer.strip(),
-            "sources": sources.strip() if sources.strip() else None
-        }
-        st.session_state.messages.append(user_message)
-        st.session_state.messages.append(assistant_message)
+    # One trace per question: rendering, the answer pipeline and the Sheets log
+    with tracing.span("streamlit_request"):
+        st.session_state.messages.append({"role": "user", "content": user_input})
         # Display the new user message
         with st.chat_message("user"):
             st.markdown(user_input)
-        # Display the new assistant message
+        # Stream the new assistant message as it is generated
+        blocks = []
         with st.chat_message("assistant"):
-            st.markdown(assistant_message["content"], unsafe_allow_html=True)
-            if assistant_message.get("sources"):
-                st.markdown(f"📚 **Sources:**\n{assistant_message['sources']}", unsafe_allow_html=True)
-    # Save last interaction
-    st.session_state.last_question = user_input
-    st.session_state.last_answer = main_answer.strip()
-    # Log Q/A immediately with 'Pending' feedback
-    log_interaction(
-        sheet,
-        st.session_state.user_email,
-        st.session_state.last_question,
-        st.session_state.last_answer,
-        "Pending"
-    )
+            events = ask_question_stream(user_input)
+            # Show spinner only until the first event (heading) arrives
+            with st.spinner("Thinking..."):
+                first_event = next(events, None)
+            answer_placeholder = None
+            answer_text = ""
+            for event in itertools.chain([first_event], events) if first_event else ():
+                if event["type"] == "heading":
+                    st.markdown(f"### {event['text']}", unsafe_allow_html=True)
+                    answer_placeholder = st.empty()
+                    answer_text = ""
+                elif event["type"] == "delta":
+                    answer_text += event["text"]
+                    answer_placeholder.markdown(answer_text + "▌", unsafe_allow_html=True)
+                elif event["type"] == "sources":
+                    answer_placeholder.markdown(answer_text, unsafe_allow_html=True)
+                    render_sources(event["sources"])
+                elif event["type"] == "done":
+                    blocks = event["blocks"]
+        main_answer = "\n\n".join(f"### {block['heading']}\n{block['answer']}" for block in blocks)
+        st.session_state.messages.append({"role": "assistant", "content": main_answer, "blocks": blocks})
+        # Save last interaction
+        st.session_state.last_question = user_input
+        st.session_state.last_answer = main_answer.strip()
+        # Log Q/A immediately with 'Pending' feedback (queued; written in the background)
+        st.session_state.last_log_id = log_interaction(
+            sheet,
+            st.session_state.user_email,
+            st.session_state.last_question,
+            st.session_state.last_answer,
+            "Pending"
+        )
 
 # ---- Feedback Buttons ----
 if st.session_state.get("last_answer"):
@@ -214,23 +303,11 @@ if st.session_state.get("last_answer"):
     with col1:
         if st.button("👍 Yes, it helped", key="feedback_yes"):
             st.success("✅ Thank you for your feedback!")
-            log_interaction(
-                sheet,
-                st.session_state.user_email,
-                st.session_state.last_question,
-                st.session_state.last_answer,
-                "Yes"
-            )
+            record_feedback(sheet, st.session_state.last_log_id, "Yes")
             st.session_state.last_answer = None  # Reset
 
     with col2:
         if st.button("👎 No, it didn't help", key="feedback_no"):
             st.warning("Sorry I'm unable to answer your question. Please contact hr@providencehealth.bc.com for further assistance.")
-            log_interaction(
-                sheet,
-                st.session_state.user_email,
-                st.session_state.last_question,
-                st.session_state.last_answer,
-                "No"
-            )
+            record_feedback(sheet, st.session_state.last_log_id, "No")
             st.session_state.last_answer = None  # Reset
\ No newline at end of file
@@ -0,0 +1,272 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from collections import defaultdict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Per-stage tracing for the question path. Wrap a stage in
+#   with tracing.span("embed", cache_hit=False) as span:
+#       ...
+#       span.set(result_count=6)
+# The outermost span of a request starts a trace; every span finished inside
+# it (on this thread, or on a worker started through tracing.bind) is recorded
+# with its duration and attributes, and the whole trace is handed to the
+# configured sinks when the outermost span ends. With TRACING_ENABLED off,
+# span() returns a shared no-op object, so instrumented code costs one check.
+
+# Tracing config
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() in ("1", "true", "yes")
+TRACING_SINKS = os.getenv("TRACING_SINKS", "log")  # comma-separated: "log", "file", "prometheus"
+TRACING_FILE_PATH = os.getenv("TRACING_FILE_PATH", "traces.jsonl")
+TRACING_PROMETHEUS_PORT = int(os.getenv("TRACING_PROMETHEUS_PORT", "9464"))  # serves /metrics
+
+_current_span = contextvars.ContextVar("tracing_span", default=None)
+
+class _NullSpan:
+    def set(self, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_SPAN = _NullSpan()
+
+class Span:
+    def __init__(self, name, trace, parent, attributes):
+        self.name = name
+        self.trace = trace
+        self.parent = parent
+        self.attributes = attributes
+        self.start = None
+        self.duration = None
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        self._token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.duration = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        try:
+            _current_span.reset(self._token)
+        except ValueError:
+            # Closed from another context (e.g. an abandoned generator)
+            _current_span.set(self.parent)
+        self.trace.finish(self)
+        return False
+
+class Trace:
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started_at = time.time()
+        self.root = None
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def finish(self, span):
+        record = {
+            "name": span.name,
+            "parent": span.parent.name if span.parent is not None else None,
+            "start_ms": round((span.start - self.root.start) * 1000, 3),
+            "duration_ms": round(span.duration * 1000, 3),
+            "attributes": span.attributes,
+        }
+        with self.lock:
+            self.spans.append(record)
+        # Spans still running on workers after the root ends (e.g. a chat
+        # block past its deadline) are not part of the emitted trace
+        if span is self.root:
+            _emit(self.to_dict())
+
+    def to_dict(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda record: record["start_ms"])
+        root = spans[0] if spans else {}
+        return {
+            "trace_id": self.trace_id,
+            "timestamp": self.started_at,
+            "name": root.get("name"),
+            "duration_ms": root.get("duration_ms"),
+            "spans": spans,
+        }
+
+def span(name, **attributes):
+    if not TRACING_ENABLED:
+        return NULL_SPAN
+    parent = _current_span.get()
+    if parent is None:
+        trace = Trace()
+        new_span = Span(name, trace, None, attributes)
+        trace.root = new_span
+        return new_span
+    return Span(name, parent.trace, parent, attributes)
+
+def annotate(**attributes):
+    # Add attributes to the innermost open span, if any
+    if TRACING_ENABLED:
+        current = _current_span.get()
+        if current is not None:
+            current.set(**attributes)
+
+def bind(func):
+    # Carry the current span into a function run on another thread
+    # (executor.submit(tracing.bind(func), ...))
+    if not TRACING_ENABLED:
+        return func
+    context = contextvars.copy_context()
+
+    def bound(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return bound
+
+# --- Sinks: anything with emit(trace_dict) ---
+class LogSink:
+    # One line per request: total time and the duration of each stage
+    def emit(self, trace):
+        stages = " ".join(f"{record['name']}={record['duration_ms']:.1f}ms" for record in trace["spans"][1:])
+        print(f"TRACE {trace['trace_id']} {trace['name']} {trace['duration_ms']:.1f}ms {stages}")
+
+class FileSink:
+    # Full traces as JSON lines
+    def __init__(self, path=TRACING_FILE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def emit(self, trace):
+        line = json.dumps(trace, default=str) + "\n"
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+class PrometheusSink:
+    # Aggregates traces into Prometheus text-format metrics: a duration
+    # histogram per stage, token counters and cache hit/miss counters.
+    # Numeric attributes ending in "_tokens" are counted as tokens and boolean
+    # attributes ending in "cache_hit" as cache lookups.
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.durations = defaultdict(lambda: [0] * (len(self.BUCKETS) + 1))  # stage -> bucket counts (+Inf last)
+        self.duration_sums = defaultdict(float)
+        self.errors = defaultdict(int)
+        self.tokens = defaultdict(int)  # (stage, kind) -> total
+        self.cache_lookups = defaultdict(int)  # (cache, "hit"/"miss") -> count
+        self.server = None
+
+    def emit(self, trace):
+        with self.lock:
+            for record in trace["spans"]:
+                stage = record["name"]
+                seconds = record["duration_ms"] / 1000
+                counts = self.durations[stage]
+                for i, bound in enumerate(self.BUCKETS):
+                    if seconds <= bound:
+                        counts[i] += 1
+                counts[-1] += 1
+                self.duration_sums[stage] += seconds
+                for key, value in record["attributes"].items():
+                    if key == "error":
+                        self.errors[stage] += 1
+                    elif isinstance(value, bool):
+                        if key.endswith("cache_hit"):
+                            self.cache_lookups[(key[:-len("_hit")], "hit" if value else "miss")] += 1
+                    elif key.endswith("_tokens") and isinstance(value, (int, float)):
+                        self.tokens[(stage, key[:-len("_tokens")])] += value
+
+    def render(self):
+        lines = [
+            "# HELP hr_chatbot_stage_duration_seconds Duration of each question pipeline stage.",
+            "# TYPE hr_chatbot_stage_duration_seconds histogram",
+        ]
+        with self.lock:
+            for stage, counts in sorted(self.durations.items()):
+                for bound, count in zip(self.BUCKETS, counts):
+                    lines.append(f'hr_chatbot_stage_duration_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'hr_chatbot_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {counts[-1]}')
+                lines.append(f'hr_chatbot_stage_duration_seconds_sum{{stage="{stage}"}} {self.duration_sums[stage]}')
+                lines.append(f'hr_chatbot_stage_duration_seconds_count{{stage="{stage}"}} {counts[-1]}')
+            lines += ["# HELP hr_chatbot_stage_errors_total Stages that raised.",
+                      "# TYPE hr_chatbot_stage_errors_total counter"]
+            for stage, count in sorted(self.errors.items()):
+                lines.append(f'hr_chatbot_stage_errors_total{{stage="{stage}"}} {count}')
+            lines += ["# HELP hr_chatbot_tokens_total Tokens reported by the OpenAI responses.",
+                      "# TYPE hr_chatbot_tokens_total counter"]
+            for (stage, kind), count in sorted(self.tokens.items()):
+                lines.append(f'hr_chatbot_tokens_total{{stage="{stage}",kind="{kind}"}} {count}')
+            lines += ["# HELP hr_chatbot_cache_lookups_total Cache lookups by result.",
+                      "# TYPE hr_chatbot_cache_lookups_total counter"]
+            for (cache, result), count in sorted(self.cache_lookups.items()):
+                lines.append(f'hr_chatbot_cache_lookups_total{{cache="{cache}",result="{result}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=TRACING_PROMETHEUS_PORT):
+        # GET /metrics on a background thread
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = sink.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+
+_sinks = []
+_sinks_lock = threading.Lock()
+
+def register_sink(sink):
+    with _sinks_lock:
+        _sinks.append(sink)
+
+def _emit(trace):
+    with _sinks_lock:
+        sinks = list(_sinks)
+    for sink in sinks:
+        try:
+            sink.emit(trace)
+        except Exception as e:
+            print("WARNING - tracing sink failed:", e)
+
+def _configure_sinks():
+    for name in (name.strip() for name in TRACING_SINKS.split(",")):
+        if name == "log":
+            register_sink(LogSink())
+        elif name == "file":
+            register_sink(FileSink())
+        elif name == "prometheus":
+            sink = PrometheusSink()
+            try:
+                sink.serve()
+            except OSError as e:
+                # e.g. another worker process already serves the port
+                print("WARNING - metrics endpoint not started:", e)
+            register_sink(sink)
+        elif name:
+            print("WARNING - unknown tracing sink:", name)
+
+if TRACING_ENABLED:
+    _configure_sinks()